@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# Copyright 2020 Erik Lönroth
+# See LICENSE file for licensing details.
+"""
+Compare plain tarfile.extractall with the threaded extraction in
+nextcloud.utils.extract_nextcloud.
+
+Runs against tests/nextcloud.tar.bz2 and a generated tarball shaped like a
+nextcloud release (many small php/js files in nested directories).
+
+    PYTHONPATH=src:../lib python3 benchmarks/bench_extract.py [--files 20000]
+"""
+import argparse
+import os
+import random
+import shutil
+import statistics
+import tarfile
+import tempfile
+import time
+
+from nextcloud import utils
+
+TESTS_TARBALL = os.path.join(os.path.dirname(__file__), '..', 'tests', 'nextcloud.tar.bz2')
+
+
+def make_tarball(path, files, seed=0):
+    """
+    Write a bz2 tarball with files small files spread over nested
+    directories, sizes roughly like a nextcloud release.
+    """
+    rnd = random.Random(seed)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        root = os.path.join(tmpdir, 'nextcloud')
+        for i in range(files):
+            d = os.path.join(root, 'apps', f"app{i % 150}", 'lib', f"dir{i % 13}")
+            os.makedirs(d, exist_ok=True)
+            with open(os.path.join(d, f"file{i}.php"), 'wb') as f:
+                f.write(os.urandom(16).hex().encode() * rnd.randint(4, 256))
+        with tarfile.open(path, 'w:bz2') as tfile:
+            tfile.add(root, arcname='nextcloud')
+
+
+def extractall(tarball, dst):
+    with tarfile.open(tarball, mode='r:*') as tfile:
+        tfile.extractall(path=dst)
+
+
+def bench(extract, repeat):
+    times = []
+    for _ in range(repeat):
+        dst = tempfile.mkdtemp(prefix='bench-extract-')
+        try:
+            start = time.perf_counter()
+            extract(dst)
+            times.append(time.perf_counter() - start)
+        finally:
+            shutil.rmtree(dst)
+    return statistics.median(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--files', type=int, default=5000,
+                        help="number of files in the generated tarball")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--workers', type=int, default=utils.EXTRACT_WORKERS)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        generated = os.path.join(tmpdir, 'generated.tar.bz2')
+        make_tarball(generated, args.files)
+        print(f"{'tarball':<28}{'extractall':>12}{'threaded':>12}{'speedup':>10}")
+        for name, tarball in [('tests/nextcloud.tar.bz2', TESTS_TARBALL),
+                              (f"generated ({args.files} files)", generated)]:
+            serial = bench(lambda dst: extractall(tarball, dst), args.repeat)
+            threaded = bench(lambda dst: utils.extract_nextcloud(tarball, dst=dst,
+                                                                 workers=args.workers),
+                             args.repeat)
+            print(f"{name:<28}{serial:>11.3f}s{threaded:>11.3f}s{serial / threaded:>9.2f}x")
+
+
+if __name__ == '__main__':
+    main()
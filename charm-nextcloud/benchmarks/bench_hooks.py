@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+# Copyright 2020 Erik Lönroth
+# See LICENSE file for licensing details.
+"""
+Measure the cost of the main charm hook paths, offline.
+
+occ/php, sudo, apt, systemctl, apache and juju hook tools are replaced by
+stub executables on PATH that only count their calls, the nextcloud tarball
+is served by a local HTTP server, and files the charm writes under /etc and
+/var/www go to a temporary directory. Hooks run in ops.testing.Harness.
+
+Reported per scenario: wall time, subprocesses spawned, and peak RSS of
+this process (and of the stubs) so far.
+
+    PYTHONPATH=src:../lib python3 benchmarks/bench_hooks.py [--peers 1,5,10,25,50]
+"""
+import argparse
+import functools
+import http.server
+import os
+import resource
+import shutil
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+import warnings
+from contextlib import ExitStack
+from pathlib import Path
+from unittest import mock
+
+from ops.testing import Harness
+
+import charm
+from charm import NextcloudCharm
+from nextcloud import config_php, utils
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from bench_extract import make_tarball  # noqa: E402
+
+# Executables replaced by stubs that succeed without doing anything.
+STUBS = ['systemctl', 'apt', 'apache2ctl', 'a2enmod', 'a2dismod', 'a2ensite',
+         'a2dissite', 'phpenmod', 'open-port', 'close-port', 'mount', 'chown']
+
+STUB_SH = """#!/bin/sh
+echo "$(basename "$0") $*" >> "$BENCH_CALLS"
+"""
+
+# sudo runs stubbed commands and ignores everything else.
+SUDO_SH = """#!/bin/sh
+echo "sudo $*" >> "$BENCH_CALLS"
+while [ "${1#-}" != "$1" ]; do
+  case "$1" in -u|-g) shift ;; esac
+  shift
+done
+if [ -x "$BENCH_BIN/$1" ]; then
+  exec "$@"
+fi
+"""
+
+PHP_PY = """#!{python}
+import json, os, sys
+with open(os.environ['BENCH_CALLS'], 'a') as f:
+    f.write('php ' + ' '.join(sys.argv[1:2]) + '\\n')
+args = sys.argv[1:]
+if args[:1] == ['-v']:
+    print('PHP 7.4.3 (cli) (built: Oct  6 2020 15:47:56) ( NTS )')
+elif args[:1] == ['-m']:
+    print('[PHP Modules]\\napcu\\ncurl\\ngd\\npgsql\\nredis\\nzip')
+elif args[:1] == ['-r']:
+    commands = json.loads(sys.stdin.read() or '[]')
+    print(json.dumps([{{'returncode': 0, 'stdout': ''}} for _ in commands]))
+elif args[1:2] == ['status']:
+    print(json.dumps({{'installed': True, 'version': '20.0.6.1', 'maintenance': False}}))
+"""
+
+
+class Stubs:
+    """
+    Stub executables on PATH, counting their invocations.
+    """
+
+    def __init__(self, root):
+        self.bin = root / 'bin'
+        self.bin.mkdir()
+        self.calls = root / 'calls.log'
+        self.calls.touch()
+        for name in STUBS:
+            self._write(name, STUB_SH)
+        self._write('sudo', SUDO_SH)
+        self._write('php', PHP_PY.format(python=sys.executable))
+        os.environ['BENCH_CALLS'] = str(self.calls)
+        os.environ['BENCH_BIN'] = str(self.bin)
+        os.environ['PATH'] = f"{self.bin}:{os.environ['PATH']}"
+
+    def _write(self, name, text):
+        path = self.bin / name
+        path.write_text(text)
+        path.chmod(0o755)
+
+    def count(self):
+        with open(self.calls) as f:
+            return sum(1 for _ in f)
+
+
+def serve(directory):
+    """
+    Serve directory over HTTP in a thread.
+    :return: base url
+    """
+    class Handler(http.server.SimpleHTTPRequestHandler):
+        def translate_path(self, path):
+            return os.path.join(directory, path.lstrip('/').split('?')[0])
+
+        def log_message(self, *args):
+            pass
+
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def redirect_writes(root):
+    """
+    Patch utils.write_atomic (used for every rendered file) to write
+    absolute paths below root instead.
+    """
+    original = utils.write_atomic
+
+    def write_atomic(path, text):
+        path = Path(path)
+        if not str(path).startswith(str(root)):
+            path = root / path.relative_to('/')
+        path.parent.mkdir(parents=True, exist_ok=True)
+        return original(path, text)
+    return mock.patch.object(utils, 'write_atomic', write_atomic)
+
+
+def peak_rss_mb():
+    self_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children_kb = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return self_kb / 1024, children_kb / 1024
+
+
+class Bench:
+
+    def __init__(self, stubs):
+        self.stubs = stubs
+        self.rows = []
+
+    def measure(self, name, func):
+        calls = self.stubs.count()
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        rss, children_rss = peak_rss_mb()
+        self.rows.append((name, elapsed, self.stubs.count() - calls, rss, children_rss))
+
+    def report(self):
+        print(f"{'scenario':<30}{'time':>10}{'subprocs':>10}{'rss MB':>10}{'stub rss MB':>13}")
+        for name, elapsed, calls, rss, children_rss in self.rows:
+            print(f"{name:<30}{elapsed:>9.3f}s{calls:>10}{rss:>10.1f}{children_rss:>13.1f}")
+
+
+def new_harness(leader=True):
+    harness = Harness(NextcloudCharm)
+    harness.set_leader(leader)
+    harness.begin()
+    return harness
+
+
+def commit(harness):
+    # End of hook: scheduled service restarts run here.
+    harness.framework.commit()
+
+
+def bench_install(bench, root, url, owner):
+    harness = new_harness()
+    harness.update_config({'nextcloud-tarfile': url, 'tarball-cache-size': 0})
+
+    def install():
+        harness.charm.on.install.emit()
+        commit(harness)
+        utils.set_directory_permissions(root / 'www' / 'nextcloud', owner=owner, skip=['data'])
+    bench.measure('install (fetch+extract+chown)', install)
+    harness.cleanup()
+
+
+def bench_config_changed(bench):
+    harness = new_harness()
+
+    def config_changed():
+        harness.charm.on.config_changed.emit()
+        commit(harness)
+    bench.measure('config-changed (first)', config_changed)
+    bench.measure('config-changed (no change)', config_changed)
+    harness.cleanup()
+
+
+def bench_cluster_join(bench, peers, config_path):
+    os.makedirs(os.path.dirname(config_path), exist_ok=True)
+    config_php.write_config({'instanceid': 'bench',
+                             'trusted_domains': ['localhost', 'nextcloud.local']},
+                            config_path)
+    harness = new_harness()
+    harness.charm._stored.nextcloud_initialized = True
+    rel_id = harness.add_relation('cluster', 'nextcloud')
+    harness.update_relation_data(rel_id, 'nextcloud/0', {'ingress-address': '10.0.0.1'})
+
+    def join():
+        for i in range(1, peers + 1):
+            # Juju sets ingress-address before relation-joined runs.
+            with harness.hooks_disabled():
+                harness.add_relation_unit(rel_id, f"nextcloud/{i}")
+                harness.update_relation_data(rel_id, f"nextcloud/{i}",
+                                             {'ingress-address': f"10.0.1.{i}"})
+            relation = harness.model.get_relation('cluster', rel_id)
+            unit = harness.model.get_unit(f"nextcloud/{i}")
+            harness.charm.on.cluster_relation_joined.emit(relation, harness.model.app, unit)
+            commit(harness)
+            harness.charm.on.cluster_relation_changed.emit(relation, harness.model.app, unit)
+            commit(harness)
+    bench.measure(f"cluster-join ({peers} peers)", join)
+    harness.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--files', type=int, default=2000,
+                        help="number of files in the generated nextcloud tarball")
+    parser.add_argument('--peers', default='1,5,10,25,50',
+                        help="comma separated numbers of simulated peers")
+    parser.add_argument('--owner', default=utils.NEXTCLOUD_OWNER,
+                        help="owner given to the extracted tree")
+    args = parser.parse_args()
+    warnings.simplefilter('ignore')
+
+    with tempfile.TemporaryDirectory() as tmpdir, ExitStack() as stack:
+        root = Path(tmpdir)
+        stubs = Stubs(root)
+        (root / 'www').mkdir()
+        make_tarball(str(root / 'nextcloud.tar.bz2'), args.files)
+        url = serve(tmpdir) + '/nextcloud.tar.bz2'
+        config_path = str(root / 'www' / 'nextcloud' / 'config' / 'config.php')
+        get_trusted = functools.partial(config_php.get_trusted_domains, path=config_path)
+        set_trusted = functools.partial(config_php.set_trusted_domains, path=config_path)
+        for patcher in [
+                redirect_writes(root),
+                mock.patch.object(utils, 'WWW_DIR', root / 'www'),
+                mock.patch.object(utils, 'DPKG_STATUS', str(root / 'dpkg-status')),
+                mock.patch.object(utils, 'TEMPLATE_CACHE_DIR', str(root / 'jinja2')),
+                mock.patch.object(charm, 'NEXTCLOUD_ROOT', str(root / 'www' / 'nextcloud')),
+                mock.patch.object(charm, 'NEXTCLOUD_CONFIG_PHP', config_path),
+                mock.patch.object(config_php, 'get_trusted_domains', get_trusted),
+                mock.patch.object(config_php, 'set_trusted_domains', set_trusted),
+                mock.patch('nextcloud.telemetry.LOG_PATH', str(root / 'telemetry.jsonl'))]:
+            stack.enter_context(patcher)
+
+        bench = Bench(stubs)
+        bench_install(bench, root, url, args.owner)
+        bench_config_changed(bench)
+        for peers in (int(p) for p in args.peers.split(',')):
+            bench_cluster_join(bench, peers, config_path)
+        bench.report()
+        shutil.rmtree(root / 'www')
+
+
+if __name__ == '__main__':
+    main()
@@ -4,9 +4,9 @@
 
 import logging
 import subprocess as sp
-import sys
 import os
 import socket
+import sys
 from pathlib import Path
 import json
 
@@ -22,10 +22,13 @@ from ops.model import (
     ModelError
 )
 
-from nextcloud import utils
+from nextcloud import config_php, dbmaint, jobs, php_tuning, telemetry, utils
+from nextcloud.cache import TarballCache, CACHE_DIR
 from nextcloud.occ import Occ
 
 from interface_http import HttpProvider
+from deferral import DeferralManager
+from services import ServiceScheduler
 import interface_redis
 
 logger = logging.getLogger(__name__)
@@ -37,8 +40,18 @@ pgsql = use("pgsql", 1, "postgresql-charmers@lists.launchpad.net")
 NEXTCLOUD_ROOT = os.path.abspath('/var/www/nextcloud')
 NEXTCLOUD_CONFIG_PHP = os.path.abspath('/var/www/nextcloud/config/config.php')
 NEXTCLOUD_CEPH_CONFIG_PHP = os.path.join(NEXTCLOUD_ROOT, 'config/ceph.config.php')
-
-
+# Directories scanned in parallel when fixing ownership on NFS.
+NFS_PERMISSION_WORKERS = 16
+# systemd timer running nextcloud background jobs (cron.php).
+CRON_TIMER = 'nextcloud-cron'
+# systemd timer generating previews of new files ahead of time.
+PREVIEW_TIMER = 'nextcloud-previews'
+PREVIEW_APP = 'previewgenerator'
+# systemd timer vacuuming the database in the db-maintenance-window.
+DBMAINT_TIMER = 'nextcloud-dbmaint'
+
+
+@telemetry.instrument
 class NextcloudCharm(CharmBase):
     _stored = StoredState()
 
@@ -47,6 +60,10 @@ class NextcloudCharm(CharmBase):
         self.db = pgsql.PostgreSQLClient(self, 'db')  # 'db' relation in metadata.yaml
         # The website provider takes care of incoming relations on the http interface.
         self.website = HttpProvider(self, 'website', socket.getfqdn(), 80)
+        # Restarts/reloads requested by handlers run once, at the end of the hook.
+        self.services = ServiceScheduler(self, 'services')
+        # Events waiting for the unit to be ready, at most one per handler and relation.
+        self.deferrals = DeferralManager(self, 'deferrals')
         self._stored.set_default(data_dir='/var/www/nextcloud/data/',
                                  nextcloud_fetched=False,
                                  nextcloud_initialized=False,
@@ -55,14 +72,30 @@ class NextcloudCharm(CharmBase):
                                  php_configured=False,
                                  ceph_configured=False)
         self._stored.set_default(db_conn_str=None, db_uri=None, db_ro_uris=[])
+        # Connection strings of the standbys, in the order of db_ro_uris.
+        self._stored.set_default(db_ro_conn_strs=[])
+        # Number of php files in the nextcloud tree, for sizing the opcache.
+        self._stored.set_default(php_file_count=None)
+        # Hash of the config.php last replicated from the leader.
+        self._stored.set_default(config_hash=None)
+        # Background jobs mode last set with occ by this unit as leader.
+        self._stored.set_default(background_jobs_mode=None)
+        self._stored.set_default(preview_app_enabled=False)
+        # Host facts (php version, distro, ...) probed in earlier hooks.
+        self._stored.set_default(probes='{}')
+        utils.load_probes(json.loads(self._stored.probes))
+        self.framework.observe(self.framework.on.pre_commit, self._on_pre_commit)
 
         event_bindings = {
             self.on.install: self._on_install,
             self.on.config_changed: self._on_config_changed,
+            self.on.upgrade_charm: self._on_upgrade_charm,
             self.on.start: self._on_start,
             self.on.leader_elected: self._on_leader_elected,
+            self.on.leader_settings_changed: self._on_leader_settings_changed,
             self.db.on.database_relation_joined: self._on_database_relation_joined,
             self.db.on.master_changed: self._on_master_changed,
+            self.db.on.standby_changed: self._on_standby_changed,
             self.on.update_status: self._on_update_status,
             self.on.cluster_relation_changed: self._on_cluster_relation_changed,
             self.on.cluster_relation_joined: self._on_cluster_relation_joined,
@@ -77,6 +110,7 @@ class NextcloudCharm(CharmBase):
         self._stored.set_default(redis_info=dict())
         self._redis = interface_redis.RedisClient(self, "redis")
         self.framework.observe(self._redis.on.redis_available, self._on_redis_available)
+        self.framework.observe(self._redis.on.redis_unavailable, self._on_redis_unavailable)
 
         for event, handler in event_bindings.items():
             self.framework.observe(event, handler)
@@ -84,59 +118,256 @@ class NextcloudCharm(CharmBase):
         action_bindings = {
             self.on.add_missing_indices_action: self._on_add_missing_indices_action,
             self.on.convert_filecache_bigint_action: self._on_convert_filecache_bigint_action,
-            self.on.maintenance_action: self._on_maintenance_action
+            self.on.maintenance_action: self._on_maintenance_action,
+            self.on.hook_stats_action: self._on_hook_stats_action,
+            self.on.generate_all_previews_action: self._on_generate_all_previews_action,
+            self.on.job_status_action: self._on_job_status_action,
+            self.on.job_cancel_action: self._on_job_cancel_action,
+            self.on.db_bloat_report_action: self._on_db_bloat_report_action,
+            self.on.db_repair_schema_action: self._on_db_repair_schema_action,
+            self.on.db_vacuum_action: self._on_db_vacuum_action
         }
 
         for action, handler in action_bindings.items():
             self.framework.observe(action, handler)
 
+    def _on_pre_commit(self, event):
+        self._stored.probes = json.dumps(utils.export_probes())
+
     def _on_install(self, event):
         self.unit.status = MaintenanceStatus("Begin installing dependencies...")
-        utils.install_dependencies()
+        utils.install_dependencies(shared_fs=bool(self.model.relations['shared-fs']),
+                                   deb_archive=self._deb_cache_resource(),
+                                   php_fpm=self.config.get('php-handler') == 'fpm')
         self.unit.status = MaintenanceStatus("Dependencies installed")
         if not self._stored.nextcloud_fetched:
             # Fetch nextcloud to /var/www/
             self.unit.status = MaintenanceStatus("Begin fetching sources.")
+            cache = self._tarball_cache()
             try:
                 tarfile_path = self.model.resources.fetch('nextcloud-tarfile')
-                utils.extract_nextcloud(tarfile_path)
+                utils.extract_nextcloud(tarfile_path, cache=cache)
             except ModelError:
-                utils.fetch_and_extract_nextcloud(self.config.get('nextcloud-tarfile'))
+                mirror_url, mirror_sha256 = self._shared_tarball_url()
+                sha256 = self.config.get('nextcloud-tarfile-sha256') or None
+                utils.fetch_and_extract_nextcloud(self.config.get('nextcloud-tarfile'),
+                                                  progress=self._fetch_progress,
+                                                  sha256=sha256,
+                                                  cache=cache,
+                                                  mirror_url=mirror_url,
+                                                  mirror_sha256=mirror_sha256)
             self.unit.status = MaintenanceStatus("Sources installed")
             self._stored.nextcloud_fetched = True
+            self._stored.php_file_count = None
+
+    def _deb_cache_resource(self):
+        """
+        Path to the optional deb-cache resource, a tarball of .deb
+        files for offline installs, or None.
+        """
+        try:
+            path = self.model.resources.fetch('deb-cache')
+        except ModelError:
+            return None
+        return path if os.path.getsize(path) else None
+
+    def _tarball_cache(self):
+        """
+        The local nextcloud tarball cache, or None if disabled.
+        """
+        max_mb = self.config.get('tarball-cache-size')
+        if not max_mb:
+            return None
+        return TarballCache(max_bytes=max_mb * 1024 * 1024)
+
+    def _shared_tarball_url(self):
+        """
+        Url and sha256 of the tarball the leader shares over the cluster
+        relation, if it matches the configured sha256 (when one is set).
+        :return: (url, sha256), (None, None) if there is none to use.
+        """
+        cluster_rel = self.model.get_relation('cluster')
+        if not cluster_rel:
+            return None, None
+        url = cluster_rel.data[self.app].get('nextcloud_tarball_url')
+        sha256 = cluster_rel.data[self.app].get('nextcloud_tarball_sha256')
+        expected = self.config.get('nextcloud-tarfile-sha256')
+        if not url or not sha256 or (expected and expected.lower() != sha256):
+            return None, None
+        return url, sha256
+
+    def _apache_ctx(self):
+        """
+        Context for nextcloud.conf.j2. The shared tarball cache is only
+        served to the peer units.
+        """
+        ctx = {}
+        if self.config.get('share-tarball-cache') and self.config.get('tarball-cache-size'):
+            ctx['tarball_cache_dir'] = os.path.join(CACHE_DIR, 'blobs')
+            ctx['tarball_peers'] = self._peer_addresses()
+        if self.config.get('php-handler') == 'fpm':
+            ctx['fpm_socket'] = utils.fpm_socket()
+        return ctx
+
+    def _peer_addresses(self):
+        """
+        :return: sorted ingress addresses of the other units.
+        """
+        cluster_rel = self.model.get_relation('cluster')
+        if not cluster_rel:
+            return []
+        return sorted(filter(None, (cluster_rel.data[u].get('ingress-address')
+                                    for u in cluster_rel.units)))
+
+    def _config_tarball_peers(self):
+        """
+        Leader lets the current peers, and only them, fetch the shared
+        tarball.
+        """
+        if not (self.model.unit.is_leader() and self._stored.apache_configured):
+            return
+        if 'tarball_cache_dir' not in self._apache_ctx():
+            return
+        if utils.config_apache2(Path(self.charm_dir / 'templates'), 'nextcloud.conf.j2',
+                                self._apache_ctx()):
+            self.services.reload('apache2')
+
+    def _share_tarball(self):
+        """
+        Leader publishes its cached nextcloud tarball to the peers, served
+        by apache at /nextcloud-tarballs/<sha256>.
+        """
+        cluster_rel = self.model.get_relation('cluster')
+        if not (self.model.unit.is_leader() and cluster_rel):
+            return
+        cache = self._tarball_cache()
+        cached = None
+        if cache and self.config.get('share-tarball-cache'):
+            cached = cache.lookup(self.config.get('nextcloud-tarfile'),
+                                  self.config.get('nextcloud-tarfile-sha256') or None)
+        if cached is None:
+            cluster_rel.data[self.app].pop('nextcloud_tarball_url', None)
+            cluster_rel.data[self.app].pop('nextcloud_tarball_sha256', None)
+            return
+        ingress_addr = cluster_rel.data[self.model.unit]['ingress-address']
+        cluster_rel.data[self.app]['nextcloud_tarball_url'] = \
+            f"http://{ingress_addr}/nextcloud-tarballs/{cached.name}"
+        cluster_rel.data[self.app]['nextcloud_tarball_sha256'] = cached.name
+
+    def _fetch_progress(self, done, total):
+        """
+        Report download progress of the nextcloud sources in steps of 10%,
+        or every 10MB if the size is unknown.
+        """
+        step = done * 10 // total if total else done // (10 * 1024 * 1024)
+        if step == getattr(self, '_fetch_step', None):
+            return
+        self._fetch_step = step
+        if total:
+            self.unit.status = MaintenanceStatus(f"Fetching sources {step * 10}%")
+        else:
+            self.unit.status = MaintenanceStatus(f"Fetching sources {done // (1024 * 1024)}MB")
 
     def _on_config_changed(self, event):
         """
         Any configuration change trigger a complete reconfigure of
-        the php and apache and also a restart of apache.
+        the php and apache. Apache is only gracefully reloaded if the
+        rendered configuration actually changed, and restarted when
+        switching php-handler (which changes the MPM).
         :param event:
         :return:
         """
+        handler = self.config.get('php-handler')
+        if handler not in utils.PHP_HANDLER_MODULES:
+            self.unit.status = BlockedStatus(f"Invalid php-handler: {handler}")
+            return
+        if handler == 'fpm':
+            utils.install_packages(utils.FPM_PACKAGES[utils.get_distro_codename()])
         self.unit.status = MaintenanceStatus("Begin config apache2.")
-        utils.config_apache2(Path(self.charm_dir / 'templates'), 'nextcloud.conf.j2')
+        apache_changed = utils.config_apache2(Path(self.charm_dir / 'templates'),
+                                              'nextcloud.conf.j2', self._apache_ctx())
+        handler_changed = utils.config_php_handler(handler)
+        self._share_tarball()
         self._stored.apache_configured = True
         self.unit.status = MaintenanceStatus("apache2 config complete.")
-        self._config_php()
+        try:
+            php_changed = self._config_php()
+            fpm_changed = self._config_php_fpm()
+        except ValueError as e:
+            self.unit.status = BlockedStatus(str(e))
+            return
+        self._config_redis()
+        self._config_dbreplica()
+        if self.model.unit.is_leader():
+            self._config_ceph()
+        self._config_previews()
+        self._config_workers()
         # self._config_website()
-        sp.check_call(['systemctl', 'restart', 'apache2.service'])
+        if handler_changed:
+            self.services.restart('apache2')
+        elif apache_changed or (php_changed and handler == 'mod_php'):
+            self.services.reload('apache2')
+        if handler == 'fpm' and handler_changed:
+            self.services.restart(utils.fpm_service())
+        elif fpm_changed or (php_changed and handler == 'fpm'):
+            self.services.reload(utils.fpm_service())
         self._on_update_status(event)
 
+    def _on_upgrade_charm(self, event):
+        """
+        Install packages added to the charm and re-render the
+        configuration with the new charm templates. In production mode
+        php does not look at file timestamps, so the opcache is reset to
+        pick up code changed by the upgrade.
+        """
+        # The new charm may need packages the old one did not install.
+        utils.install_dependencies(shared_fs=bool(self.model.relations['shared-fs']),
+                                   deb_archive=self._deb_cache_resource(),
+                                   php_fpm=self.config.get('php-handler') == 'fpm')
+        self._stored.php_file_count = None
+        self._on_config_changed(event)
+        if self.config.get('php-production-mode'):
+            self._reset_opcache()
+
+    def _reset_opcache(self):
+        """
+        The opcache lives in the processes running php, reloading them
+        starts over with an empty one.
+        """
+        if self.config.get('php-handler') == 'fpm':
+            self.services.reload(utils.fpm_service())
+        else:
+            self.services.reload('apache2')
+
     def _on_database_relation_joined(self, event: pgsql.DatabaseRelationJoinedEvent):
+        # Until the leader has set requirements, defer, incase this unit
+        # becomes leader and needs to perform that operation.
+        def ready():
+            return self.model.unit.is_leader() or event.database == 'nextcloud'
+        if not self.deferrals.gate(event, "waiting for the leader to request the database", ready):
+            return
         if self.model.unit.is_leader():
             # Provide requirements to the PostgreSQL server.
             event.database = 'nextcloud'  # Request database named mydbname
             event.extensions = ['citext']  # Request the citext extension installed
-        elif event.database != 'nextcloud':
-            # Leader has not yet set requirements. Defer, incase this unit
-            # becomes leader and needs to perform that operation.
-            event.defer()
-            return
 
     # Only leader is running this hook (verify this)
     def _on_leader_elected(self, event):
         logger.debug("!!!!!!!!new leader!!!!!!!!")
         self.framework.breakpoint('leader')
+        self._share_tarball()
         self.update_config_php_trusted_domains()
+        # Take over running background jobs. The mode is set again, it
+        # may have been changed while another unit was leader.
+        self._stored.background_jobs_mode = None
+        self._config_workers()
+
+    def _on_leader_settings_changed(self, event):
+        """
+        Runs on the units that are not the leader, after a leader change
+        one of them may still run background jobs.
+        """
+        self._config_workers()
 
     def update_config_php_trusted_domains(self):
         if not os.path.exists(NEXTCLOUD_CONFIG_PHP):
@@ -147,9 +378,39 @@ class NextcloudCharm(CharmBase):
         this_unit_ip = cluster_rel.data[self.model.unit]['ingress-address']
         rel_unit_ip.append(this_unit_ip)
         Occ.update_trusted_domains_peer_ips(rel_unit_ip)
-        with open(NEXTCLOUD_CONFIG_PHP) as f:
-            nextcloud_config = f.read()
-            cluster_rel.data[self.app]['nextcloud_config'] = str(nextcloud_config)
+        self.publish_config_php(cluster_rel)
+
+    def publish_config_php(self, cluster_rel):
+        """
+        Leader replicates config.php to the peers. The relation data is
+        only touched when the content hash changes, and carries:
+        - nextcloud_config_hash: hash of the config (see config_php.config_hash),
+          peers that are up to date with it skip rewriting config.php
+        - nextcloud_config_base: a snapshot of the config, only republished
+          when the diff grows to half its size
+        - nextcloud_config_diff: the changed keys relative to the snapshot,
+          the only key that changes with a config change
+        """
+        try:
+            config = config_php.read_config(NEXTCLOUD_CONFIG_PHP)
+        except config_php.ConfigPhpError as e:
+            logger.error("Not publishing config.php, it could not be parsed: %s", e)
+            return
+        new_hash = config_php.config_hash(config)
+        app_data = cluster_rel.data[self.app]
+        if new_hash == app_data.get('nextcloud_config_hash'):
+            return
+        base = app_data.get('nextcloud_config_base')
+        changes = json.dumps(config_php.diff(json.loads(base), config)) if base else None
+        if changes is None or len(changes) * 2 > len(base):
+            base = json.dumps(config)
+            changes = json.dumps(config_php.diff(config, config))
+            app_data['nextcloud_config_base'] = base
+        app_data['nextcloud_config_diff'] = changes
+        app_data['nextcloud_config_hash'] = new_hash
+        # Replaced by the keys above.
+        app_data.pop('nextcloud_config', None)
+        app_data.pop('nextcloud_config_json', None)
 
     def update_relation_ceph_config_php(self):
         if not os.path.exists(NEXTCLOUD_CEPH_CONFIG_PHP):
@@ -160,38 +421,62 @@ class NextcloudCharm(CharmBase):
             cluster_rel.data[self.app]['ceph_config'] = str(ceph_config)
 
     def _on_cluster_relation_joined(self, event):
+        self._config_tarball_peers()
+
+        def ready():
+            return not self.model.unit.is_leader() or self._stored.nextcloud_initialized
+        if not self.deferrals.gate(event, "waiting for nextcloud to be initialized", ready,
+                                   watch=['nextcloud_initialized']):
+            return
         if self.model.unit.is_leader():
-            if not self._stored.nextcloud_initialized:
-                event.defer()
-                return
             self.framework.breakpoint('joined')
             self.update_config_php_trusted_domains()
 
     def _on_cluster_relation_changed(self, event):
+        def ready():
+            if self.model.unit.is_leader():
+                return True
+            return 'nextcloud_config_hash' in event.relation.data[self.app]
+        if not self.deferrals.gate(event, "waiting for the leader to publish config.php", ready):
+            return
         if not self.model.unit.is_leader():
-            if 'nextcloud_config' not in event.relation.data[self.app]:
-                event.defer()
-                return
-            nextcloud_config = event.relation.data[self.app]['nextcloud_config']
-            with open(NEXTCLOUD_CONFIG_PHP, "w") as f:
-                f.write(nextcloud_config)
-            data_dir_path = os.path.join(NEXTCLOUD_ROOT, 'data')
-            ocdata_path = os.path.join(data_dir_path, '.ocdata')
-            if not os.path.exists(data_dir_path):
-                os.mkdir(data_dir_path)
-            if not os.path.exists(ocdata_path):
-                open(ocdata_path, 'a').close()
-            utils.set_directory_permissions()
-            self._stored.database_available = True
-            self._stored.nextcloud_initialized = True
+            app_data = event.relation.data[self.app]
+            if app_data['nextcloud_config_hash'] != self._stored.config_hash:
+                self._apply_replicated_config(app_data)
+            if not self._stored.nextcloud_initialized:
+                data_dir_path = os.path.join(NEXTCLOUD_ROOT, 'data')
+                ocdata_path = os.path.join(data_dir_path, '.ocdata')
+                if not os.path.exists(data_dir_path):
+                    os.mkdir(data_dir_path)
+                if not os.path.exists(ocdata_path):
+                    open(ocdata_path, 'a').close()
+                # The content of data/ is either empty or on shared storage,
+                # only its top level needs fixing.
+                utils.set_directory_permissions(skip=['data'])
+                utils.set_directory_permissions(data_dir_path, max_depth=1)
+                self._stored.database_available = True
+                self._stored.nextcloud_initialized = True
+                self._config_dbreplica()
             # Broadcast ceph config to peers
-            if 'ceph_config' in event.relation.data[self.app]:
-                ceph_config = event.relation.data[self.app]['ceph_config']
-                with open(NEXTCLOUD_CEPH_CONFIG_PHP, "w") as f:
-                    f.write(ceph_config)
+            if 'ceph_config' in app_data:
+                utils.write_atomic(NEXTCLOUD_CEPH_CONFIG_PHP, app_data['ceph_config'])
+
+    def _apply_replicated_config(self, app_data):
+        """
+        Bring the local config.php up to the leaders version, the snapshot
+        with the published diff applied.
+        """
+        config = config_php.patch(json.loads(app_data['nextcloud_config_base']),
+                                  json.loads(app_data['nextcloud_config_diff']))
+        if config_php.config_hash(config) != app_data['nextcloud_config_hash']:
+            logger.error("Replicated config.php does not match the published hash, not writing it")
+            return
+        config_php.write_config(config, NEXTCLOUD_CONFIG_PHP)
+        self._stored.config_hash = app_data['nextcloud_config_hash']
 
     def _on_cluster_relation_departed(self, event):
         self.framework.breakpoint('departed')
+        self._config_tarball_peers()
         if self.model.unit.is_leader():
             self.update_config_php_trusted_domains()
 
@@ -226,42 +511,158 @@ class NextcloudCharm(CharmBase):
         if event.master and event.database == 'nextcloud':
             self._stored.database_available = True
             if not self._stored.nextcloud_initialized:
-                utils.set_directory_permissions()
+                utils.set_directory_permissions(skip=['data'])
                 self._init_nextcloud()
                 self._add_initial_trusted_domain()
                 installed = Occ.status()['installed']
                 if installed:
                     logger.debug("===== Nextcloud install_status: {}====".format(installed))
                     self._stored.nextcloud_initialized = True
+                    self._config_workers()
+                    self._config_dbreplica()
+
+    def _on_standby_changed(self, event: pgsql.StandbyChangedEvent):
+        """
+        The hot standbys of the database changed, every unit spreads its
+        read queries over them.
+        """
+        if event.database != 'nextcloud':
+            # Leader has not yet set requirements.
+            return
+        standbys = sorted(event.standbys, key=lambda s: s.uri)
+        self._stored.db_ro_uris = [s.uri for s in standbys]
+        self._stored.db_ro_conn_strs = [s.conn_str for s in standbys]
+        logger.info("Database has %d standbys", len(standbys))
+        self._config_dbreplica()
+
+    def _config_dbreplica(self):
+        """
+        Renders dbreplica.config.php from the standbys, or removes it.
+        Not before nextcloud is installed, the installer must only see
+        the primary.
+        :return: True if it changed.
+        """
+        replicas = []
+        if self._stored.nextcloud_initialized:
+            for conn_str in self._stored.db_ro_conn_strs:
+                standby = pgsql.ConnectionString(conn_str)
+                replicas.append({'host': f"{standby.host}:{standby.port or 5432}",
+                                 'dbname': standby.dbname,
+                                 'user': standby.user,
+                                 'password': standby.password})
+        return utils.config_dbreplica(replicas, Path(self.charm_dir / 'templates'),
+                                      'dbreplica.config.php.j2')
 
     def _on_start(self, event):
-        if not self._stored.nextcloud_initialized:
-            event.defer()
+        if not self.deferrals.gate(event, "waiting for nextcloud to be initialized",
+                                   lambda: self._stored.nextcloud_initialized,
+                                   watch=['nextcloud_initialized']):
             return
-        try:
-            sp.check_call(['systemctl', 'restart', 'apache2.service'])
-            self._on_update_status(event)
-            utils.open_port('80')
-        except sp.CalledProcessError as e:
-            print(e)
-            sys.exit(-1)
+        self.services.restart('apache2')
+        self._on_update_status(event)
+        utils.open_port('80')
 
     # ACTIONS
 
     def _on_add_missing_indices_action(self, event):
-        o = Occ.db_add_missing_indices()
-        event.set_results({"occ-output": o})
+        self._start_job(event, 'add-missing-indices', [jobs.occ('db:add-missing-indices')])
 
     def _on_convert_filecache_bigint_action(self, event):
         """
         Action to convert-filecache-bigint on the database via occ
         This action places the site in maintenance mode to protect it
-        while this action runs.
+        while the conversion runs, as a background job that may take
+        longer than an action is allowed to.
         """
-        Occ.maintenance_mode(enable=True)
-        o = Occ.db_convert_filecache_bigint()
-        event.set_results({"occ-output": o})
-        Occ.maintenance_mode(enable=False)
+        self._start_job(event, 'convert-filecache-bigint',
+                        [jobs.occ('db:convert-filecache-bigint', '--no-interaction')],
+                        maintenance=True)
+
+    def _start_job(self, event, name, commands, maintenance=False):
+        try:
+            job_id = jobs.start(name, commands, maintenance=maintenance)
+        except jobs.JobError as e:
+            event.fail(str(e))
+            return
+        event.set_results({"job-id": job_id, "log": jobs.log_path(job_id)})
+
+    def _maint_tables(self, event):
+        """
+        Tables given in the tables action parameter, or None for the defaults.
+        :raises ValueError: on invalid table names
+        """
+        tables = (event.params.get('tables') or '').split()
+        return dbmaint.check_tables(tables) if tables else None
+
+    def _on_db_bloat_report_action(self, event):
+        """
+        Size, dead row share and index use of the busiest tables.
+        """
+        try:
+            report = dbmaint.bloat_report(dbmaint.Database.from_config(NEXTCLOUD_CONFIG_PHP),
+                                          self._maint_tables(event))
+        except (ValueError, dbmaint.DatabaseError) as e:
+            event.fail(str(e))
+            return
+        event.set_results({"report": json.dumps(report, indent=2)})
+
+    def _on_db_repair_schema_action(self, event):
+        self._start_job(event, 'db-repair-schema', [
+            jobs.occ('db:add-missing-indices'),
+            jobs.occ('db:add-missing-columns'),
+            jobs.occ('db:add-missing-primary-keys'),
+        ])
+
+    def _on_db_vacuum_action(self, event):
+        """
+        VACUUM (ANALYZE), and optionally REINDEX CONCURRENTLY, now, as a
+        background job. Neither locks out nextcloud.
+        """
+        try:
+            tables = self._maint_tables(event)
+        except ValueError as e:
+            event.fail(str(e))
+            return
+        cmd = [sys.executable, '-m', 'nextcloud.dbmaint', '--config', NEXTCLOUD_CONFIG_PHP]
+        if tables:
+            cmd += ['--tables'] + tables
+        if event.params.get('reindex'):
+            cmd.append('--reindex')
+        self._start_job(event, 'db-vacuum', [cmd])
+
+    def _on_job_status_action(self, event):
+        """
+        State and last log lines of a background job, or of all jobs.
+        """
+        job_id = event.params.get('job-id')
+        if not job_id:
+            summary = [{k: job.get(k) for k in ('id', 'status', 'returncode')}
+                       for job in jobs.list_jobs()]
+            event.set_results({"jobs": json.dumps(summary, indent=2)})
+            return
+        try:
+            state = jobs.status(job_id, tail=event.params.get('tail') or 10)
+        except jobs.JobError as e:
+            event.fail(str(e))
+            return
+        event.set_results(self._job_results(state))
+
+    def _on_job_cancel_action(self, event):
+        try:
+            state = jobs.cancel(event.params['job-id'])
+        except jobs.JobError as e:
+            event.fail(str(e))
+            return
+        event.set_results(self._job_results(state))
+
+    @staticmethod
+    def _job_results(state):
+        results = {"job-id": state['id'], "status": state['status'], "log-tail": state['log_tail']}
+        if state.get('returncode') is not None:
+            results["returncode"] = state['returncode']
+        if state['status'] == jobs.LOST and state.get('maintenance'):
+            results["warning"] = "The job did not finish, check occ maintenance:mode."
+        return results
 
     def _on_maintenance_action(self, event):
         """
@@ -272,22 +673,189 @@ class NextcloudCharm(CharmBase):
         o = Occ.maintenance_mode(enable=event.params['enable'])
         event.set_results({"occ-output": o})
 
+    def _on_hook_stats_action(self, event):
+        """
+        Wall time percentiles per handler, occ command and subprocess,
+        from the telemetry log.
+        """
+        kind = event.params.get('kind') or None
+        summary = telemetry.stats(telemetry.read_log(), kind=kind)
+        top = event.params.get('top')
+        if top:
+            summary = dict(list(summary.items())[:top])
+        event.set_results({"stats": json.dumps(summary, indent=2)})
+
+    def _on_generate_all_previews_action(self, event):
+        """
+        Generate the previews of all existing files, or of one user, as a
+        background job at low priority. The preview worker only handles
+        files added after the previewgenerator app was enabled. Can run for
+        hours on large installs, see job-status and job-cancel.
+        """
+        cmd = ['nice', '-n', '19'] + jobs.occ('preview:generate-all', '-vvv')
+        if event.params.get('user'):
+            cmd.append(event.params['user'])
+        self._start_job(event, 'generate-all-previews', [cmd])
+
     def _config_php(self):
         """
         Renders the phpmodule for nextcloud (nextcloud.ini)
         This is instead of manipulating the system wide php.ini
         which might be overwitten or changed from elsewhere.
+        :return: True if the php config changed.
         """
         self.unit.status = MaintenanceStatus("Begin config php.")
         phpmod_context = {
             'max_file_uploads': self.config.get('php_max_file_uploads'),
             'upload_max_filesize': self.config.get('php_upload_max_filesize'),
             'post_max_size': self.config.get('php_post_max_size'),
-            'memory_limit': self.config.get('php_memory_limit')
+            'memory_limit': self.config.get('php_memory_limit'),
+            'php_settings': self._php_settings()
         }
-        utils.config_php(phpmod_context, Path(self.charm_dir / 'templates'), 'nextcloud.ini.j2')
+        changed = utils.config_php(phpmod_context, Path(self.charm_dir / 'templates'),
+                                   'nextcloud.ini.j2')
         self._stored.php_configured = True
         self.unit.status = MaintenanceStatus("php config complete.")
+        return changed
+
+    def _config_php_fpm(self):
+        """
+        Renders the php-fpm pool for nextcloud, sized from the host memory
+        and php_memory_limit, or removes it when php is served by mod_php.
+        :return: True if the pool changed.
+        """
+        if self.config.get('php-handler') != 'fpm':
+            return utils.config_php_fpm(None, Path(self.charm_dir / 'templates'),
+                                        'nextcloud-fpm.conf.j2')
+        pool = php_tuning.fpm_pool(php_tuning.host_memory(), php_tuning.cpu_count(),
+                                   self.config.get('php_memory_limit'),
+                                   settings=self._php_settings(),
+                                   pm=self.config.get('php-fpm-pm'),
+                                   max_requests=self.config.get('php-fpm-max-requests'))
+        if self.config.get('php-fpm-max-children'):
+            pool['pm.max_children'] = self.config.get('php-fpm-max-children')
+        return utils.config_php_fpm({'pool': pool}, Path(self.charm_dir / 'templates'),
+                                    'nextcloud-fpm.conf.j2')
+
+    def _php_settings(self):
+        """
+        OPcache/APCu/realpath cache settings sized for this host,
+        with the php-ini-overrides config applied on top.
+        :raises ValueError: if php-ini-overrides can not be parsed.
+        """
+        overrides = php_tuning.parse_overrides(self.config.get('php-ini-overrides'))
+        if self._stored.php_file_count is None and os.path.exists(NEXTCLOUD_ROOT):
+            self._stored.php_file_count = php_tuning.count_php_files(NEXTCLOUD_ROOT)
+        settings = php_tuning.tune(php_tuning.host_memory(),
+                                   self._stored.php_file_count or 0,
+                                   php_version=utils.get_phpversion(),
+                                   production=self.config.get('php-production-mode'))
+        settings.update(overrides)
+        return settings
+
+    def _config_workers(self):
+        """
+        Background jobs and preview generation run on the leader only.
+        """
+        self._config_cron()
+        self._config_preview_worker()
+        self._config_db_maintenance()
+
+    def _config_cron(self):
+        """
+        Background jobs run from a systemd timer on the leader only, so
+        they are not run in user requests (AJAX mode) and not by several
+        units at once. The other units remove the timer. With cron-interval
+        0 nextcloud is switched back to AJAX mode.
+        :return: True if the timer changed.
+        """
+        interval = self.config.get('cron-interval')
+        leader = self.model.unit.is_leader() and self._stored.nextcloud_initialized
+        if leader:
+            mode = 'cron' if interval else 'ajax'
+            if self._stored.background_jobs_mode != mode:
+                output = Occ.background_jobs_mode(mode)
+                if output.returncode == 0:
+                    self._stored.background_jobs_mode = mode
+                else:
+                    logger.warning("occ background:%s failed: %s", mode, output.stdout)
+        else:
+            self._stored.background_jobs_mode = None
+        ctx = None
+        if leader and interval:
+            ctx = {'nextcloud_root': NEXTCLOUD_ROOT, 'interval': interval}
+        return utils.config_timer(CRON_TIMER, ctx, Path(self.charm_dir / 'templates'))
+
+    def _preview_workers(self):
+        """
+        Cores used to generate previews, half of them unless preview-workers is set.
+        """
+        cpus = php_tuning.cpu_count()
+        return max(1, min(self.config.get('preview-workers') or cpus // 2, cpus))
+
+    def _config_previews(self):
+        """
+        Renders previews.config.php from the preview-* config options.
+        :return: True if it changed.
+        """
+        providers = []
+        if self.config.get('preview-imaginary-url'):
+            # imaginary renders most formats, the local providers are the fallback.
+            providers.append('OC\\Preview\\Imaginary')
+        for name in self.config.get('preview-providers').split():
+            providers.append(name if '\\' in name else f"OC\\Preview\\{name}")
+        ctx = {'preview_max_x': self.config.get('preview-max-x'),
+               'preview_max_y': self.config.get('preview-max-y'),
+               'concurrency': self._preview_workers(),
+               'providers': providers,
+               'imaginary_url': self.config.get('preview-imaginary-url')}
+        return utils.config_previews(ctx, Path(self.charm_dir / 'templates'),
+                                     'previews.config.php.j2')
+
+    def _config_preview_worker(self):
+        """
+        The leader generates previews of new files every preview-interval
+        minutes (occ preview:pre-generate of the previewgenerator app), at
+        low priority and on at most _preview_workers() cores.
+        :return: True if the timer changed.
+        """
+        interval = self.config.get('preview-interval')
+        ctx = None
+        if self.model.unit.is_leader() and self._stored.nextcloud_initialized and interval:
+            if not self._stored.preview_app_enabled:
+                output = Occ.app_enable(PREVIEW_APP)
+                if output.returncode != 0:
+                    logger.warning("Could not enable the %s app, previews are generated on "
+                                   "demand: %s", PREVIEW_APP, output.stdout)
+                self._stored.preview_app_enabled = output.returncode == 0
+            if self._stored.preview_app_enabled:
+                ctx = {'nextcloud_root': NEXTCLOUD_ROOT, 'interval': interval,
+                       'workers': self._preview_workers()}
+        return utils.config_timer(PREVIEW_TIMER, ctx, Path(self.charm_dir / 'templates'))
+
+    def _config_db_maintenance(self):
+        """
+        The leader vacuums (and with db-reindex reindexes) the busiest
+        tables daily in the db-maintenance-window, when their share of dead
+        rows is above db-vacuum-threshold. Statements still running when
+        the window closes are cancelled. An invalid window only disables
+        the timer, the rest of the configuration is still applied.
+        :return: True if the timer changed.
+        """
+        ctx = None
+        try:
+            window = dbmaint.parse_window(self.config.get('db-maintenance-window'))
+        except ValueError as e:
+            logger.error("Database maintenance disabled: %s", e)
+            window = None
+        if window and self.model.unit.is_leader() and self._stored.nextcloud_initialized:
+            start, minutes = window
+            ctx = {'start': start, 'minutes': minutes,
+                   'threshold': self.config.get('db-vacuum-threshold'),
+                   'reindex': self.config.get('db-reindex'),
+                   'python': sys.executable,
+                   'pythonpath': os.pathsep.join(p for p in sys.path if p)}
+        return utils.config_timer(DBMAINT_TIMER, ctx, Path(self.charm_dir / 'templates'))
 
     def _init_nextcloud(self):
         """
@@ -313,12 +881,13 @@ class NextcloudCharm(CharmBase):
         2. fqdn config
         :return:
         """
-        # Adds the fqdn to trusted domains (if set)
-        if self.config['fqdn']:
-            Occ.config_system_set_trusted_domains(self.config['fqdn'], 1)
         ingress_addr = self.model.get_binding('website').network.ingress_address
-        # Adds the ingress_address to trusted domains
-        Occ.config_system_set_trusted_domains(ingress_addr, 2)
+        with Occ.batch():
+            # Adds the fqdn to trusted domains (if set)
+            if self.config['fqdn']:
+                Occ.config_system_set_trusted_domains(self.config['fqdn'], 1)
+            # Adds the ingress_address to trusted domains
+            Occ.config_system_set_trusted_domains(ingress_addr, 2)
 
     def _on_update_status(self, event):
         """
@@ -346,11 +915,33 @@ class NextcloudCharm(CharmBase):
 
     def set_redis_info(self, info: dict):
         self._stored.redis_info = info
-        utils.config_redis(info, Path(self.charm_dir / 'templates'), 'redis.config.php.j2')
+        self._config_redis()
 
     def _on_redis_available(self, event):
-        utils.config_redis(self._stored.redis_info,
-                           Path(self.charm_dir / 'templates'), 'redis.config.php.j2')
+        self._config_redis()
+
+    def _on_redis_unavailable(self, event):
+        # redis_info is empty, this removes redis.config.php.
+        self._config_redis()
+
+    def _config_redis(self):
+        """
+        Renders redis.config.php from the relation data and the redis-*
+        config options, or removes it when no redis is related.
+        :return: True if it changed.
+        """
+        if not self._stored.redis_info:
+            return utils.config_redis(None, Path(self.charm_dir / 'templates'),
+                                      'redis.config.php.j2')
+        redis_ctx = dict(self._stored.redis_info)
+        redis_ctx.update({
+            'redis_timeout': self.config.get('redis-timeout'),
+            'redis_read_timeout': self.config.get('redis-read-timeout'),
+            'redis_dbindex': self.config.get('redis-dbindex'),
+            'redis_persistent': self.config.get('redis-persistent'),
+        })
+        return utils.config_redis(redis_ctx, Path(self.charm_dir / 'templates'),
+                                  'redis.config.php.j2')
 
     def _on_set_trusted_domain_action(self, event):
         domain = event.params['domain']
@@ -368,14 +959,8 @@ class NextcloudCharm(CharmBase):
         mount_options = event.relation.data[event.unit].get('options')
         fstype = event.relation.data[event.unit].get('fstype')
 
-        try:
-            packages = ['rpcbind', 'nfs-common']
-            cmd = ["sudo", "apt", "install", "-y"]
-            cmd.extend(packages)
-            sp.run(cmd, check=True)
-        except sp.CalledProcessError as e:
-            print(e)
-            sys.exit(-1)
+        # Normally already installed by the install hook.
+        utils.install_packages(utils.NFS_PACKAGES)
 
         local_data_dir = '/var/www/nextcloud/data'
         if not os.path.exists(local_data_dir):
@@ -383,14 +968,25 @@ class NextcloudCharm(CharmBase):
         cmd = "mount -t {} -o {} {}:{} {}".format(fstype, mount_options, remote_host, export_path, local_data_dir)
         sp.run(cmd.split())
 
-        utils.set_directory_permissions()
+        utils.set_directory_permissions(local_data_dir, workers=NFS_PERMISSION_WORKERS)
 
     def _on_ceph_relation_changed(self, event):
         if not self.model.unit.is_leader():
             return
-        ceph_user = event.relation.data[event.app].get('ceph_user')
-        rados_gw_hostname = event.relation.data[event.app].get('rados_gw_hostname')
-        rados_gw_port = event.relation.data[event.app].get('rados_gw_port')
+        self._config_ceph()
+
+    def _config_ceph(self):
+        """
+        Renders ceph.config.php from the ceph relation and the s3-* config
+        options and shares it with the peers.
+        """
+        relation = self.model.get_relation('ceph')
+        if relation is None or relation.app is None:
+            return
+        ceph_data = relation.data[relation.app]
+        ceph_user = ceph_data.get('ceph_user')
+        rados_gw_hostname = ceph_data.get('rados_gw_hostname')
+        rados_gw_port = ceph_data.get('rados_gw_port')
         if ceph_user and rados_gw_hostname and rados_gw_port:
             self.framework.breakpoint('ceph-changed')
             ceph_user = json.loads(ceph_user)
@@ -399,7 +995,12 @@ class NextcloudCharm(CharmBase):
                 'ceph_key': ceph_user['keys'][0]['access_key'],
                 'ceph_secret': ceph_user['keys'][0]['secret_key'],
                 'rados_gw_hostname': rados_gw_hostname,
-                'rados_gw_port': rados_gw_port
+                'rados_gw_port': rados_gw_port,
+                # Buckets created by the ceph side, <bucket> or <bucket>0..<num_buckets - 1>.
+                'bucket': ceph_data.get('bucket_prefix', 'nextcloud'),
+                'num_buckets': int(ceph_data.get('num_buckets', 1)),
+                'upload_part_size': self.config.get('s3-upload-part-size') * 1024 * 1024,
+                'upload_concurrency': self.config.get('s3-upload-concurrency')
             }
             utils.config_ceph(ceph_info, Path(self.charm_dir / 'templates'), 'ceph.config.php.j2')
             self._stored.ceph_configured = True
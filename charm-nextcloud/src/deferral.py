@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""Deferred event bookkeeping."""
+import logging
+
+from ops.charm import RelationEvent
+from ops.framework import Object, StoredState
+
+logger = logging.getLogger(__name__)
+
+
+class DeferralManager(Object):
+    """
+    Keeps at most one deferred event per handler and relation, and
+    remembers why it was deferred.
+
+    The operator framework re-runs every deferred event at the start of
+    each hook. Handlers ask gate() whether they can run:
+    - while an event is deferred, newer events of the same kind on the
+      same relation are dropped instead of piling up, the deferred one
+      covers them (handlers read the relation data when they run).
+    - a re-run deferred event that waits for flags in the charm's
+      _stored is deferred again right away, without checking readiness,
+      until one of those flags changes.
+    - once an event runs, older duplicates still in the queue are dropped.
+    """
+
+    _stored = StoredState()
+
+    def __init__(self, charm, key):
+        super().__init__(charm, key)
+        self._charm = charm
+        # key -> {'handle', 'reason', 'flags'}
+        self._stored.set_default(pending={}, superseded=[])
+
+    @staticmethod
+    def _key(event):
+        if isinstance(event, RelationEvent):
+            return f"{event.handle.kind}:{event.relation.id}"
+        return event.handle.kind
+
+    def _flags(self, watch):
+        return {name: getattr(self._charm._stored, name, None) for name in watch}
+
+    def gate(self, event, reason, ready, watch=()) -> bool:
+        """
+        :param event: the event being handled
+        :param reason: why the event has to wait, for logs and reasons()
+        :param ready: callable, True when the handler can run
+        :param watch: names of charm._stored flags that ready() depends on
+        :return: True if the handler should run now, otherwise the event
+                 has been deferred or dropped.
+        """
+        key = self._key(event)
+        handle = str(event.handle)
+        entry = self._stored.pending.get(key)
+        if handle in self._stored.superseded:
+            # A newer event of the same kind already ran.
+            self._stored.superseded.remove(handle)
+            logger.debug("Dropping superseded %s", handle)
+            return False
+        if entry and entry['handle'] == handle and watch \
+                and dict(entry['flags']) == self._flags(watch):
+            # Nothing this event waits for has changed.
+            event.defer()
+            return False
+        if ready():
+            if entry:
+                del self._stored.pending[key]
+                if entry['handle'] != handle:
+                    self._stored.superseded.append(entry['handle'])
+            return True
+        if entry and entry['handle'] != handle:
+            logger.debug("Coalescing %s into deferred %s", handle, entry['handle'])
+            return False
+        if not entry or entry['reason'] != reason:
+            logger.info("Deferring %s: %s", handle, reason)
+        event.defer()
+        self._stored.pending[key] = {'handle': handle, 'reason': reason,
+                                     'flags': self._flags(watch)}
+        return False
+
+    def reasons(self) -> dict:
+        """
+        :return: deferred event handle -> reason
+        """
+        return {entry['handle']: entry['reason'] for entry in self._stored.pending.values()}
@@ -1,62 +1,129 @@
 #!/usr/bin/env python3
 """RedisRequires."""
+import json
 import logging
 
+from ops.charm import RelationBrokenEvent, RelationDepartedEvent
 from ops.framework import (
     EventBase,
     EventSource,
     Object,
     ObjectEvents,
+    StoredState,
 )
 
+from nextcloud import telemetry
+
 
 logger = logging.getLogger()
 
+# Values of the optional 'role' field that mark a unit as the primary.
+PRIMARY_ROLES = ('master', 'primary')
+
 
 class RedisAvailableEvent(EventBase):
     """RedisAvailableEvent."""
 
 
+class RedisUnavailableEvent(EventBase):
+    """RedisUnavailableEvent, no related unit provides redis anymore."""
+
+
 class RedisEvents(ObjectEvents):
     """Redis events."""
 
     redis_available = EventSource(RedisAvailableEvent)
+    redis_unavailable = EventSource(RedisUnavailableEvent)
+
 
+def _unit_number(unit_name):
+    return int(unit_name.rsplit('/', 1)[-1])
 
+
+def select_topology(units_data) -> dict:
+    """
+    Pick the redis topology from the relation data of all related units.
+    The result only depends on the data, not on which unit changed last.
+    - The primary is the lowest numbered unit publishing role master/primary,
+      or the lowest numbered unit if none does.
+    - Cluster seeds are the union of all published cluster-seeds.
+    :param units_data: dict of unit name -> relation data
+    :return: redis info for the charm, or {} if no unit provides redis yet
+    """
+    candidates = []
+    seeds = set()
+    for name, data in units_data.items():
+        seeds.update(data.get('cluster-seeds', '').split())
+        if (data.get('hostname') and data.get('port')) or data.get('socket'):
+            primary = data.get('role', '').lower() in PRIMARY_ROLES
+            candidates.append((not primary, _unit_number(name), name, data))
+    if not candidates and not seeds:
+        return {}
+    info = {'redis_seeds': sorted(seeds)}
+    if candidates:
+        _, _, name, data = min(candidates)
+        info.update({
+            'redis_unit': name,
+            'redis_password': data.get('password'),
+            'redis_hostname': data.get('hostname'),
+            'redis_port': data.get('port'),
+            'redis_socket': data.get('socket'),
+        })
+    else:
+        # Only cluster seeds, the password comes with them.
+        info['redis_password'] = next((d['password'] for d in units_data.values()
+                                       if d.get('password')), None)
+    return info
+
+
+@telemetry.instrument
 class RedisClient(Object):
     """Redis Client Interface."""
 
     on = RedisEvents()
+    _stored = StoredState()
 
     def __init__(self, charm, relation_name):
         """Observe relation_changed."""
         super().__init__(charm, relation_name)
         self._charm = charm
         self._relation_name = relation_name
-        # Observe the relation-changed hook event and bind
-        # self.on_relation_changed() to handle the event.
-        self.framework.observe(
-            self._charm.on[self._relation_name].relation_changed,
-            self._on_relation_changed
-        )
+        # JSON of the topology last passed to the charm.
+        self._stored.set_default(topology='{}')
+        # Observe the relation hook events and bind them to
+        # self._on_relation_changed(), which looks at all units.
+        for event in (self._charm.on[self._relation_name].relation_changed,
+                      self._charm.on[self._relation_name].relation_departed,
+                      self._charm.on[self._relation_name].relation_broken):
+            self.framework.observe(event, self._on_relation_changed)
+
+    def _units_data(self, event) -> dict:
+        """
+        Relation data of every unit on all relations of this endpoint,
+        leaving out the unit or relation that is going away.
+        """
+        units_data = {}
+        for relation in self.model.relations[self._relation_name]:
+            if isinstance(event, RelationBrokenEvent) and relation.id == event.relation.id:
+                continue
+            for unit in relation.units:
+                if isinstance(event, RelationDepartedEvent) and unit == event.unit:
+                    continue
+                units_data[unit.name] = dict(relation.data[unit])
+        return units_data
 
     def _on_relation_changed(self, event):
-        event_unit_data = event.relation.data.get(event.unit)
-        if not event_unit_data:
-            event.defer()
+        topology = select_topology(self._units_data(event))
+        serialized = json.dumps(topology, sort_keys=True)
+        if serialized == self._stored.topology:
             return
-        password = event_unit_data.get('password')
-        host = event_unit_data.get('hostname')
-        port = event_unit_data.get('port')
-
-        if (host and port):
-            self._charm.set_redis_info({
-                'redis_password': password,
-                'redis_hostname': host,
-                'redis_port': port,
-            })
+        self._stored.topology = serialized
+        if topology:
+            logger.info("Redis topology changed, primary %s, %d cluster seeds",
+                        topology.get('redis_unit'), len(topology['redis_seeds']))
+            self._charm.set_redis_info(topology)
             self.on.redis_available.emit()
         else:
             logger.info("REDIS INFO NOT AVAILABLE")
-            event.defer()
-            return
+            self._charm.set_redis_info({})
+            self.on.redis_unavailable.emit()
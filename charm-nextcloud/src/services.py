@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""Service restart/reload scheduling."""
+import logging
+import sys
+
+from ops.framework import Object
+
+from nextcloud import telemetry
+from nextcloud.telemetry import sp
+
+logger = logging.getLogger(__name__)
+
+RESTART = 'restart'
+RELOAD = 'reload'
+
+
+@telemetry.instrument
+class ServiceScheduler(Object):
+    """
+    Collects restart and reload requests for system services while a hook
+    runs, and performs at most one action per service when the hook
+    commits. A restart request wins over a reload. Reloading apache2 is a
+    graceful restart, which lets in-flight requests finish.
+    """
+
+    def __init__(self, charm, key):
+        super().__init__(charm, key)
+        self._intents = {}
+        self.framework.observe(self.framework.on.pre_commit, self._on_pre_commit)
+
+    def restart(self, service):
+        self._intents[service] = RESTART
+
+    def reload(self, service):
+        self._intents.setdefault(service, RELOAD)
+
+    def pending(self, service):
+        """
+        :return: RESTART, RELOAD or None
+        """
+        return self._intents.get(service)
+
+    def _on_pre_commit(self, event):
+        self.flush()
+
+    def flush(self):
+        """
+        Perform the collected actions now.
+        """
+        intents, self._intents = self._intents, {}
+        for service, action in intents.items():
+            if service == 'apache2' and action == RELOAD:
+                cmd = ['apache2ctl', 'graceful']
+            else:
+                cmd = ['systemctl', action, f"{service}.service"]
+            logger.info("Running %s", ' '.join(cmd))
+            try:
+                sp.check_call(cmd)
+            except sp.CalledProcessError as e:
+                print(e)
+                sys.exit(-1)
@@ -0,0 +1,38 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+TEMPLATES = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'templates')
+
+
+class TestCase(unittest.TestCase):
+    """
+    Base class for the charm tests. Keeps the telemetry log and the jinja2
+    bytecode cache of each test class in a temporary directory instead of
+    /var/log and /var/cache.
+    """
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        from nextcloud import utils
+        super().setUpClass()
+        cls._state_dir = tempfile.TemporaryDirectory()
+        cls._state_patchers = [
+            mock.patch('nextcloud.telemetry.LOG_PATH',
+                       os.path.join(cls._state_dir.name, 'telemetry.jsonl')),
+            mock.patch('nextcloud.utils.TEMPLATE_CACHE_DIR',
+                       os.path.join(cls._state_dir.name, 'jinja2'))]
+        for patcher in cls._state_patchers:
+            patcher.start()
+        # Environments made before the patch point at the real cache dir.
+        utils._jinja_env.cache_clear()
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        from nextcloud import utils
+        for patcher in cls._state_patchers:
+            patcher.stop()
+        utils._jinja_env.cache_clear()
+        cls._state_dir.cleanup()
+        super().tearDownClass()
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+"""
+Stand-in for psql in tests, answering the statements nextcloud.dbmaint
+sends from a JSON description of the database (FAKE_PSQL_DB):
+
+    {"version": 140005,
+     "tables": {"oc_filecache": {"live": 900, "dead": 100, "table_bytes": 8192,
+                                 "index_bytes": 4096, "indexes": {"fs_mtime": [2048, 7]}}},
+     "invalid_indexes": ["fs_mtime_ccnew"],
+     "fail": ["REINDEX"]}
+
+Statements starting with a "fail" prefix fail like a statement timeout.
+Every statement is appended to FAKE_PSQL_LOG as a JSON line with the
+options and password psql got.
+"""
+import json
+import os
+import re
+import sys
+
+
+def main(argv):
+    sql = argv[argv.index('-c') + 1]
+    with open(os.environ['FAKE_PSQL_DB']) as f:
+        db = json.load(f)
+    with open(os.environ['FAKE_PSQL_LOG'], 'a') as f:
+        f.write(json.dumps({'sql': sql, 'user': argv[argv.index('-U') + 1],
+                            'password': os.environ.get('PGPASSWORD'),
+                            'options': os.environ.get('PGOPTIONS')}) + '\n')
+    if any(sql.startswith(prefix) for prefix in db.get('fail', [])):
+        sys.stderr.write("ERROR:  canceling statement due to statement timeout\n")
+        return 1
+    names = re.findall(r"'([a-z0-9_]+)'", sql.split('IN', 1)[-1])
+    rows = []
+    if sql == 'SHOW server_version_num':
+        rows = [[db.get('version', 140005)]]
+    elif 'FROM pg_stat_user_tables' in sql:
+        rows = [[name, t['live'], t['dead'], t['table_bytes'], t['index_bytes'],
+                 t.get('last_vacuum', ''), t.get('last_analyze', '')]
+                for name, t in sorted(db['tables'].items()) if name in names]
+    elif 'FROM pg_stat_user_indexes' in sql:
+        rows = [[name, index, size, scans]
+                for name, t in sorted(db['tables'].items()) if name in names
+                for index, (size, scans) in sorted(t.get('indexes', {}).items())]
+    elif 'NOT i.indisvalid' in sql:
+        rows = [[index] for index in db.get('invalid_indexes', [])]
+    for row in rows:
+        print('\t'.join(str(v) for v in row))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,51 @@
+import hashlib
+import os
+import tempfile
+import unittest
+
+from nextcloud.cache import TarballCache, ChecksumError
+
+
+class TestTarballCache(unittest.TestCase):
+    """
+    Unittests for the content addressed tarball cache
+    """
+
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cache = TarballCache(self.tmpdir.name, max_bytes=250)
+
+    def tearDown(self) -> None:
+        self.tmpdir.cleanup()
+
+    def _add(self, url, data, sha256=None):
+        with self.cache.writer(url, sha256) as f:
+            f.write(data)
+        return hashlib.sha256(data).hexdigest()
+
+    def test_lookup_by_url_and_sha256(self) -> None:
+        digest = self._add('http://example.com/nc.tar.bz2', b'a' * 100)
+        self.assertEqual(self.cache.lookup('http://example.com/nc.tar.bz2').name, digest)
+        self.assertEqual(self.cache.lookup(sha256=digest).read_bytes(), b'a' * 100)
+        self.assertIsNone(self.cache.lookup('http://example.com/other.tar.bz2'))
+
+    def test_checksum_mismatch_is_not_cached(self) -> None:
+        with self.assertRaises(ChecksumError):
+            self._add('http://example.com/nc.tar.bz2', b'evil', sha256='0' * 64)
+        self.assertIsNone(self.cache.lookup('http://example.com/nc.tar.bz2'))
+        self.assertEqual(os.listdir(self.cache.blobs), [])
+
+    def test_evicts_least_recently_used(self) -> None:
+        first = self._add('http://example.com/1', b'1' * 100)
+        second = self._add('http://example.com/2', b'2' * 100)
+        os.utime(self.cache.path(first), (1, 1))
+        os.utime(self.cache.path(second), (2, 2))
+        self.cache.lookup('http://example.com/1')
+        self._add('http://example.com/3', b'3' * 100)
+        self.assertIsNotNone(self.cache.lookup('http://example.com/1'))
+        self.assertIsNone(self.cache.lookup('http://example.com/2'))
+        self.assertIsNotNone(self.cache.lookup('http://example.com/3'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+import os
+import tempfile
+import unittest
+
+from nextcloud import config_php
+
+CONFIG_PHP = """<?php
+$CONFIG = array (
+  'instanceid' => 'oc1x2y3z',
+  'passwordsalt' => 'it\\'s \\\\salty',
+  'trusted_domains' =>
+  array (
+    0 => 'localhost',
+    2 => '10.0.0.1',
+  ),
+  'datadirectory' => '/var/www/nextcloud/data',
+  'dbport' => '',
+  'installed' => true,
+  'maintenance' => false,
+  'memcache.local' => "\\\\OC\\\\Memcache\\\\APCu",
+  'loglevel' => 2,
+  'redis' => [ 'host' => 'localhost', 'port' => 6379, ], // short syntax
+);
+"""
+
+
+class TestConfigPhp(unittest.TestCase):
+    """
+    Unittests for reading and writing config.php without occ
+    """
+
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'config.php')
+        with open(self.path, 'w') as f:
+            f.write(CONFIG_PHP)
+
+    def tearDown(self) -> None:
+        self.tmpdir.cleanup()
+
+    def test_loads(self) -> None:
+        config = config_php.loads(CONFIG_PHP)
+        self.assertEqual(config['passwordsalt'], "it's \\salty")
+        self.assertEqual(config['trusted_domains'], {0: 'localhost', 2: '10.0.0.1'})
+        self.assertIs(config['installed'], True)
+        self.assertEqual(config['memcache.local'], '\\OC\\Memcache\\APCu')
+        self.assertEqual(config['redis'], {'host': 'localhost', 'port': 6379})
+
+    def test_dumps_roundtrip(self) -> None:
+        config = config_php.loads(CONFIG_PHP)
+        text = config_php.dumps(config)
+        self.assertIn("  'trusted_domains' => \n  array (\n    0 => 'localhost',\n", text)
+        self.assertEqual(config_php.loads(text), config)
+
+    def test_set_trusted_domains(self) -> None:
+        config_php.set_trusted_domains(['localhost', 'example.com', '10.0.0.2'], self.path)
+        self.assertEqual(config_php.get_trusted_domains(self.path),
+                         ['localhost', 'example.com', '10.0.0.2'])
+        self.assertEqual(config_php.read_config(self.path)['instanceid'], 'oc1x2y3z')
+        self.assertEqual(os.listdir(self.tmpdir.name), ['config.php'])
+        self.assertFalse(config_php.set_trusted_domains(['localhost', 'example.com', '10.0.0.2'],
+                                                        self.path))
+
+
+if __name__ == '__main__':
+    unittest.main()
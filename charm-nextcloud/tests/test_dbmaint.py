@@ -0,0 +1,118 @@
+import json
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+from nextcloud import config_php, dbmaint
+from tests import TestCase
+
+FAKE_PSQL = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_psql.py')
+
+
+class TestDbMaint(TestCase):
+    """
+    Unittests for database maintenance, against the psql stand-in
+    """
+
+    def setUp(self) -> None:
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.db_path = os.path.join(tmpdir.name, 'db.json')
+        self.log_path = os.path.join(tmpdir.name, 'psql.log')
+        self.config_path = os.path.join(tmpdir.name, 'config.php')
+        config_php.write_config({'dbtype': 'pgsql', 'dbhost': '10.0.0.7:5433',
+                                 'dbname': 'nextcloud', 'dbuser': 'nc', 'dbpassword': 's3cret',
+                                 'dbtableprefix': 'oc_'},
+                                self.config_path)
+        self.set_db({'tables': {
+            'oc_filecache': {'live': 800, 'dead': 200, 'table_bytes': 81920, 'index_bytes': 40960,
+                             'indexes': {'fs_mtime': [20480, 7], 'fs_size': [20480, 0]}},
+            'oc_activity': {'live': 990, 'dead': 10, 'table_bytes': 8192, 'index_bytes': 4096},
+            'oc_authtoken': {'live': 0, 'dead': 0, 'table_bytes': 0, 'index_bytes': 0}}})
+        for target, value in [('nextcloud.dbmaint.PSQL', [sys.executable, FAKE_PSQL]),
+                              ('os.environ', dict(os.environ, FAKE_PSQL_DB=self.db_path,
+                                                  FAKE_PSQL_LOG=self.log_path))]:
+            patcher = mock.patch(target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.db = dbmaint.Database.from_config(self.config_path)
+
+    def set_db(self, db):
+        with open(self.db_path, 'w') as f:
+            json.dump(db, f)
+
+    def update_db(self, **fields):
+        with open(self.db_path) as f:
+            db = json.load(f)
+        self.set_db(dict(db, **fields))
+
+    def statements(self):
+        with open(self.log_path) as f:
+            return [json.loads(line) for line in f]
+
+    def test_bloat_report(self) -> None:
+        self.assertEqual((self.db.host, self.db.port, self.db.tables()),
+                         ('10.0.0.7', '5433', ['oc_filecache', 'oc_activity', 'oc_authtoken']))
+        report = dbmaint.bloat_report(self.db)
+        self.assertEqual(report['oc_filecache']['dead_ratio'], 0.2)
+        self.assertEqual(report['oc_authtoken']['dead_ratio'], 0.0)
+        self.assertEqual(report['oc_filecache']['indexes']['fs_size'],
+                         {'bytes': 20480, 'scans': 0})
+        self.assertEqual({s['password'] for s in self.statements()}, {'s3cret'})
+        with self.assertRaises(ValueError):
+            dbmaint.bloat_report(self.db, ["oc_filecache'; DROP TABLE oc_users; --"])
+
+    def test_maintain_vacuums_bloated_tables(self) -> None:
+        done = dbmaint.maintain(self.db, threshold=0.1, reindex=True, minutes=60)
+        self.assertEqual(done, [('oc_filecache', 'vacuum', 'done'),
+                                ('oc_filecache', 'reindex', 'done'),
+                                ('oc_activity', 'vacuum', 'skipped'),
+                                ('oc_authtoken', 'vacuum', 'skipped')])
+        vacuum = [s for s in self.statements() if s['sql'].startswith('VACUUM')]
+        self.assertEqual([s['sql'] for s in vacuum], ['VACUUM (ANALYZE) oc_filecache'])
+        # The statement is cancelled when the window closes.
+        self.assertRegex(vacuum[0]['options'], r'^-c statement_timeout=3[56]\d{5}$')
+
+    def test_cancelled_reindex_drops_invalid_indexes(self) -> None:
+        self.update_db(fail=['REINDEX'], invalid_indexes=['fs_mtime_ccnew'])
+        done = dbmaint.maintain(self.db, ['oc_filecache'], reindex=True)
+        self.assertEqual(done[1][:2], ('oc_filecache', 'reindex'))
+        self.assertTrue(done[1][2].startswith('failed: ERROR:  canceling statement'))
+        self.assertEqual(self.statements()[-1]['sql'],
+                         'DROP INDEX CONCURRENTLY IF EXISTS "fs_mtime_ccnew"')
+
+    def test_no_reindex_before_postgresql_12(self) -> None:
+        self.update_db(version=110012)
+        done = dbmaint.maintain(self.db, reindex=True)
+        self.assertNotIn('reindex', [action for _, action, _ in done])
+
+    def test_short_timeout_is_not_unlimited(self) -> None:
+        self.db.query('SELECT 1', timeout=0.0004)
+        self.assertEqual(self.statements()[-1]['options'], '-c statement_timeout=1')
+
+    def test_split_dbhost(self) -> None:
+        self.assertEqual((self.db.host, self.db.port), ('10.0.0.7', '5433'))
+        for dbhost, expected in [('db.example.com', ('db.example.com', None)),
+                                 ('db.example.com:5433', ('db.example.com', '5433')),
+                                 ('[fd00::7]:5433', ('fd00::7', '5433')),
+                                 ('[fd00::7]', ('fd00::7', None)),
+                                 ('fd00::7', ('fd00::7', None)),
+                                 ('localhost:/var/run/postgresql', ('/var/run/postgresql', None)),
+                                 ('/var/run/postgresql', ('/var/run/postgresql', None)),
+                                 ('/var/run/postgresql/.s.PGSQL.5433',
+                                  ('/var/run/postgresql', '5433'))]:
+            self.assertEqual(dbmaint.split_dbhost(dbhost), expected, dbhost)
+
+    def test_parse_window(self) -> None:
+        self.assertEqual(dbmaint.parse_window('2:00-04:30'), ('02:00', 150))
+        self.assertEqual(dbmaint.parse_window('23:00-01:00'), ('23:00', 120))
+        self.assertIsNone(dbmaint.parse_window(''))
+        for text in ['02:00', '25:00-01:00', '03:00-03:00']:
+            with self.assertRaises(ValueError):
+                dbmaint.parse_window(text)
+
+
+if __name__ == '__main__':
+    unittest.main()
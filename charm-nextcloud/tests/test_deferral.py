@@ -0,0 +1,65 @@
+import unittest
+from unittest import mock
+
+from ops.charm import StartEvent
+from ops.framework import Handle
+from ops.testing import Harness
+from charm import NextcloudCharm
+from tests import TestCase
+
+
+class TestDeferralManager(TestCase):
+    """
+    Unittests for coalescing deferred events
+    """
+
+    def setUp(self) -> None:
+        self.harness = Harness(NextcloudCharm)
+        self.addCleanup(self.harness.cleanup)
+        self.harness.begin()
+        self.deferrals = self.harness.charm.deferrals
+
+    def _start_event(self, key):
+        return StartEvent(Handle(self.harness.charm.on, 'start', key))
+
+    def test_duplicates_are_coalesced(self) -> None:
+        first, second = self._start_event('1'), self._start_event('2')
+        ready = mock.Mock(return_value=False)
+        self.assertFalse(self.deferrals.gate(first, "waiting", ready))
+        self.assertTrue(first.deferred)
+        self.assertFalse(self.deferrals.gate(second, "waiting", ready))
+        self.assertFalse(second.deferred)
+        self.assertEqual(self.deferrals.reasons(), {str(first.handle): "waiting"})
+
+    def test_waits_for_watched_flags(self) -> None:
+        event = self._start_event('1')
+        ready = mock.Mock(return_value=False)
+        self.deferrals.gate(event, "waiting", ready, watch=['nextcloud_initialized'])
+        # Re-run with nothing changed: deferred without checking readiness.
+        self.assertFalse(self.deferrals.gate(event, "waiting", ready,
+                                             watch=['nextcloud_initialized']))
+        self.assertEqual(ready.call_count, 1)
+        self.harness.charm._stored.nextcloud_initialized = True
+        ready.return_value = True
+        self.assertTrue(self.deferrals.gate(event, "waiting", ready,
+                                            watch=['nextcloud_initialized']))
+        self.assertEqual(self.deferrals.reasons(), {})
+
+    def test_superseded_events_are_dropped(self) -> None:
+        first, second = self._start_event('1'), self._start_event('2')
+        self.deferrals.gate(first, "waiting", lambda: False)
+        self.assertTrue(self.deferrals.gate(second, "waiting", lambda: True))
+        self.assertFalse(self.deferrals.gate(first, "waiting", lambda: True))
+
+    @mock.patch('charm.utils.open_port')
+    def test_start_runs_once_after_install(self, open_port) -> None:
+        for _ in range(5):
+            self.harness.charm.on.start.emit()
+        self.harness.charm._stored.nextcloud_initialized = True
+        with mock.patch.object(self.harness.charm, '_on_update_status'):
+            self.harness.framework.reemit()
+        open_port.assert_called_once_with('80')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+import unittest
+from unittest import mock
+
+from ops.testing import Harness
+from charm import NextcloudCharm
+from interface_redis import select_topology
+from tests import TestCase
+
+
+class TestRedisTopology(TestCase):
+    """
+    Unittests for picking the redis topology from all related units
+    """
+
+    def test_primary_is_deterministic(self) -> None:
+        units = {
+            'redis/10': {'hostname': '10.0.0.10', 'port': '6379'},
+            'redis/2': {'hostname': '10.0.0.2', 'port': '6379', 'password': 'pw'},
+            'redis/3': {},
+        }
+        self.assertEqual(select_topology(units)['redis_unit'], 'redis/2')
+        units['redis/10']['role'] = 'master'
+        topology = select_topology(units)
+        self.assertEqual((topology['redis_unit'], topology['redis_hostname']),
+                         ('redis/10', '10.0.0.10'))
+
+    def test_cluster_seeds_are_merged(self) -> None:
+        units = {
+            'redis/0': {'cluster-seeds': '10.0.0.1:6379 10.0.0.2:6379', 'password': 'pw'},
+            'redis/1': {'cluster-seeds': '10.0.0.2:6379 10.0.0.3:6379'},
+        }
+        self.assertEqual(select_topology(units), {
+            'redis_seeds': ['10.0.0.1:6379', '10.0.0.2:6379', '10.0.0.3:6379'],
+            'redis_password': 'pw'})
+        self.assertEqual(select_topology({'redis/0': {}}), {})
+
+
+class TestRedisClient(TestCase):
+    """
+    Unittests for re-rendering redis config only on topology changes
+    """
+
+    def setUp(self) -> None:
+        self.harness = Harness(NextcloudCharm)
+        self.addCleanup(self.harness.cleanup)
+        self.harness.begin()
+        patcher = mock.patch('charm.utils.config_redis')
+        self.config_redis = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_renders_on_topology_change_only(self) -> None:
+        rel_id = self.harness.add_relation('redis', 'redis')
+        self.harness.add_relation_unit(rel_id, 'redis/0')
+        self.harness.add_relation_unit(rel_id, 'redis/1')
+        self.harness.update_relation_data(rel_id, 'redis/1',
+                                          {'hostname': '10.0.0.2', 'port': '6379'})
+        self.assertEqual(self.harness.charm._stored.redis_info['redis_unit'], 'redis/1')
+        self.harness.update_relation_data(rel_id, 'redis/0',
+                                          {'hostname': '10.0.0.1', 'port': '6379'})
+        self.assertEqual(self.harness.charm._stored.redis_info['redis_unit'], 'redis/0')
+        calls = self.config_redis.call_count
+        # A change that does not affect the topology.
+        self.harness.update_relation_data(rel_id, 'redis/1', {'ingress-address': '10.0.0.2'})
+        self.assertEqual(self.config_redis.call_count, calls)
+        # Failover to the remaining unit.
+        self.harness.remove_relation_unit(rel_id, 'redis/0')
+        self.assertEqual(self.harness.charm._stored.redis_info['redis_hostname'], '10.0.0.2')
+        self.harness.remove_relation(rel_id)
+        self.assertEqual(dict(self.harness.charm._stored.redis_info), {})
+        self.assertIsNone(self.config_redis.call_args[0][0])
+
+
+if __name__ == '__main__':
+    unittest.main()
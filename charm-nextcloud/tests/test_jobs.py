@@ -0,0 +1,110 @@
+import os
+import signal
+import sys
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from nextcloud import jobs
+
+
+class TestJobs(unittest.TestCase):
+    """
+    Unittests for occ background jobs
+    """
+
+    def setUp(self) -> None:
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        for target, value in [('nextcloud.jobs.JOBS_DIR', tmpdir.name),
+                              ('nextcloud.jobs.NEXTCLOUD_ROOT', tmpdir.name),
+                              # "occ" prints its arguments, or sleeps with a sleep argument.
+                              ('nextcloud.jobs.OCC_CMD', [
+                                  sys.executable, '-c',
+                                  'import sys, time; print(sys.argv[1:]); '
+                                  'time.sleep(30 if "sleep" in sys.argv else 0); '
+                                  'sys.exit("fail" in sys.argv)'])]:
+            patcher = mock.patch(target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch('nextcloud.jobs.Occ.maintenance_mode')
+        self.maintenance_mode = patcher.start()
+        self.maintenance_mode.return_value = mock.Mock(returncode=0, stdout='')
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch('nextcloud.jobs.sp.check_call')
+        self.check_call = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _start(self, *commands, maintenance=False):
+        job_id = jobs.start('convert', [jobs.occ(*args) for args in commands],
+                            maintenance=maintenance)
+        cmd = self.check_call.call_args[0][0]
+        self.assertEqual(cmd[:3], ['systemd-run', '--unit', jobs.unit_name(job_id)])
+        self.assertEqual(cmd[-3:], ['-m', 'nextcloud.jobs', job_id])
+        return job_id
+
+    @mock.patch('nextcloud.jobs._unit_active', return_value=True)
+    def test_run_writes_log_and_state(self, _unit_active) -> None:
+        job_id = self._start(['db:add-missing-indices'], ['db:add-missing-columns'],
+                             maintenance=True)
+        with self.assertRaises(jobs.JobError):
+            jobs.start('convert', [jobs.occ('db:add-missing-indices')])
+        self.assertEqual(jobs.run(job_id), 0)
+        state = jobs.status(job_id)
+        self.assertEqual((state['status'], state['returncode']), (jobs.SUCCEEDED, 0))
+        self.assertEqual(state['log_tail'].splitlines()[1::2],
+                         ["['db:add-missing-indices']", "['db:add-missing-columns']"])
+        self.assertEqual(self.maintenance_mode.call_args_list,
+                         [mock.call(enable=True), mock.call(enable=False)])
+
+    def test_maintenance_ends_when_occ_fails(self) -> None:
+        job_id = self._start(['fail'], ['db:add-missing-columns'], maintenance=True)
+        self.assertEqual(jobs.run(job_id), 1)
+        self.assertNotIn('add-missing-columns', jobs.status(job_id)['log_tail'])
+        self.assertEqual(jobs.status(job_id)['status'], jobs.FAILED)
+        self.assertEqual(self.maintenance_mode.call_args, mock.call(enable=False))
+
+    def test_no_commands_without_maintenance_mode(self) -> None:
+        self.maintenance_mode.return_value = mock.Mock(returncode=1, stdout='Database is locked')
+        job_id = self._start(['db:add-missing-indices'], maintenance=True)
+        self.assertIsNone(jobs.run(job_id))
+        state = jobs.status(job_id)
+        self.assertEqual(state['status'], jobs.FAILED)
+        self.assertNotIn('add-missing-indices', state['log_tail'])
+        self.assertIn('Database is locked', state['log_tail'])
+        self.assertEqual(self.maintenance_mode.call_args_list, [mock.call(enable=True)])
+
+    @mock.patch('nextcloud.jobs.time.strftime', return_value='20261018120000')
+    def test_jobs_started_in_the_same_second(self, _strftime) -> None:
+        first = jobs.start('add-missing-indices', [jobs.occ('db:add-missing-indices')])
+        second = jobs.start('add-missing-columns', [jobs.occ('db:add-missing-columns')])
+        self.assertNotEqual(first, second)
+        self.assertEqual(jobs.read_state(first)['name'], 'add-missing-indices')
+        with mock.patch('nextcloud.jobs.secrets.token_hex', return_value=first.rsplit('-', 1)[1]):
+            with self.assertRaises(jobs.JobError):
+                jobs.start('add-missing-indices', [jobs.occ('db:add-missing-indices')])
+
+    def test_cancel_terminates_occ(self) -> None:
+        job_id = self._start(['sleep'], maintenance=True)
+        # What systemctl stop does to the runner.
+        timer = threading.Timer(0.5, os.kill, (os.getpid(), signal.SIGTERM))
+        timer.start()
+        self.addCleanup(timer.cancel)
+        self.assertEqual(jobs.run(job_id), -signal.SIGTERM)
+        state = jobs.read_state(job_id)
+        self.assertEqual(state['status'], jobs.CANCELLED)
+        self.assertEqual(self.maintenance_mode.call_args, mock.call(enable=False))
+        self.assertIs(signal.getsignal(signal.SIGTERM), signal.SIG_DFL)
+
+    @mock.patch('nextcloud.jobs._unit_active', return_value=False)
+    def test_dead_runner_is_lost(self, _unit_active) -> None:
+        job_id = self._start(['db:add-missing-indices'])
+        self.assertEqual(jobs.status(job_id)['status'], jobs.LOST)
+        self.assertEqual([job['id'] for job in jobs.list_jobs()], [job_id])
+        with self.assertRaises(jobs.JobError):
+            jobs.status('no-such-job')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+import json
+import subprocess as sp
+import unittest
+from unittest import mock
+
+from nextcloud import config_php
+from nextcloud.occ import Occ, OCC_CMD
+from tests import TestCase
+
+
+def _completed(cmd, stdout=''):
+    return sp.CompletedProcess(cmd, 0, stdout=stdout)
+
+
+class TestOccBatch(TestCase):
+    """
+    Unittests for batching occ commands into one php bootstrap
+    """
+
+    @mock.patch('nextcloud.occ.sp.run')
+    def test_batch_bootstraps_once(self, run) -> None:
+        def fake_run(cmd, **kwargs):
+            if 'config:system:get' in cmd:
+                return _completed(cmd, 'localhost\n')
+            if 'input' not in kwargs:
+                return _completed(cmd)
+            results = [{'returncode': 0, 'stdout': ''}] * len(json.loads(kwargs['input']))
+            return _completed(cmd, ''.join(json.dumps(r) + '\n' for r in results))
+        run.side_effect = fake_run
+
+        with Occ.batch():
+            Occ.config_system_delete_trusted_domains()
+            Occ.config_system_set_trusted_domains('localhost', 0)
+            Occ.config_system_set_trusted_domains('example.com', 1)
+            # Needs output: flushes the queue before running.
+            self.assertEqual(Occ.config_system_get_trusted_domains(), ['localhost'])
+            Occ.config_system_set_trusted_domains('10.0.0.1', 2)
+
+        self.assertEqual(run.call_count, 3)
+        batch = json.loads(run.call_args_list[0][1]['input'])
+        self.assertEqual(batch, [
+            ['config:system:delete', 'trusted_domains'],
+            ['config:system:set', 'trusted_domains', '0', '--value=localhost'],
+            ['config:system:set', 'trusted_domains', '1', '--value=example.com'],
+        ])
+        # A single queued command is run directly.
+        self.assertEqual(run.call_args[0][0],
+                         OCC_CMD + ['config:system:set', 'trusted_domains', '2',
+                                    '--value=10.0.0.1'])
+
+    @mock.patch('nextcloud.occ.sp.run')
+    def test_batch_falls_back_to_single_commands(self, run) -> None:
+        run.side_effect = lambda cmd, **kwargs: sp.CompletedProcess(cmd, 255, stdout='PHP Fatal')
+
+        with Occ.batch():
+            Occ.config_system_delete_trusted_domains()
+            Occ.config_system_set_trusted_domains('localhost', 0)
+
+        self.assertEqual(run.call_count, 3)
+        self.assertEqual(run.call_args[0][0],
+                         OCC_CMD + ['config:system:set', 'trusted_domains', '0',
+                                    '--value=localhost'])
+
+    @mock.patch('nextcloud.occ.sp.run')
+    def test_batch_reruns_only_unfinished_commands(self, run) -> None:
+        def fake_run(cmd, **kwargs):
+            if 'input' not in kwargs:
+                return _completed(cmd)
+            stdout = json.dumps({'returncode': 0, 'stdout': ''}) + '\nPHP Fatal error: ...\n'
+            return sp.CompletedProcess(cmd, 255, stdout=stdout)
+        run.side_effect = fake_run
+
+        with Occ.batch():
+            Occ.config_system_delete_trusted_domains()
+            Occ.config_system_set_trusted_domains('localhost', 0)
+            Occ.config_system_set_trusted_domains('example.com', 1)
+
+        # The delete already ran in the batch, it is not run again.
+        self.assertEqual([c[0][0][len(OCC_CMD):] for c in run.call_args_list[1:]], [
+            ['config:system:set', 'trusted_domains', '0', '--value=localhost'],
+            ['config:system:set', 'trusted_domains', '1', '--value=example.com'],
+        ])
+
+
+class TestOccTrustedDomains(TestCase):
+
+    @mock.patch('nextcloud.occ.sp.run')
+    def test_unparsable_config_php_falls_back_to_occ(self, run) -> None:
+        run.side_effect = lambda cmd, **kwargs: _completed(
+            cmd, 'localhost\nexample.com\n10.0.0.1\n')
+        error = config_php.ConfigPhpError("Unsupported value 'getenv(...)'")
+        with mock.patch('nextcloud.occ.config_php.get_trusted_domains', side_effect=error), \
+                mock.patch('nextcloud.occ.config_php.set_trusted_domains', side_effect=error):
+            Occ.update_trusted_domains_peer_ips(['10.0.0.2'])
+        self.assertEqual([c[0][0][len(OCC_CMD):] for c in run.call_args_list], [
+            ['config:system:get', 'trusted_domains'],
+            ['config:system:delete', 'trusted_domains'],
+            ['config:system:set', 'trusted_domains', '0', '--value=localhost'],
+            ['config:system:set', 'trusted_domains', '1', '--value=example.com'],
+            ['config:system:set', 'trusted_domains', '2', '--value=10.0.0.2'],
+        ])
+
+
+if __name__ == '__main__':
+    unittest.main()
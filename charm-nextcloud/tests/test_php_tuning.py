@@ -0,0 +1,80 @@
+import os
+import tempfile
+import unittest
+
+from nextcloud import php_tuning
+
+GB = 1024 * 1024 * 1024
+
+
+class TestPhpTuning(unittest.TestCase):
+    """
+    Unittests for sizing the php caches from host resources
+    """
+
+    def test_small_host_keeps_defaults(self):
+        settings = php_tuning.tune(2 * GB, 3000)
+        self.assertEqual(settings['opcache.memory_consumption'], 128)
+        self.assertEqual(settings['opcache.max_accelerated_files'], 16229)
+        self.assertEqual(settings['apc.shm_size'], '32M')
+        self.assertEqual(settings['opcache.validate_timestamps'], 1)
+        self.assertNotIn('opcache.jit', settings)
+
+    def test_large_host_fits_code_base(self):
+        settings = php_tuning.tune(32 * GB, 20000)
+        # 40000 files with headroom, rounded up to the opcache prime.
+        self.assertEqual(settings['opcache.max_accelerated_files'], 65407)
+        self.assertEqual(settings['opcache.memory_consumption'], 625)
+        self.assertEqual(settings['opcache.interned_strings_buffer'], 64)
+        self.assertEqual(settings['apc.shm_size'], '512M')
+        self.assertEqual(settings['realpath_cache_size'], '5000K')
+
+    def test_accelerated_files_capped_at_php_maximum(self):
+        settings = php_tuning.tune(32 * GB, 600000)
+        self.assertEqual(settings['opcache.max_accelerated_files'], 1000000)
+
+    def test_production_and_jit(self):
+        settings = php_tuning.tune(32 * GB, 20000, php_version='8.0', production=True)
+        self.assertEqual(settings['opcache.validate_timestamps'], 0)
+        self.assertEqual(settings['opcache.jit_buffer_size'], '128M')
+
+    def test_parse_overrides(self):
+        overrides = php_tuning.parse_overrides(
+            "; comment\n\nopcache.memory_consumption = 512\napc.ttl=0\n")
+        self.assertEqual(overrides, {'opcache.memory_consumption': '512', 'apc.ttl': '0'})
+        with self.assertRaises(ValueError):
+            php_tuning.parse_overrides("opcache.memory_consumption 512")
+
+    def test_count_php_files_skips_data(self):
+        with tempfile.TemporaryDirectory() as root:
+            for rel in ['index.php', 'lib/base.php', 'lib/README', 'apps/a/appinfo/app.php',
+                        'data/user/files/x.php']:
+                path = os.path.join(root, rel)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                open(path, 'w').close()
+            self.assertEqual(php_tuning.count_php_files(root), 3)
+
+    def test_parse_size(self):
+        self.assertEqual(php_tuning.parse_size('512M'), 512 * 1024 * 1024)
+        self.assertEqual(php_tuning.parse_size('1g'), GB)
+        self.assertEqual(php_tuning.parse_size('-1'), -1)
+        with self.assertRaises(ValueError):
+            php_tuning.parse_size('lots')
+
+    def test_fpm_pool_fits_memory(self):
+        settings = php_tuning.tune(32 * GB, 20000)
+        pool = php_tuning.fpm_pool(32 * GB, 8, '1G', settings=settings)
+        self.assertEqual(pool['pm'], 'dynamic')
+        # Children budgeted at 256M in what is left after caches and the reserve.
+        self.assertEqual(pool['pm.max_children'], 91)
+        self.assertEqual((pool['pm.min_spare_servers'], pool['pm.max_spare_servers'],
+                          pool['pm.start_servers']), (8, 32, 20))
+
+    def test_fpm_pool_small_host(self):
+        pool = php_tuning.fpm_pool(1 * GB, 1, '512M')
+        self.assertEqual(pool['pm'], 'ondemand')
+        self.assertEqual(pool['pm.max_children'], 4)
+        pool = php_tuning.fpm_pool(1 * GB, 1, '512M', pm='static', max_requests=100)
+        self.assertEqual(pool, {'pm': 'static', 'pm.max_children': 4, 'pm.max_requests': 100})
+        with self.assertRaises(ValueError):
+            php_tuning.fpm_pool(1 * GB, 1, '512M', pm='fast')
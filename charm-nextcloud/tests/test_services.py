@@ -0,0 +1,38 @@
+import unittest
+from unittest import mock
+
+from ops.testing import Harness
+from charm import NextcloudCharm
+from tests import TestCase
+
+
+class TestServiceScheduler(TestCase):
+    """
+    Unittests for coalescing service actions at the end of a hook
+    """
+
+    def setUp(self) -> None:
+        self.harness = Harness(NextcloudCharm)
+        self.addCleanup(self.harness.cleanup)
+        self.harness.begin()
+        self.services = self.harness.charm.services
+
+    @mock.patch('services.sp.check_call')
+    def test_restart_wins_over_reload(self, check_call) -> None:
+        self.services.reload('apache2')
+        self.services.restart('apache2')
+        self.services.reload('apache2')
+        self.harness.framework.commit()
+        check_call.assert_called_once_with(['systemctl', 'restart', 'apache2.service'])
+
+    @mock.patch('services.sp.check_call')
+    def test_apache_reload_is_graceful(self, check_call) -> None:
+        self.services.reload('apache2')
+        self.services.reload('apache2')
+        self.harness.framework.commit()
+        self.harness.framework.commit()
+        check_call.assert_called_once_with(['apache2ctl', 'graceful'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+from nextcloud import telemetry
+
+
+class TestTelemetry(unittest.TestCase):
+    """
+    Unittests for hook and subprocess timing telemetry
+    """
+
+    def setUp(self) -> None:
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.log_path = os.path.join(tmpdir.name, 'telemetry.jsonl')
+        patcher = mock.patch('nextcloud.telemetry.LOG_PATH', self.log_path)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_subprocess_is_recorded(self) -> None:
+        result = telemetry.sp.run([sys.executable, '-c', 'print("hello")'],
+                                  stdout=telemetry.sp.PIPE)
+        self.assertEqual(result.stdout, b'hello\n')
+        with self.assertRaises(telemetry.sp.CalledProcessError):
+            telemetry.sp.check_call([sys.executable, '-c', 'exit(3)'])
+        records = telemetry.read_log(self.log_path)
+        self.assertEqual([(r['kind'], r['returncode']) for r in records],
+                         [('subprocess', 0), ('subprocess', 3)])
+        self.assertEqual(records[0]['output_bytes'], 6)
+        self.assertEqual(records[1]['error'], 'CalledProcessError')
+
+    def test_command_name(self) -> None:
+        self.assertEqual(telemetry._command_name(
+            ['sudo', '-u', 'www-data', '/usr/bin/php', 'occ', 'status']), 'php occ')
+        self.assertEqual(telemetry._command_name('apt install -y apache2'), 'apt install')
+
+    def test_instrumented_handlers(self) -> None:
+        @telemetry.instrument
+        class Charm:
+            def _on_start(self, event):
+                """Start."""
+                return 'started'
+
+            def helper(self):
+                pass
+
+        self.assertEqual(Charm()._on_start(mock.Mock(deferred=True)), 'started')
+        self.assertEqual(Charm._on_start.__doc__, "Start.")
+        Charm().helper()
+        records = telemetry.read_log(self.log_path)
+        self.assertEqual(len(records), 1)
+        self.assertEqual((records[0]['name'], records[0]['deferred']), ('Charm._on_start', True))
+
+    def test_stats_and_rotation(self) -> None:
+        with mock.patch('nextcloud.telemetry.MAX_LOG_BYTES', 500):
+            for i in range(1, 21):
+                telemetry.record(telemetry.HANDLER, 'NextcloudCharm._on_install', i)
+                telemetry.record(telemetry.OCC, 'status', 0.5)
+        self.assertTrue(os.path.exists(self.log_path + '.1'))
+        records = telemetry.read_log(self.log_path)
+        self.assertLess(len(records), 40)
+        records = [{'kind': 'handler', 'name': 'install', 'duration': i} for i in range(1, 21)]
+        records.append({'kind': 'occ', 'name': 'status', 'duration': 1})
+        summary = telemetry.stats(records)
+        self.assertEqual(list(summary), ['handler:install', 'occ:status'])
+        self.assertEqual(summary['handler:install'],
+                         {'count': 20, 'p50': 10, 'p95': 19, 'max': 20, 'total': 210})
+        self.assertEqual(list(telemetry.stats(records, kind='occ')), ['occ:status'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,29 +1,43 @@
+import hashlib
+import io
 import os
-from nextcloud import utils
+import pwd
+import shutil
+import tarfile
+import tempfile
+from nextcloud import config_php, utils
+from nextcloud.cache import TarballCache
 import unittest
+from unittest import mock
 import threading
 from http.server import SimpleHTTPRequestHandler, HTTPServer
+from tests import TEMPLATES, TestCase
 
 
-class TestUtils(unittest.TestCase):
+class TestUtils(TestCase):
     """
     Unittests for utils functions
     """
 
-    def setUp(self) -> None:
+    @classmethod
+    def setUpClass(cls) -> None:
         """
         Launch a local webserver to serve a fake nextcloud.tar.bz2 file
         :return:
         """
-        os.chdir('tests')
+        super().setUpClass()
+        os.chdir(os.path.dirname(os.path.abspath(__file__)))
         handler = SimpleHTTPRequestHandler
-        httpd = HTTPServer(("", 8081), handler)
-        self.httpd_thread = threading.Thread(target=httpd.serve_forever)
-        self.httpd_thread.daemon = True
-        self.httpd_thread.start()
+        cls.httpd = HTTPServer(("", 8081), handler)
+        cls.httpd_thread = threading.Thread(target=cls.httpd.serve_forever)
+        cls.httpd_thread.daemon = True
+        cls.httpd_thread.start()
 
-    def tearDown(self) -> None:
-        pass
+    @classmethod
+    def tearDownClass(cls) -> None:
+        cls.httpd.shutdown()
+        cls.httpd.server_close()
+        super().tearDownClass()
 
     def test_fetch_and_extract_nextcloud(self) -> None:
         """
@@ -31,6 +45,322 @@ class TestUtils(unittest.TestCase):
         """
         utils.fetch_and_extract_nextcloud('http://localhost:8081/nextcloud.tar.bz2')
 
+    def test_fetch_and_extract_nextcloud_progress(self) -> None:
+        """
+        Test that download progress is reported up to the full size.
+        """
+        reported = []
+        utils.fetch_and_extract_nextcloud('http://localhost:8081/nextcloud.tar.bz2',
+                                          progress=lambda done, total: reported.append(
+                                              (done, total)))
+        size = os.path.getsize('nextcloud.tar.bz2')
+        self.assertEqual(reported[-1], (size, size))
+
+    def test_fetch_and_extract_nextcloud_sha256(self) -> None:
+        """
+        Test that a tarfile is verified before anything is extracted.
+        """
+        url = 'http://localhost:8081/nextcloud.tar.bz2'
+        extracted = str(utils.WWW_DIR / 'slask.py')
+        if os.path.exists(extracted):
+            os.unlink(extracted)
+        with self.assertRaises(SystemExit):
+            utils.fetch_and_extract_nextcloud(url, sha256='0' * 64)
+        self.assertFalse(os.path.exists(extracted))
+        sha256 = hashlib.sha256(open('nextcloud.tar.bz2', 'rb').read()).hexdigest()
+        utils.fetch_and_extract_nextcloud(url, sha256=sha256)
+        self.assertTrue(os.path.isfile(extracted))
+
+    def test_fetch_and_extract_nextcloud_cached(self) -> None:
+        """
+        Test that a fetched tarfile is cached and verified against its sha256.
+        """
+        url = 'http://localhost:8081/nextcloud.tar.bz2'
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache = TarballCache(tmpdir)
+            sha256 = hashlib.sha256(open('nextcloud.tar.bz2', 'rb').read()).hexdigest()
+            utils.fetch_and_extract_nextcloud(url, sha256=sha256, cache=cache)
+            self.assertEqual(cache.lookup(url).name, sha256)
+            with self.assertRaises(SystemExit):
+                utils.fetch_and_extract_nextcloud(url + '?v2', sha256='0' * 64, cache=cache)
+
+    def test_fetch_and_extract_nextcloud_mirror_sha256(self) -> None:
+        """
+        Test that a mirror tarball not matching mirror_sha256 is not used.
+        """
+        url = 'http://localhost:8081/nextcloud.tar.bz2'
+        sha256 = hashlib.sha256(open('nextcloud.tar.bz2', 'rb').read()).hexdigest()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache = TarballCache(tmpdir)
+            with mock.patch.object(utils, '_download_to_cache',
+                                   wraps=utils._download_to_cache) as download:
+                utils.fetch_and_extract_nextcloud(url, cache=cache, mirror_url=url + '?mirror',
+                                                  mirror_sha256='0' * 64)
+            self.assertEqual([c[0][0] for c in download.call_args_list], [url + '?mirror', url])
+            self.assertEqual(cache.lookup(url).name, sha256)
+
+    def test_extract_nextcloud_parallel(self) -> None:
+        """
+        Test the threaded extraction against a generated tree with nested
+        directories and a symlink.
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            src = os.path.join(tmpdir, 'src', 'nextcloud')
+            for i in range(50):
+                os.makedirs(os.path.join(src, 'apps', str(i % 7)), exist_ok=True)
+                with open(os.path.join(src, 'apps', str(i % 7), f"{i}.php"), 'w') as f:
+                    f.write(f"<?php // {i}\n")
+            os.symlink('apps/0/0.php', os.path.join(src, 'index.php'))
+            archive = os.path.join(tmpdir, 'nextcloud.tar.bz2')
+            with tarfile.open(archive, 'w:bz2') as tfile:
+                tfile.add(src, arcname='nextcloud')
+            dst = os.path.join(tmpdir, 'dst')
+            utils.extract_nextcloud(archive, dst=dst, workers=4)
+            self.assertEqual(open(os.path.join(dst, 'nextcloud', 'apps', '6', '48.php')).read(),
+                             "<?php // 48\n")
+            self.assertEqual(os.readlink(os.path.join(dst, 'nextcloud', 'index.php')),
+                             'apps/0/0.php')
+
+    def test_extract_nextcloud_refuses_path_traversal(self) -> None:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            archive = os.path.join(tmpdir, 'evil.tar.bz2')
+            with tarfile.open(archive, 'w:bz2') as tfile:
+                info = tarfile.TarInfo('../evil.php')
+                tfile.addfile(info, io.BytesIO(b''))
+            with self.assertRaises(tarfile.ExtractError):
+                utils.extract_nextcloud(archive, dst=os.path.join(tmpdir, 'dst'))
+            self.assertFalse(os.path.exists(os.path.join(tmpdir, 'evil.php')))
+
+    @unittest.skipUnless(shutil.which('bzip2'), "needs bzip2")
+    def test_extract_nextcloud_keeps_error_from_decompressor_pipe(self) -> None:
+        """
+        Test that an extraction error is not replaced by the failure of
+        the decompressor whose output was closed.
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            archive = os.path.join(tmpdir, 'evil.tar.bz2')
+            with tarfile.open(archive, 'w:bz2') as tfile:
+                info = tarfile.TarInfo('../evil.php')
+                tfile.addfile(info, io.BytesIO(b''))
+                info = tarfile.TarInfo('nextcloud/big.bin')
+                info.size = 4 * 1024 * 1024
+                tfile.addfile(info, io.BytesIO(os.urandom(info.size)))
+            with mock.patch('nextcloud.utils.shutil.which', return_value=shutil.which('bzip2')):
+                with self.assertRaises(tarfile.ExtractError):
+                    utils.extract_nextcloud(archive, dst=os.path.join(tmpdir, 'dst'))
+
+    def test_extract_nextcloud_zstd_without_decompressor(self) -> None:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            archive = os.path.join(tmpdir, 'nextcloud.tar.bz2')
+            with open(archive, 'wb') as f:
+                f.write(b'\x28\xb5\x2f\xfd' + b'\0' * 16)
+            with mock.patch('nextcloud.utils.shutil.which', return_value=None), \
+                    mock.patch.dict('sys.modules', {'zstandard': None}):
+                with self.assertRaises(tarfile.ReadError):
+                    utils.extract_nextcloud(archive, dst=os.path.join(tmpdir, 'dst'))
+
+    @unittest.skipUnless(os.geteuid() == 0, "chown needs root")
+    def test_set_directory_permissions(self) -> None:
+        """
+        Test that only entries with the wrong owner are changed and that
+        skipped directories are not walked.
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for d in ['apps/files', 'apps/dav/lib', 'data/admin/files']:
+                os.makedirs(os.path.join(tmpdir, d))
+            for f in ['index.php', 'apps/dav/lib/a.php', 'data/admin/files/b.txt']:
+                open(os.path.join(tmpdir, f), 'w').close()
+            os.chown(os.path.join(tmpdir, 'apps/files'), 1234, 1234)
+            self.assertEqual(utils.set_directory_permissions(tmpdir, owner='nobody', skip=['data'],
+                                                             workers=4), 8)
+            self.assertEqual(
+                utils.set_directory_permissions(tmpdir, owner='nobody', skip=['data']), 0)
+            nobody = pwd.getpwnam('nobody').pw_uid
+            self.assertEqual(os.stat(os.path.join(tmpdir, 'data')).st_uid, nobody)
+            self.assertEqual(os.stat(os.path.join(tmpdir, 'data/admin')).st_uid, 0)
+            self.assertEqual(
+                utils.set_directory_permissions(tmpdir, owner='nobody', max_depth=2), 1)
+            self.assertEqual(os.stat(os.path.join(tmpdir, 'data/admin/files')).st_uid, 0)
+
+    def test_render_template_only_writes_changes(self) -> None:
+        """
+        Test that rendering reports whether the target changed.
+        """
+        redis_info = {'redis_hostname': '10.0.0.5', 'redis_port': 6379}
+        with tempfile.TemporaryDirectory() as tmpdir:
+            target = os.path.join(tmpdir, 'redis.config.php')
+            self.assertTrue(utils.render_template(TEMPLATES, 'redis.config.php.j2', redis_info,
+                                                  target))
+            mtime = os.stat(target).st_mtime_ns
+            self.assertFalse(utils.render_template(TEMPLATES, 'redis.config.php.j2', redis_info,
+                                                   target))
+            self.assertEqual(os.stat(target).st_mtime_ns, mtime)
+            redis_info['redis_port'] = 6380
+            self.assertTrue(utils.render_template(TEMPLATES, 'redis.config.php.j2', redis_info,
+                                                  target))
+
+    def test_redis_config_php(self) -> None:
+        """
+        Test that redis.config.php uses APCu locally and quotes the password.
+        """
+        redis_info = {'redis_socket': '/var/run/redis/redis.sock', 'redis_password': "it's\\",
+                      'redis_dbindex': 2, 'redis_timeout': 1.5, 'redis_read_timeout': 0,
+                      'redis_persistent': True}
+        with tempfile.TemporaryDirectory() as tmpdir:
+            target = os.path.join(tmpdir, 'redis.config.php')
+            utils.render_template(TEMPLATES, 'redis.config.php.j2', redis_info, target)
+            config = config_php.read_config(target)
+        self.assertEqual(config['memcache.local'], '\\OC\\Memcache\\APCu')
+        self.assertEqual(config['redis'], {'host': '/var/run/redis/redis.sock', 'port': 0,
+                                           'password': "it's\\", 'dbindex': 2,
+                                           'timeout': 1.5, 'persistent': True})
+
+    def test_ceph_config_php_multibucket(self) -> None:
+        """
+        Test that more than one bucket switches to objectstore_multibucket.
+        """
+        ceph_info = {'ceph_key': 'key', 'ceph_secret': 'secret', 'rados_gw_hostname': '10.0.0.1',
+                     'rados_gw_port': '80', 'bucket': 'nextcloud', 'num_buckets': 1,
+                     'upload_part_size': 500 * 1024 * 1024, 'upload_concurrency': 5}
+        with tempfile.TemporaryDirectory() as tmpdir:
+            target = os.path.join(tmpdir, 'ceph.config.php')
+            utils.render_template(TEMPLATES, 'ceph.config.php.j2', ceph_info, target)
+            config = config_php.read_config(target)
+            self.assertNotIn('num_buckets', config['objectstore']['arguments'])
+            ceph_info['num_buckets'] = 64
+            utils.render_template(TEMPLATES, 'ceph.config.php.j2', ceph_info, target)
+            config = config_php.read_config(target)
+        self.assertNotIn('objectstore', config)
+        arguments = config['objectstore_multibucket']['arguments']
+        self.assertEqual((arguments['num_buckets'], arguments['bucket'], arguments['concurrency']),
+                         (64, 'nextcloud', 5))
+
+    def test_dbreplica_config_php(self) -> None:
+        """
+        Test that every standby becomes a dbreplica entry.
+        """
+        replicas = [{'host': '10.0.0.4:5432', 'dbname': 'nextcloud', 'user': 'juju_nextcloud',
+                     'password': "p'w"},
+                    {'host': '10.0.0.5:5432', 'dbname': 'nextcloud', 'user': 'juju_nextcloud',
+                     'password': "p'w"}]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            target = os.path.join(tmpdir, 'dbreplica.config.php')
+            utils.render_template(TEMPLATES, 'dbreplica.config.php.j2', {'replicas': replicas},
+                                  target)
+            config = config_php.read_config(target)
+        self.assertEqual([dict(r) for r in config['dbreplica']], replicas)
+
+    def test_previews_config_php(self) -> None:
+        """
+        Test that previews.config.php lists the providers with imaginary first.
+        """
+        ctx = {'preview_max_x': 1024, 'preview_max_y': 768, 'concurrency': 2,
+               'providers': ['OC\\Preview\\Imaginary', 'OC\\Preview\\PNG'],
+               'imaginary_url': 'http://10.0.0.9:9000'}
+        with tempfile.TemporaryDirectory() as tmpdir:
+            target = os.path.join(tmpdir, 'previews.config.php')
+            utils.render_template(TEMPLATES, 'previews.config.php.j2', ctx, target)
+            config = config_php.read_config(target)
+        self.assertEqual((config['preview_max_x'], config['preview_max_y']), (1024, 768))
+        self.assertEqual((config['preview_concurrency_new'], config['preview_concurrency_all']),
+                         (2, 4))
+        self.assertEqual(list(config['enabledPreviewProviders']),
+                         ['OC\\Preview\\Imaginary', 'OC\\Preview\\PNG'])
+        self.assertEqual(config['preview_imaginary_url'], 'http://10.0.0.9:9000')
+
+    @mock.patch('nextcloud.utils.sp.call')
+    @mock.patch('nextcloud.utils.sp.check_call')
+    def test_config_timer(self, check_call, call) -> None:
+        """
+        Test that the cron timer is enabled once, restarted when its
+        schedule changes and removed with ctx None.
+        """
+        ctx = {'nextcloud_root': '/var/www/nextcloud', 'interval': 5}
+        with tempfile.TemporaryDirectory() as tmpdir, \
+                mock.patch('nextcloud.utils.SYSTEMD_DIR', utils.Path(tmpdir)):
+            self.assertTrue(utils.config_timer('nextcloud-cron', ctx, TEMPLATES))
+            self.assertEqual([c[0][0] for c in check_call.call_args_list],
+                             [['systemctl', 'daemon-reload'],
+                              ['systemctl', 'enable', 'nextcloud-cron.timer'],
+                              ['systemctl', 'restart', 'nextcloud-cron.timer']])
+            with open(os.path.join(tmpdir, 'nextcloud-cron.service')) as f:
+                self.assertIn('ExecStart=/usr/bin/php -f /var/www/nextcloud/cron.php', f.read())
+            check_call.reset_mock()
+            self.assertFalse(utils.config_timer('nextcloud-cron', ctx, TEMPLATES))
+            check_call.assert_not_called()
+            self.assertTrue(utils.config_timer('nextcloud-cron', dict(ctx, interval=15),
+                                               TEMPLATES))
+            with open(os.path.join(tmpdir, 'nextcloud-cron.timer')) as f:
+                self.assertIn('OnUnitActiveSec=15min', f.read())
+            self.assertTrue(utils.config_timer('nextcloud-cron', None, TEMPLATES))
+            call.assert_called_once_with(['systemctl', 'disable', '--now', 'nextcloud-cron.timer'])
+            self.assertEqual(os.listdir(tmpdir), [])
+            self.assertFalse(utils.config_timer('nextcloud-cron', None, TEMPLATES))
+
+    @mock.patch('nextcloud.utils.sp.check_output')
+    def test_probes_are_memoized(self, check_output) -> None:
+        """
+        Test that host probes spawn one process and can be carried over
+        to the next hook until the packages change.
+        """
+        check_output.return_value = b"PHP 7.4.3 (cli) (built: Oct  6 2020 15:47:56) ( NTS )\n"
+        utils.invalidate_probes()
+        self.assertEqual(utils.get_phpversion(), "7.4")
+        self.assertEqual(utils.get_phpversion(), "7.4")
+        self.assertEqual(check_output.call_count, 1)
+
+        saved = utils.export_probes()
+        utils.invalidate_probes()
+        utils.load_probes(saved)
+        self.assertEqual(utils.get_phpversion(), "7.4")
+        self.assertEqual(check_output.call_count, 1)
+
+        utils.invalidate_probes()
+        utils.load_probes(dict(saved, fingerprint='stale'))
+        self.assertEqual(utils.get_phpversion(), "7.4")
+        self.assertEqual(check_output.call_count, 2)
+        utils.invalidate_probes()
+
+    @mock.patch('nextcloud.utils.glob.glob',
+                return_value=['/etc/apache2/mods-enabled/rewrite.load'])
+    def test_apache_modules_are_not_persisted(self, glob) -> None:
+        """
+        Test that enabled apache modules are probed once per hook only.
+        """
+        utils.invalidate_probes()
+        self.assertEqual(utils.get_apache_modules(), ['rewrite'])
+        self.assertEqual(utils.get_apache_modules(), ['rewrite'])
+        self.assertEqual(glob.call_count, 1)
+        saved = utils.export_probes()
+        self.assertNotIn('get_apache_modules', saved['facts'])
+
+        utils.invalidate_probes()
+        utils.load_probes(dict(saved, facts={'get_apache_modules': ['rewrite', 'headers']}))
+        self.assertEqual(utils.get_apache_modules(), ['rewrite'])
+        self.assertEqual(glob.call_count, 2)
+        utils.invalidate_probes()
+
+    @mock.patch('nextcloud.utils.sp.run')
+    def test_install_packages_skips_installed(self, run) -> None:
+        """
+        Test that only packages missing from the dpkg status are installed.
+        """
+        with tempfile.NamedTemporaryFile('w') as status:
+            status.write("Package: apache2\nStatus: install ok installed\nVersion: 2.4.41\n\n"
+                         "Package: php-pear\nStatus: deinstall ok config-files\n\n"
+                         "Package: rpcbind\nStatus: install ok installed\n"
+                         "Description: portmapper\n multi line: description\n")
+            status.flush()
+            with mock.patch('nextcloud.utils.DPKG_STATUS', status.name):
+                self.assertEqual(
+                    utils.install_packages(['apache2', 'php-pear', 'rpcbind', 'php-pear']),
+                    ['php-pear'])
+                run.assert_called_once_with(['sudo', 'apt', 'install', '-y', 'php-pear'],
+                                            check=True)
+                run.reset_mock()
+                self.assertEqual(utils.install_packages(['apache2', 'rpcbind']), [])
+                run.assert_not_called()
+
 
 if __name__ == '__main__':
     unittest.main()
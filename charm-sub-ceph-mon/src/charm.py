@@ -4,13 +4,18 @@
 
 """Charm the service."""
 
+import http.client
 import logging
 import subprocess as sp
 import json
+from concurrent.futures import ThreadPoolExecutor
 
 from ops.charm import CharmBase
 from ops.main import main
 from ops.framework import StoredState
+from ops.model import ActiveStatus, WaitingStatus
+
+from s3client import S3Client, S3Error
 
 logger = logging.getLogger(__name__)
 
@@ -26,37 +31,109 @@ class SubCephMonCharm(CharmBase):
         self.framework.observe(self.on.ceph_relation_changed, self._on_ceph_relation_changed)
         self.framework.observe(self.on.rados_gw_relation_changed, self._on_rados_gw_relation_changed)
         self._stored.set_default(rados_gw={'hostname': '', 'port': ''})
+        # Output of radosgw-admin user info, and the buckets known to exist.
+        self._stored.set_default(user_info=None, buckets_endpoint=None, buckets=[])
 
-    def _on_config_changed(self, _):
-        pass
+    def _on_config_changed(self, event):
+        """
+        Leader creates the buckets added by num-buckets or bucket-prefix
+        and republishes them, once radosgw and the ceph relation are there.
+        """
+        relation = self.model.get_relation('ceph')
+        if not (self.model.unit.is_leader() and relation):
+            return
+        if not (self._stored.rados_gw['hostname'] and self._stored.rados_gw['port']):
+            return
+        user_info = self._user_info()
+        if not user_info:
+            return
+        if not self._publish_buckets(relation, user_info):
+            event.defer()
 
     def _on_ceph_relation_changed(self, event):
         if self.model.unit.is_leader():
             if not (self._stored.rados_gw['hostname'] and self._stored.rados_gw['port']):
                 event.defer()
                 return
-            # Create user
             self.framework.breakpoint('ceph')
-            cmd = 'sudo radosgw-admin user create --uid=nextcloud --display-name=\"nextcloud\"'
-            user_info = sp.run(cmd.split(' '), stdout=sp.PIPE, universal_newlines=True).stdout
+            user_info = self._user_info()
             if not user_info:
                 event.defer()
                 return
-            user_info = json.loads(user_info)
             event.relation.data[self.app]['ceph_user'] = json.dumps(user_info)
-            # Create bucket
-            sp.run(["sudo", "apt", "install", "-y", 'awscli'], check=True)
-
-            # configure aws with creds from created user
-            aws_env_vars = {'AWS_ACCESS_KEY_ID': user_info['keys'][0]['access_key'],
-                            'AWS_SECRET_ACCESS_KEY': user_info['keys'][0]['secret_key'],
-                            'AWS_DEFAULT_REGION': 'eu-north-1'}
-            rados_gw_hostname = self._stored.rados_gw['hostname']
-            rados_gw_port = self._stored.rados_gw['port']
-            cmd = "aws --endpoint-url=http://{}:{} s3api create-bucket --bucket nextcloud".format(rados_gw_hostname, rados_gw_port)
-            sp.run(cmd.split(' '), check=True, env=aws_env_vars)
-            event.relation.data[self.app]['rados_gw_hostname'] = rados_gw_hostname
-            event.relation.data[self.app]['rados_gw_port'] = rados_gw_port
+            if not self._publish_buckets(event.relation, user_info):
+                event.defer()
+
+    def _publish_buckets(self, relation, user_info):
+        """
+        Create the missing buckets and publish radosgw and the bucket
+        layout to nextcloud.
+        :return: False if radosgw could not create the buckets, to retry.
+        """
+        rados_gw_hostname = self._stored.rados_gw['hostname']
+        rados_gw_port = self._stored.rados_gw['port']
+        endpoint = "http://{}:{}".format(rados_gw_hostname, rados_gw_port)
+        try:
+            self._create_buckets(endpoint, user_info['keys'][0])
+        except (S3Error, OSError, http.client.HTTPException) as e:
+            logger.warning("Creating buckets at %s failed: %s", endpoint, e)
+            self.unit.status = WaitingStatus("waiting for radosgw to create buckets")
+            return False
+        self.unit.status = ActiveStatus()
+        relation.data[self.app]['rados_gw_hostname'] = rados_gw_hostname
+        relation.data[self.app]['rados_gw_port'] = rados_gw_port
+        relation.data[self.app]['bucket_prefix'] = self.config['bucket-prefix']
+        relation.data[self.app]['num_buckets'] = str(self.config['num-buckets'])
+        return True
+
+    def _user_info(self):
+        """
+        The radosgw user for nextcloud, looked up with user info and only
+        created if missing. Kept in StoredState after the first success.
+        :return: dict from radosgw-admin, or None if radosgw is not ready.
+        """
+        if self._stored.user_info:
+            return json.loads(self._stored.user_info)
+        output = sp.run(['sudo', 'radosgw-admin', 'user', 'info', '--uid=nextcloud'],
+                        stdout=sp.PIPE, stderr=sp.DEVNULL, universal_newlines=True)
+        if output.returncode != 0:
+            output = sp.run(['sudo', 'radosgw-admin', 'user', 'create', '--uid=nextcloud',
+                             '--display-name=nextcloud'],
+                            stdout=sp.PIPE, universal_newlines=True)
+        if output.returncode != 0 or not output.stdout:
+            return None
+        self._stored.user_info = output.stdout
+        return json.loads(output.stdout)
+
+    def bucket_names(self):
+        """
+        The buckets nextcloud expects: bucket-prefix, or bucket-prefix
+        followed by 0 .. num-buckets - 1 in multibucket mode.
+        """
+        prefix = self.config['bucket-prefix']
+        num_buckets = self.config['num-buckets']
+        if num_buckets <= 1:
+            return [prefix]
+        return ["{}{}".format(prefix, i) for i in range(num_buckets)]
+
+    def _create_buckets(self, endpoint, keys):
+        """
+        Create the buckets that are not known to exist yet, several at a
+        time. Created buckets are remembered per endpoint in StoredState.
+        :param keys: dict with access_key and secret_key
+        """
+        if self._stored.buckets_endpoint != endpoint:
+            self._stored.buckets_endpoint = endpoint
+            self._stored.buckets = []
+        missing = [b for b in self.bucket_names() if b not in self._stored.buckets]
+        if not missing:
+            return
+        client = S3Client(endpoint, keys['access_key'], keys['secret_key'])
+        workers = max(1, self.config['bucket-create-workers'])
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # list() re-raises the first failure.
+            list(executor.map(client.create_bucket, missing))
+        self._stored.buckets = sorted(set(self._stored.buckets) | set(missing))
 
     def _on_rados_gw_relation_changed(self, event):
         if self.model.unit.is_leader():
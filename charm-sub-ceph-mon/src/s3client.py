@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+"""
+Minimal S3 client for radosgw bucket provisioning.
+
+Requests are signed with AWS Signature Version 4 using only the standard
+library, so the charm does not need awscli or boto.
+"""
+import datetime
+import hashlib
+import hmac
+import http.client
+import logging
+from urllib.parse import quote, urlsplit
+
+logger = logging.getLogger(__name__)
+
+EMPTY_SHA256 = hashlib.sha256(b'').hexdigest()
+
+
+class S3Error(Exception):
+    """An S3 request failed."""
+
+    def __init__(self, status, body):
+        super().__init__("S3 request failed with {}: {}".format(status, body))
+        self.status = status
+        self.body = body
+
+
+def _hmac(key, msg):
+    return hmac.new(key, msg.encode(), hashlib.sha256).digest()
+
+
+def signing_key(secret_key, date, region, service='s3'):
+    """
+    Derive the SigV4 signing key for a date (YYYYMMDD).
+    """
+    key = _hmac(('AWS4' + secret_key).encode(), date)
+    key = _hmac(key, region)
+    key = _hmac(key, service)
+    return _hmac(key, 'aws4_request')
+
+
+def sign(method, url, headers, access_key, secret_key, region='us-east-1',
+         payload_hash=EMPTY_SHA256, now=None, service='s3'):
+    """
+    Sign a request with AWS Signature Version 4.
+    :param headers: dict of headers to sign, host, x-amz-date and
+                    x-amz-content-sha256 are added
+    :param now: datetime (UTC) of the request, defaults to now
+    :return: new dict of headers, including Authorization
+    """
+    now = now or datetime.datetime.utcnow()
+    amz_date = now.strftime('%Y%m%dT%H%M%SZ')
+    date = now.strftime('%Y%m%d')
+    parts = urlsplit(url)
+    headers = {k.lower(): str(v).strip() for k, v in headers.items()}
+    headers.setdefault('host', parts.netloc)
+    headers['x-amz-date'] = amz_date
+    headers['x-amz-content-sha256'] = payload_hash
+
+    query = []
+    for param in filter(None, parts.query.split('&')):
+        key, _, value = param.partition('=')
+        query.append((quote(key, safe='-_.~'), quote(value, safe='-_.~')))
+    signed_headers = ';'.join(sorted(headers))
+    canonical_request = '\n'.join([
+        method,
+        quote(parts.path or '/', safe='/-_.~'),
+        '&'.join('{}={}'.format(k, v) for k, v in sorted(query)),
+        ''.join('{}:{}\n'.format(k, headers[k]) for k in sorted(headers)),
+        signed_headers,
+        payload_hash,
+    ])
+    scope = '{}/{}/{}/aws4_request'.format(date, region, service)
+    string_to_sign = '\n'.join([
+        'AWS4-HMAC-SHA256',
+        amz_date,
+        scope,
+        hashlib.sha256(canonical_request.encode()).hexdigest(),
+    ])
+    signature = hmac.new(signing_key(secret_key, date, region, service),
+                         string_to_sign.encode(), hashlib.sha256).hexdigest()
+    headers['authorization'] = (
+        'AWS4-HMAC-SHA256 Credential={}/{}, SignedHeaders={}, Signature={}'.format(
+            access_key, scope, signed_headers, signature))
+    return headers
+
+
+class S3Client:
+    """
+    Path style S3 client (radosgw is addressed by ip, not by bucket
+    hostnames). One connection per request, so it is safe to use from
+    several threads.
+    """
+
+    def __init__(self, endpoint, access_key, secret_key, region='us-east-1', timeout=30):
+        self.endpoint = endpoint.rstrip('/')
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.region = region
+        self.timeout = timeout
+
+    def request(self, method, path, body=b''):
+        """
+        :return: (status, body)
+        """
+        url = self.endpoint + path
+        headers = sign(method, url, {}, self.access_key, self.secret_key, self.region,
+                       payload_hash=hashlib.sha256(body).hexdigest())
+        parts = urlsplit(url)
+        if parts.scheme == 'https':
+            conn_class = http.client.HTTPSConnection
+        else:
+            conn_class = http.client.HTTPConnection
+        conn = conn_class(parts.netloc, timeout=self.timeout)
+        try:
+            conn.request(method, parts.path or '/', body=body or None, headers=headers)
+            response = conn.getresponse()
+            return response.status, response.read().decode(errors='replace')
+        finally:
+            conn.close()
+
+    def bucket_exists(self, bucket) -> bool:
+        status, body = self.request('HEAD', '/' + bucket)
+        if status == 404:
+            return False
+        if status >= 300:
+            raise S3Error(status, body)
+        return True
+
+    def create_bucket(self, bucket) -> bool:
+        """
+        Create a bucket unless it exists.
+        :return: True if the bucket was created.
+        """
+        if self.bucket_exists(bucket):
+            return False
+        status, body = self.request('PUT', '/' + bucket)
+        if status == 409 and 'BucketAlreadyOwnedByYou' in body:
+            return False
+        if status >= 300:
+            raise S3Error(status, body)
+        logger.info("Created bucket %s", bucket)
+        return True
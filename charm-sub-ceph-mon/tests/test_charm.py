@@ -1,8 +1,12 @@
 # Copyright 2021 joakimnyman
 # See LICENSE file for licensing details.
 
+import json
+import subprocess as sp
 import unittest
+from unittest import mock
 
+from ops.model import ActiveStatus, WaitingStatus
 from ops.testing import Harness
 from charm import SubCephMonCharm
 
@@ -15,3 +19,81 @@ class TestCharm(unittest.TestCase):
         self.assertEqual(harness.charm._stored.rados_gw, {'hostname': '', 'port': ''})
         harness.update_config()
         self.assertEqual(harness.charm._stored.rados_gw, {'hostname': '', 'port': ''})
+
+    def test_bucket_names(self):
+        harness = Harness(SubCephMonCharm)
+        self.addCleanup(harness.cleanup)
+        harness.begin()
+        self.assertEqual(harness.charm.bucket_names(), ['nextcloud'])
+        harness.update_config({'num-buckets': 3, 'bucket-prefix': 'nc-'})
+        self.assertEqual(harness.charm.bucket_names(), ['nc-0', 'nc-1', 'nc-2'])
+
+    @mock.patch('charm.S3Client.create_bucket')
+    def test_create_buckets_once(self, create_bucket):
+        harness = Harness(SubCephMonCharm)
+        self.addCleanup(harness.cleanup)
+        harness.begin()
+        harness.update_config({'num-buckets': 16})
+        keys = {'access_key': 'a', 'secret_key': 's'}
+        harness.charm._create_buckets('http://10.0.0.1:80', keys)
+        buckets = sorted(c[0][0] for c in create_bucket.call_args_list)
+        self.assertEqual(buckets, sorted(harness.charm.bucket_names()))
+        # Known buckets are not created again.
+        harness.charm._create_buckets('http://10.0.0.1:80', keys)
+        self.assertEqual(create_bucket.call_count, 16)
+        harness.update_config({'num-buckets': 17})
+        harness.charm._create_buckets('http://10.0.0.1:80', keys)
+        create_bucket.assert_called_with('nextcloud16')
+
+    @mock.patch('charm.S3Client.create_bucket')
+    def test_config_changed_republishes_buckets(self, create_bucket):
+        harness = Harness(SubCephMonCharm)
+        self.addCleanup(harness.cleanup)
+        harness.set_leader(True)
+        harness.begin()
+        rel_id = harness.add_relation('ceph', 'nextcloud')
+        # Nothing to do before radosgw is known.
+        harness.update_config({'num-buckets': 2})
+        create_bucket.assert_not_called()
+
+        harness.charm._stored.rados_gw = {'hostname': '10.0.0.1', 'port': '80'}
+        harness.charm._stored.user_info = json.dumps(
+            {'user_id': 'nextcloud', 'keys': [{'access_key': 'a', 'secret_key': 's'}]})
+        harness.update_config({'num-buckets': 3, 'bucket-prefix': 'nc-'})
+        self.assertEqual(sorted(c[0][0] for c in create_bucket.call_args_list),
+                         ['nc-0', 'nc-1', 'nc-2'])
+        data = harness.get_relation_data(rel_id, 'sub-ceph-mon')
+        self.assertEqual((data['bucket_prefix'], data['num_buckets']), ('nc-', '3'))
+        self.assertEqual(data['rados_gw_hostname'], '10.0.0.1')
+
+    @mock.patch('charm.S3Client.create_bucket')
+    def test_unreachable_radosgw_defers(self, create_bucket):
+        harness = Harness(SubCephMonCharm)
+        self.addCleanup(harness.cleanup)
+        harness.set_leader(True)
+        harness.begin()
+        rel_id = harness.add_relation('ceph', 'nextcloud')
+        harness.charm._stored.rados_gw = {'hostname': '10.0.0.1', 'port': '80'}
+        harness.charm._stored.user_info = json.dumps(
+            {'user_id': 'nextcloud', 'keys': [{'access_key': 'a', 'secret_key': 's'}]})
+        create_bucket.side_effect = ConnectionRefusedError(111, 'Connection refused')
+        harness.update_config({'num-buckets': 2})
+        self.assertIsInstance(harness.charm.unit.status, WaitingStatus)
+        self.assertNotIn('num_buckets', harness.get_relation_data(rel_id, 'sub-ceph-mon'))
+
+        create_bucket.side_effect = None
+        harness.framework.reemit()
+        self.assertIsInstance(harness.charm.unit.status, ActiveStatus)
+        self.assertEqual(harness.get_relation_data(rel_id, 'sub-ceph-mon')['num_buckets'], '2')
+
+    @mock.patch('charm.sp.run')
+    def test_user_info_before_create(self, run):
+        harness = Harness(SubCephMonCharm)
+        self.addCleanup(harness.cleanup)
+        harness.begin()
+        user = {'user_id': 'nextcloud', 'keys': [{'access_key': 'a', 'secret_key': 's'}]}
+        run.return_value = sp.CompletedProcess([], 0, json.dumps(user))
+        self.assertEqual(harness.charm._user_info(), user)
+        self.assertEqual(harness.charm._user_info(), user)
+        run.assert_called_once()
+        self.assertEqual(run.call_args[0][0][:4], ['sudo', 'radosgw-admin', 'user', 'info'])
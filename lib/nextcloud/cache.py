@@ -0,0 +1,159 @@
+"""
+Content addressed cache for nextcloud release tarballs.
+
+Files are stored as blobs/<sha256>, index.json maps download urls to the
+sha256 of what they served. The least recently used blobs are evicted when
+the cache grows past max_bytes.
+"""
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIR = '/var/cache/nextcloud-charm/tarballs'
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024
+
+
+class ChecksumError(Exception):
+    """A tarball did not match the expected sha256."""
+
+
+def sha256sum(path) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class TarballCache:
+
+    def __init__(self, root=CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.root = Path(root)
+        self.blobs = self.root / 'blobs'
+        self.index_path = self.root / 'index.json'
+        self.max_bytes = max_bytes
+
+    def _index(self) -> dict:
+        try:
+            return json.loads(self.index_path.read_text())
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def _save_index(self, index):
+        self.root.mkdir(parents=True, exist_ok=True)
+        tmp = self.index_path.with_suffix('.tmp')
+        tmp.write_text(json.dumps(index, indent=2, sort_keys=True))
+        os.replace(str(tmp), str(self.index_path))
+
+    def path(self, sha256) -> Path:
+        return self.blobs / sha256
+
+    def lookup(self, url=None, sha256=None):
+        """
+        Find a cached tarball by its sha256, or by the url it was downloaded
+        from. A url hit must also match sha256 when both are given.
+        :return: Path to the blob or None.
+        """
+        if not sha256 and url:
+            sha256 = self._index().get(url)
+        if not sha256:
+            return None
+        blob = self.path(sha256)
+        if not blob.exists():
+            return None
+        # Mark as recently used for eviction.
+        os.utime(str(blob))
+        return blob
+
+    @contextmanager
+    def writer(self, url=None, sha256=None):
+        """
+        Write a new tarball into the cache chunk by chunk. The content is
+        hashed while written and only becomes visible in the cache when the
+        block exits without error and the sha256 matches (if given).
+
+            with cache.writer(url, sha256) as f:
+                f.write(chunk)
+        """
+        self.blobs.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=str(self.blobs), prefix='.incoming-')
+        digest = hashlib.sha256()
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                yield _HashingWriter(f, digest)
+            actual = digest.hexdigest()
+            if sha256 and actual != sha256.lower():
+                raise ChecksumError(f"{url or 'tarball'} has sha256 {actual}, expected {sha256}")
+            os.chmod(tmp, 0o644)
+            os.replace(tmp, str(self.path(actual)))
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        self._commit(url, actual)
+
+    def add_file(self, src, url=None, sha256=None) -> Path:
+        """
+        Copy an existing tarball (e.g. a juju resource) into the cache.
+        :return: Path to the blob.
+        """
+        actual = sha256sum(src)
+        if sha256 and actual != sha256.lower():
+            raise ChecksumError(f"{src} has sha256 {actual}, expected {sha256}")
+        blob = self.lookup(sha256=actual)
+        if blob is None:
+            with self.writer(url) as f, open(src, 'rb') as s:
+                shutil.copyfileobj(s, f, 1024 * 1024)
+            blob = self.path(actual)
+        elif url:
+            self._commit(url, actual)
+        return blob
+
+    def _commit(self, url, sha256):
+        if url:
+            index = self._index()
+            index[url] = sha256
+            self._save_index(index)
+        self.evict(keep=sha256)
+
+    def evict(self, keep=None):
+        """
+        Remove least recently used blobs until the cache fits in max_bytes.
+        The blob named by keep is never removed.
+        """
+        if not self.blobs.exists():
+            return
+        blobs = [p for p in self.blobs.iterdir() if not p.name.startswith('.')]
+        blobs.sort(key=lambda p: p.stat().st_mtime)
+        total = sum(p.stat().st_size for p in blobs)
+        removed = set()
+        for blob in blobs:
+            if total <= self.max_bytes:
+                break
+            if blob.name == keep:
+                continue
+            total -= blob.stat().st_size
+            blob.unlink()
+            removed.add(blob.name)
+            logger.info("Evicted %s from the tarball cache", blob.name)
+        if removed:
+            index = {u: s for u, s in self._index().items() if s not in removed}
+            self._save_index(index)
+
+
+class _HashingWriter:
+    """File wrapper that feeds everything written into a hash."""
+
+    def __init__(self, f, digest):
+        self._f = f
+        self._digest = digest
+
+    def write(self, data):
+        self._digest.update(data)
+        return self._f.write(data)
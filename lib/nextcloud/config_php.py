@@ -0,0 +1,246 @@
+"""
+Read and write nextcloud config/config.php without going through occ.
+
+config.php holds a single PHP array literal assigned to $CONFIG, as written
+by Nextcloud itself with var_export(). Arrays with keys 0..n-1 become python
+lists, all other arrays become dicts (in file order).
+"""
+import hashlib
+import json
+import re
+
+from nextcloud.utils import write_atomic
+
+CONFIG_PHP = '/var/www/nextcloud/config/config.php'
+
+_TOKEN_RE = re.compile(r"""
+    (?P<space>\s+|//[^\n]*|\#[^\n]*|/\*.*?\*/)
+  | (?P<open_tag><\?php)
+  | (?P<close_tag>\?>)
+  | (?P<variable>\$[A-Za-z_][A-Za-z0-9_]*)
+  | (?P<sstring>'(?:[^'\\]|\\.)*')
+  | (?P<dstring>"(?:[^"\\]|\\.)*")
+  | (?P<number>[-+]?(?:\d+\.\d*|\.\d+|\d+)(?:[eE][-+]?\d+)?)
+  | (?P<word>[A-Za-z_][A-Za-z0-9_]*)
+  | (?P<op>=>|[=(),;\[\]])
+""", re.VERBOSE | re.DOTALL)
+
+_DSTRING_ESCAPES = {'n': '\n', 't': '\t', 'r': '\r', 'v': '\v', 'f': '\f',
+                    '\\': '\\', '$': '$', '"': '"', '0': '\0'}
+
+
+class ConfigPhpError(ValueError):
+    """config.php contains something this parser does not understand."""
+
+
+def _tokenize(text):
+    pos = 0
+    tokens = []
+    while pos < len(text):
+        m = _TOKEN_RE.match(text, pos)
+        if not m:
+            raise ConfigPhpError("Unexpected input at offset {}: {!r}".format(
+                pos, text[pos:pos + 20]))
+        pos = m.end()
+        if m.lastgroup != 'space':
+            tokens.append((m.lastgroup, m.group()))
+    return tokens
+
+
+def _unquote(kind, raw):
+    body = raw[1:-1]
+    if kind == 'sstring':
+        return re.sub(r"\\([\\'])", r"\1", body)
+    return re.sub(r'\\(.)', lambda m: _DSTRING_ESCAPES.get(m.group(1), m.group()), body)
+
+
+class _Parser:
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.pos = 0
+
+    def peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return (None, None)
+
+    def next(self):
+        token = self.peek()
+        self.pos += 1
+        return token
+
+    def expect(self, value):
+        kind, got = self.next()
+        if got != value:
+            raise ConfigPhpError("Expected {!r}, got {!r}".format(value, got))
+
+    def value(self):
+        kind, raw = self.next()
+        if kind in ('sstring', 'dstring'):
+            return _unquote(kind, raw)
+        if kind == 'number':
+            return float(raw) if any(c in raw for c in '.eE') else int(raw)
+        if kind == 'word':
+            word = raw.lower()
+            if word == 'true':
+                return True
+            if word == 'false':
+                return False
+            if word == 'null':
+                return None
+            if word == 'array':
+                self.expect('(')
+                return self.array(')')
+        if raw == '[':
+            return self.array(']')
+        raise ConfigPhpError("Unsupported value {!r}".format(raw))
+
+    def array(self, closing):
+        items = []
+        next_index = 0
+        while self.peek()[1] != closing:
+            value = self.value()
+            if self.peek()[1] == '=>':
+                self.next()
+                key, value = value, self.value()
+                if isinstance(key, bool) or key is None or isinstance(key, float):
+                    raise ConfigPhpError("Unsupported array key {!r}".format(key))
+                if isinstance(key, str) and re.fullmatch(r'-?[1-9]\d*|0', key):
+                    # PHP casts numeric string keys to integers.
+                    key = int(key)
+            else:
+                key = next_index
+            if isinstance(key, int):
+                next_index = max(next_index, key + 1)
+            items.append((key, value))
+            if self.peek()[1] == ',':
+                self.next()
+            elif self.peek()[1] != closing:
+                raise ConfigPhpError("Expected ',' or {!r}, got {!r}".format(
+                    closing, self.peek()[1]))
+        self.next()
+        result = dict(items)
+        if list(result) == list(range(len(result))):
+            return list(result.values())
+        return result
+
+
+def loads(text) -> dict:
+    """
+    Parse the text of a config.php and return the $CONFIG array.
+    """
+    parser = _Parser(_tokenize(text))
+    if parser.peek()[0] == 'open_tag':
+        parser.next()
+    kind, name = parser.next()
+    if name != '$CONFIG':
+        raise ConfigPhpError("Expected $CONFIG assignment, got {!r}".format(name))
+    parser.expect('=')
+    config = parser.value()
+    parser.expect(';')
+    if isinstance(config, list):
+        config = dict(enumerate(config))
+    if not isinstance(config, dict):
+        raise ConfigPhpError("$CONFIG is not an array")
+    return config
+
+
+def _export(value, indent):
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if value is None:
+        return 'NULL'
+    if isinstance(value, (int, float)):
+        return repr(value)
+    if isinstance(value, str):
+        return "'" + value.replace('\\', '\\\\').replace("'", "\\'") + "'"
+    if isinstance(value, (list, tuple)):
+        value = dict(enumerate(value))
+    if isinstance(value, dict):
+        pad = '  ' * (indent + 1)
+        lines = ['array (']
+        for key, item in value.items():
+            exported = _export(item, indent + 1)
+            if exported.startswith('array ('):
+                # var_export() puts nested arrays on their own line.
+                exported = '\n' + pad + exported
+            lines.append('{}{} => {},'.format(pad, _export(key, indent), exported))
+        lines.append('  ' * indent + ')')
+        return '\n'.join(lines)
+    raise ConfigPhpError("Cannot export {!r} to PHP".format(value))
+
+
+def dumps(config) -> str:
+    """
+    Render a $CONFIG dict the way Nextcloud writes config.php.
+    """
+    return "<?php\n$CONFIG = " + _export(config, 0) + ";\n"
+
+
+def read_config(path=CONFIG_PHP) -> dict:
+    with open(path) as f:
+        return loads(f.read())
+
+
+def write_config(config, path=CONFIG_PHP) -> bool:
+    """
+    Atomically replace config.php with the given config.
+    :return: True if the file content changed.
+    """
+    return write_atomic(path, dumps(config))
+
+
+def get_trusted_domains(path=CONFIG_PHP) -> list:
+    domains = read_config(path).get('trusted_domains', [])
+    if isinstance(domains, dict):
+        domains = list(domains.values())
+    return domains
+
+
+def set_trusted_domains(domains, path=CONFIG_PHP) -> bool:
+    """
+    Replace the full trusted_domains list with one write.
+    :return: True if config.php changed.
+    """
+    config = read_config(path)
+    config['trusted_domains'] = list(domains)
+    return write_config(config, path)
+
+
+def _canonical(value):
+    if isinstance(value, dict):
+        return {str(k): _canonical(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_canonical(v) for v in value]
+    return value
+
+
+def config_hash(config) -> str:
+    """
+    Content hash of a config, independent of key order and of whether
+    array keys are ints or numeric strings (as after a JSON round trip).
+    """
+    canonical = json.dumps(_canonical(config), sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def diff(old, new) -> dict:
+    """
+    Top level keys that differ between two configs.
+    :return: {'set': {key: new value}, 'unset': [removed keys]}
+    """
+    old, new = _canonical(old), _canonical(new)
+    return {'set': {k: v for k, v in new.items() if k not in old or old[k] != v},
+            'unset': [k for k in old if k not in new]}
+
+
+def patch(config, changes) -> dict:
+    """
+    Apply a diff() to a config.
+    """
+    config = _canonical(config)
+    for key in changes.get('unset', []):
+        config.pop(key, None)
+    config.update(changes.get('set', {}))
+    return config
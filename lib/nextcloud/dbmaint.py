@@ -0,0 +1,245 @@
+"""
+PostgreSQL maintenance of the busiest nextcloud tables.
+
+Connects with psql using the database settings of config.php, so it
+works on every unit and needs no credentials of its own. Run as
+python3 -m nextcloud.dbmaint from the maintenance timer or a job:
+tables are vacuumed (and optionally reindexed) when their share of
+dead rows is above a threshold, until the maintenance window closes.
+"""
+import argparse
+import logging
+import os
+import re
+import sys
+import time
+
+from nextcloud import config_php
+from nextcloud.telemetry import sp
+
+logger = logging.getLogger(__name__)
+
+PSQL = ['psql']
+# Tables, without the dbtableprefix, that grow and churn the most.
+MAINT_TABLES = ['filecache', 'activity', 'authtoken']
+# REINDEX CONCURRENTLY needs PostgreSQL 12.
+REINDEX_CONCURRENTLY_VERSION = 120000
+
+_TABLE_NAME = re.compile(r'^[a-z_][a-z0-9_]*$')
+_WINDOW = re.compile(r'^(\d{1,2}):(\d{2})-(\d{1,2}):(\d{2})$')
+
+
+class DatabaseError(Exception):
+    """A psql statement failed."""
+
+
+def parse_window(text):
+    """
+    Parse a daily maintenance window, e.g. "02:00-04:30".
+    :return: (start "HH:MM", length in minutes), None for an empty text.
+    :raises ValueError: if text is not a valid window.
+    """
+    if not text or not text.strip():
+        return None
+    match = _WINDOW.match(text.strip())
+    if not match:
+        raise ValueError(f"Invalid maintenance window {text!r}, expected HH:MM-HH:MM")
+    start_h, start_m, end_h, end_m = (int(g) for g in match.groups())
+    if start_h > 23 or end_h > 23 or start_m > 59 or end_m > 59:
+        raise ValueError(f"Invalid maintenance window {text!r}, expected HH:MM-HH:MM")
+    minutes = (end_h * 60 + end_m - start_h * 60 - start_m) % (24 * 60)
+    if not minutes:
+        raise ValueError(f"Maintenance window {text!r} is empty")
+    return f"{start_h:02d}:{start_m:02d}", minutes
+
+
+def check_tables(tables):
+    """
+    :raises ValueError: on anything that is not a plain table name, the
+                        names are used in SQL statements.
+    """
+    for table in tables:
+        if not _TABLE_NAME.match(table):
+            raise ValueError(f"Invalid table name {table!r}")
+    return list(tables)
+
+
+def split_dbhost(dbhost):
+    """
+    Split a config.php dbhost into what psql takes as -h and -p:
+    host, host:port, [ipv6]:port, a bare IPv6 address, host:/socket/dir
+    and /socket/dir (or the .s.PGSQL.<port> socket file in it).
+    :return: (host or socket directory, port or None)
+    """
+    if dbhost.startswith('['):
+        host, _, rest = dbhost[1:].partition(']')
+        port = rest[1:] if rest.startswith(':') else ''
+        return host, port or None
+    host, sep, port = dbhost.rpartition(':')
+    if sep and ':' in host and not port.startswith('/'):
+        # A bare IPv6 address, it has no port.
+        return dbhost, None
+    if not sep:
+        host, port = dbhost, ''
+    if port.startswith('/'):
+        host, port = port, ''
+    if host.startswith('/'):
+        directory, name = os.path.split(host)
+        if name.startswith('.s.PGSQL.'):
+            return directory, name[len('.s.PGSQL.'):]
+    return host, port or None
+
+
+class Database:
+    """
+    psql connection settings of the nextcloud database.
+    """
+
+    def __init__(self, host, port, dbname, user, password, prefix='oc_'):
+        self.host = host
+        self.port = port
+        self.dbname = dbname
+        self.user = user
+        self.password = password
+        self.prefix = prefix
+
+    @classmethod
+    def from_config(cls, path=config_php.CONFIG_PHP):
+        """
+        Connection settings from nextcloud's config.php.
+        """
+        config = config_php.read_config(path)
+        if config.get('dbtype') != 'pgsql':
+            raise DatabaseError(f"Not a PostgreSQL database: {config.get('dbtype')}")
+        host, port = split_dbhost(config['dbhost'])
+        return cls(host, port or config.get('dbport') or '5432', config['dbname'],
+                   config['dbuser'], config.get('dbpassword', ''),
+                   config.get('dbtableprefix', 'oc_'))
+
+    def tables(self) -> list:
+        return [self.prefix + table for table in MAINT_TABLES]
+
+    def query(self, sql, timeout=None) -> list:
+        """
+        Run one statement, outside of a transaction.
+        :param timeout: statement_timeout in seconds, at least 1ms as
+                        statement_timeout=0 means no limit
+        :return: result rows, as tuples of strings
+        """
+        env = dict(os.environ, PGPASSWORD=self.password, PGCONNECT_TIMEOUT='10')
+        if timeout is not None:
+            env['PGOPTIONS'] = f"-c statement_timeout={max(1, int(timeout * 1000))}"
+        cmd = PSQL + ['-X', '-q', '-A', '-t', '-F', '\t', '-v', 'ON_ERROR_STOP=1',
+                      '-h', self.host, '-p', str(self.port), '-U', self.user, '-d', self.dbname,
+                      '-c', sql]
+        output = sp.run(cmd, env=env, stdout=sp.PIPE, stderr=sp.PIPE, universal_newlines=True)
+        if output.returncode != 0:
+            raise DatabaseError(output.stderr.strip() or f"psql exited with {output.returncode}")
+        return [tuple(line.split('\t')) for line in output.stdout.splitlines() if line]
+
+    def server_version(self) -> int:
+        return int(self.query('SHOW server_version_num')[0][0])
+
+
+def _in_list(tables):
+    return ', '.join(f"'{t}'" for t in check_tables(tables))
+
+
+def bloat_report(db, tables=None) -> dict:
+    """
+    Size and dead row share of tables and the size and use of their
+    indexes, from the statistics collector (no table scans).
+    :return: {table: {live_rows, dead_rows, dead_ratio, table_bytes, index_bytes,
+                      last_vacuum, last_analyze, indexes: {name: {bytes, scans}}}}
+    """
+    tables = tables or db.tables()
+    report = {}
+    for name, live, dead, table_bytes, index_bytes, last_vacuum, last_analyze in db.query(
+            "SELECT relname, n_live_tup, n_dead_tup, "
+            "pg_table_size(relid), pg_indexes_size(relid), "
+            "coalesce(greatest(last_vacuum, last_autovacuum)::text, ''), "
+            "coalesce(greatest(last_analyze, last_autoanalyze)::text, '') "
+            f"FROM pg_stat_user_tables WHERE relname IN ({_in_list(tables)}) ORDER BY relname"):
+        live, dead = int(live), int(dead)
+        report[name] = {'live_rows': live, 'dead_rows': dead,
+                        'dead_ratio': round(dead / (live + dead), 3) if live + dead else 0.0,
+                        'table_bytes': int(table_bytes), 'index_bytes': int(index_bytes),
+                        'last_vacuum': last_vacuum or None, 'last_analyze': last_analyze or None,
+                        'indexes': {}}
+    for table, index, index_bytes, scans in db.query(
+            "SELECT relname, indexrelname, pg_relation_size(indexrelid), idx_scan "
+            f"FROM pg_stat_user_indexes WHERE relname IN ({_in_list(tables)}) "
+            "ORDER BY relname, indexrelname"):
+        if table in report:
+            report[table]['indexes'][index] = {'bytes': int(index_bytes), 'scans': int(scans)}
+    return report
+
+
+def _drop_invalid_indexes(db, table):
+    """
+    A cancelled REINDEX CONCURRENTLY leaves invalid *_ccnew indexes behind.
+    """
+    for index, in db.query(
+            "SELECT c.relname FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+            f"WHERE i.indrelid = '{check_tables([table])[0]}'::regclass AND NOT i.indisvalid "
+            "AND c.relname LIKE '%\\_ccnew%'"):
+        db.query(f'DROP INDEX CONCURRENTLY IF EXISTS "{index}"')
+
+
+def maintain(db, tables=None, threshold=0.0, reindex=False, minutes=None) -> list:
+    """
+    VACUUM (ANALYZE), and with reindex REINDEX CONCURRENTLY, the tables
+    whose dead row share is at least threshold. Neither blocks nextcloud.
+    :param minutes: stop when this many minutes have passed, statements
+                    still running then are cancelled.
+    :return: list of (table, action, outcome)
+    """
+    deadline = time.monotonic() + minutes * 60 if minutes else None
+    report = bloat_report(db, tables)
+    if reindex and db.server_version() < REINDEX_CONCURRENTLY_VERSION:
+        logger.warning("REINDEX CONCURRENTLY needs PostgreSQL 12, not reindexing.")
+        reindex = False
+    done = []
+    for table, stats in sorted(report.items(), key=lambda kv: -kv[1]['dead_rows']):
+        if stats['dead_ratio'] < threshold:
+            done.append((table, 'vacuum', 'skipped'))
+            continue
+        actions = [('vacuum', f"VACUUM (ANALYZE) {table}")]
+        if reindex:
+            actions.append(('reindex', f"REINDEX TABLE CONCURRENTLY {table}"))
+        for action, sql in actions:
+            timeout = deadline - time.monotonic() if deadline else None
+            if timeout is not None and timeout <= 0:
+                done.append((table, action, 'window closed'))
+                continue
+            logger.info("%s", sql)
+            try:
+                db.query(sql, timeout=timeout)
+                done.append((table, action, 'done'))
+            except DatabaseError as e:
+                logger.error("%s failed: %s", sql, e)
+                done.append((table, action, f"failed: {e}"))
+                if action == 'reindex':
+                    _drop_invalid_indexes(db, table)
+    return done
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Vacuum and reindex nextcloud tables")
+    parser.add_argument('--config', default=config_php.CONFIG_PHP)
+    parser.add_argument('--tables', nargs='*', help="default: the busiest nextcloud tables")
+    parser.add_argument('--threshold', type=float, default=0.0,
+                        help="only tables with at least this share of dead rows")
+    parser.add_argument('--reindex', action='store_true')
+    parser.add_argument('--minutes', type=int, help="length of the maintenance window")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    db = Database.from_config(args.config)
+    done = maintain(db, args.tables, args.threshold, args.reindex, args.minutes)
+    for row in done:
+        print('\t'.join(row))
+    return 1 if any(outcome.startswith('failed') for _, _, outcome in done) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,225 @@
+"""
+Long running occ (and other) commands as background jobs.
+
+A job runs in a transient systemd unit (systemd-run), so it is not bound
+to the hook or action that started it and survives hook timeouts. The
+unit runs this module (python3 -m nextcloud.jobs <job id>), which writes
+the command output to the job log and its state to a JSON file next to it.
+Stopping the unit cancels the job. Maintenance mode, when the job needs
+it, is switched off again however the job ends.
+"""
+import json
+import logging
+import os
+import secrets
+import signal
+import sys
+import time
+
+from nextcloud.occ import Occ, OCC_CMD, NEXTCLOUD_ROOT
+from nextcloud.telemetry import sp
+
+logger = logging.getLogger(__name__)
+
+JOBS_DIR = '/var/lib/nextcloud-charm/jobs'
+UNIT_PREFIX = 'nextcloud-job-'
+# Seconds occ gets to exit after a cancel, before systemd kills it.
+STOP_TIMEOUT = 60
+
+STARTING = 'starting'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+# The unit is gone without the runner recording how the job ended.
+LOST = 'lost'
+ACTIVE = (STARTING, RUNNING)
+
+
+class JobError(Exception):
+    """A job could not be started or found."""
+
+
+class _Cancelled(Exception):
+    pass
+
+
+def state_path(job_id) -> str:
+    return os.path.join(JOBS_DIR, f"{job_id}.json")
+
+
+def log_path(job_id) -> str:
+    return os.path.join(JOBS_DIR, f"{job_id}.log")
+
+
+def unit_name(job_id) -> str:
+    return f"{UNIT_PREFIX}{job_id}.service"
+
+
+def read_state(job_id) -> dict:
+    try:
+        with open(state_path(job_id)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        raise JobError(f"No job {job_id}")
+
+
+def _create_state(job_id, **fields):
+    """
+    :raises JobError: if a job with this id exists already
+    """
+    try:
+        with open(state_path(job_id), 'x') as f:
+            json.dump(dict(fields, id=job_id), f)
+    except FileExistsError:
+        raise JobError(f"Job {job_id} exists already")
+
+
+def _update_state(job_id, **fields) -> dict:
+    try:
+        state = read_state(job_id)
+    except JobError:
+        state = {'id': job_id}
+    state.update(fields)
+    tmp = state_path(job_id) + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp, state_path(job_id))
+    return state
+
+
+def list_jobs() -> list:
+    """
+    :return: states of all jobs, oldest first.
+    """
+    try:
+        names = os.listdir(JOBS_DIR)
+    except FileNotFoundError:
+        return []
+    jobs = [status(name[:-len('.json')]) for name in names if name.endswith('.json')]
+    return sorted(jobs, key=lambda job: job.get('started', 0))
+
+
+def occ(*args) -> list:
+    """
+    :return: command line running an occ command, for start().
+    """
+    return OCC_CMD + list(args)
+
+
+def _unit_active(job_id) -> bool:
+    return sp.call(['systemctl', 'is-active', '--quiet', unit_name(job_id)]) == 0
+
+
+def start(name, commands, maintenance=False) -> str:
+    """
+    Start commands as a background job, run one after the other until
+    one fails.
+    :param name: kind of job, only one job of a kind runs at a time
+    :param commands: list of command lines, see occ()
+    :param maintenance: keep nextcloud in maintenance mode while it runs
+    :return: job id
+    :raises JobError: if a job of this kind is running already
+    """
+    for job in list_jobs():
+        if job.get('name') == name and job['status'] in ACTIVE:
+            raise JobError(f"Job {job['id']} is still {job['status']}")
+    # The suffix keeps jobs started in the same second apart.
+    job_id = f"{name}-{time.strftime('%Y%m%d%H%M%S')}-{secrets.token_hex(2)}"
+    os.makedirs(JOBS_DIR, exist_ok=True)
+    _create_state(job_id, name=name, commands=[list(c) for c in commands],
+                  maintenance=maintenance, status=STARTING, started=time.time())
+    pythonpath = os.pathsep.join(p for p in sys.path if p)
+    sp.check_call(['systemd-run', '--unit', unit_name(job_id), '--collect',
+                   '--property=KillMode=mixed', f"--property=TimeoutStopSec={STOP_TIMEOUT * 2}",
+                   f"--setenv=PYTHONPATH={pythonpath}",
+                   sys.executable, '-m', 'nextcloud.jobs', job_id])
+    logger.info("Started job %s: %s", job_id, '; '.join(' '.join(c) for c in commands))
+    return job_id
+
+
+def status(job_id, tail=10) -> dict:
+    """
+    :return: job state, with the last lines of its log.
+    """
+    state = read_state(job_id)
+    if state['status'] in ACTIVE and not _unit_active(job_id):
+        # The runner was killed before it could record the outcome,
+        # maintenance mode may still be on.
+        state = _update_state(job_id, status=LOST)
+    try:
+        with open(log_path(job_id), errors='replace') as f:
+            state['log_tail'] = ''.join(f.readlines()[-tail:])
+    except FileNotFoundError:
+        state['log_tail'] = ''
+    return state
+
+
+def cancel(job_id) -> dict:
+    """
+    Stop a running job. The runner terminates occ and, if needed, ends
+    maintenance mode before the unit stops.
+    :return: job state
+    """
+    state = read_state(job_id)
+    if state['status'] in ACTIVE:
+        sp.call(['systemctl', 'stop', unit_name(job_id)])
+    return status(job_id)
+
+
+def run(job_id) -> int:
+    """
+    Run a job in this process, the entry point of the job unit.
+    :return: exit code of the last command run, None if none ran.
+    """
+    state = read_state(job_id)
+
+    def on_term(signum, frame):
+        raise _Cancelled()
+    previous = signal.signal(signal.SIGTERM, on_term)
+    returncode = None
+    proc = None
+    in_maintenance = False
+    try:
+        with open(log_path(job_id), 'a') as log:
+            try:
+                if state['maintenance']:
+                    output = Occ.maintenance_mode(enable=True)
+                    if output.returncode != 0:
+                        # Never run the commands against a live instance.
+                        raise RuntimeError(f"occ maintenance:mode --on failed: {output.stdout}")
+                    in_maintenance = True
+                for command in state['commands']:
+                    log.write(f"$ {' '.join(command)}\n")
+                    log.flush()
+                    proc = sp.Popen(command, cwd=NEXTCLOUD_ROOT, stdout=log, stderr=sp.STDOUT)
+                    _update_state(job_id, status=RUNNING, pid=proc.pid)
+                    returncode = proc.wait()
+                    if returncode != 0:
+                        break
+                outcome = SUCCEEDED if returncode == 0 else FAILED
+            except _Cancelled:
+                outcome = CANCELLED
+                if proc is not None:
+                    proc.terminate()
+                    try:
+                        returncode = proc.wait(timeout=STOP_TIMEOUT)
+                    except sp.TimeoutExpired:
+                        proc.kill()
+                        returncode = proc.wait()
+                log.write("Cancelled\n")
+            except Exception as e:
+                outcome = FAILED
+                log.write(f"{type(e).__name__}: {e}\n")
+            finally:
+                signal.signal(signal.SIGTERM, signal.SIG_IGN)
+                if in_maintenance:
+                    Occ.maintenance_mode(enable=False)
+        _update_state(job_id, status=outcome, returncode=returncode, finished=time.time())
+    finally:
+        signal.signal(signal.SIGTERM, previous)
+    return returncode
+
+
+if __name__ == '__main__':
+    sys.exit(0 if run(sys.argv[1]) == 0 else 1)
@@ -2,44 +2,201 @@ import subprocess as sp
 import logging
 import json
 import sys
+from contextlib import contextmanager
+
+from nextcloud import config_php, telemetry
 
 logger = logging.getLogger(__name__)
 
+NEXTCLOUD_ROOT = '/var/www/nextcloud'
+
+OCC_CMD = ['sudo', '-u', 'www-data', 'php', NEXTCLOUD_ROOT + '/occ']
+
+# Boots Nextcloud once and runs every occ command read (as a JSON list of
+# argument lists) from stdin inside the same console application.
+# Prints one JSON line per command (returncode and captured output) as soon
+# as it ends, so when the runner dies the commands that already ran are known.
+# The application is built by the container rather than by its constructor.
+# Its inner symfony application is private and exits after the first command
+# unless auto exit is turned off, which is what the reflection is for.
+OCC_BATCH_PHP = r"""
+require_once 'lib/base.php';
+$application = \OC::$server->query(\OC\Console\Application::class);
+$application->loadCommands(new \Symfony\Component\Console\Input\ArrayInput([]),
+                           new \Symfony\Component\Console\Output\NullOutput());
+$inner = new \ReflectionProperty($application, 'application');
+$inner->setAccessible(true);
+$console = $inner->getValue($application);
+$console->setAutoExit(false);
+foreach (json_decode(stream_get_contents(STDIN), true) as $args) {
+    $output = new \Symfony\Component\Console\Output\BufferedOutput();
+    $input = new \Symfony\Component\Console\Input\ArgvInput(array_merge(['occ'], $args));
+    $returncode = $console->run($input, $output);
+    echo json_encode(['returncode' => $returncode, 'stdout' => $output->fetch()]), "\n";
+    flush();
+}
+"""
+
+
+class OccBatch:
+    """
+    Collects occ commands and runs them in a single PHP bootstrap.
+    Falls back to one occ process per command if the batch runner fails.
+    """
+
+    def __init__(self):
+        self.commands = []
+
+    def add(self, args):
+        self.commands.append(list(args))
+
+    def flush(self):
+        """
+        Run all queued commands.
+        :return: list of CompletedProcess, one per command.
+        """
+        commands, self.commands = self.commands, []
+        if not commands:
+            return []
+        if len(commands) == 1:
+            return [Occ._spawn(commands[0])]
+        cmd = ['sudo', '-u', 'www-data', 'php', '-r', OCC_BATCH_PHP]
+        with telemetry.timed(telemetry.OCC, 'batch', commands=len(commands)) as extra:
+            output = sp.run(cmd, cwd=NEXTCLOUD_ROOT, input=json.dumps(commands),
+                            stdout=sp.PIPE, universal_newlines=True)
+            extra['returncode'] = output.returncode
+        done = [sp.CompletedProcess(OCC_CMD + args, r['returncode'], stdout=r['stdout'])
+                for args, r in zip(commands, self._parse_results(output.stdout))]
+        if len(done) < len(commands):
+            # Only rerun what the batch did not get to, the rest is applied.
+            logger.warning("occ batch runner failed (%d), running the last %d of %d commands "
+                           "one by one.", output.returncode, len(commands) - len(done),
+                           len(commands))
+            done += [Occ._spawn(args) for args in commands[len(done):]]
+        return done
+
+    @staticmethod
+    def _parse_results(stdout):
+        """
+        :return: results of the commands the batch runner finished, in order.
+        """
+        results = []
+        for line in stdout.splitlines():
+            try:
+                result = json.loads(line)
+            except ValueError:
+                # php warnings and errors can be printed between the results
+                continue
+            if isinstance(result, dict) and 'returncode' in result:
+                results.append(result)
+        return results
+
 
 class Occ:
 
+    # Active OccBatch while inside Occ.batch(), otherwise None.
+    _batch = None
+
+    @staticmethod
+    @contextmanager
+    def batch():
+        """
+        Context manager that defers occ commands whose output is not used
+        and runs them together in one PHP bootstrap when the block exits,
+        or before the next command that needs its output.
+
+            with Occ.batch():
+                Occ.config_system_delete_trusted_domains()
+                Occ.config_system_set_trusted_domains('localhost', 0)
+        """
+        if Occ._batch is not None:
+            # Nested batches join the outer one.
+            yield Occ._batch
+            return
+        Occ._batch = OccBatch()
+        try:
+            yield Occ._batch
+        finally:
+            batch, Occ._batch = Occ._batch, None
+            batch.flush()
+
+    @staticmethod
+    def _spawn(args, capture=True):
+        """
+        Run a single occ command in its own php process.
+        """
+        kwargs = {'stdout': sp.PIPE, 'universal_newlines': True} if capture else {}
+        with telemetry.timed(telemetry.OCC, args[0]) as extra:
+            output = sp.run(OCC_CMD + list(args), cwd=NEXTCLOUD_ROOT, **kwargs)
+            extra['returncode'] = output.returncode
+            extra['output_bytes'] = len(output.stdout or '')
+        return output
+
+    @staticmethod
+    def _run(args, capture=False):
+        """
+        Run an occ command, or queue it when a batch is active and
+        the caller does not need the output.
+        """
+        if Occ._batch is not None:
+            if not capture:
+                Occ._batch.add(args)
+                return None
+            # Keep ordering: queued commands must run before this one.
+            Occ._batch.flush()
+        return Occ._spawn(args, capture=capture)
+
     @staticmethod
     def config_system_set_trusted_domains(domain, index):
         """
         Adds a trusted domain to nextcloud config.php with occ
         """
-
-        cmd = ("sudo -u www-data php /var/www/nextcloud/occ config:system:set"
-               " trusted_domains {index}"
-               " --value={domain} ").format(index=index, domain=domain)
-        sp.call(cmd.split(), cwd='/var/www/nextcloud')
+        Occ._run(['config:system:set', 'trusted_domains', str(index),
+                  '--value={}'.format(domain)])
 
     @staticmethod
     def remove_trusted_domain(domain):
         """
-        Removes a trusted domain from nextcloud with occ
+        Removes a trusted domain from nextcloud.
+        Rewrites the trusted_domains list in config.php in one atomic
+        write, so indices stay in order starting from 0.
         """
-        current_domains = Occ.config_system_get_trusted_domains()
+        current_domains = Occ._get_trusted_domains()
         if domain in current_domains:
             current_domains.remove(domain)
-            # First delete all trusted domains from config.php
-            # since they might have indices not in order.
-            Occ.config_system_delete_trusted_domains()
-            if current_domains:
-                # Now, add all the domains with indices in order starting from 0
-                for index, domain in enumerate(current_domains):
-                    Occ.config_system_set_trusted_domains(domain, index)
+            Occ._set_trusted_domains(current_domains)
+
+    @staticmethod
+    def _get_trusted_domains():
+        """
+        Trusted domains read from config.php, with occ if the file can not
+        be parsed (e.g. after editing it by hand).
+        """
+        try:
+            return config_php.get_trusted_domains()
+        except config_php.ConfigPhpError as e:
+            logger.warning("Could not parse config.php (%s), using occ for trusted_domains", e)
+            return Occ.config_system_get_trusted_domains()
+
+    @staticmethod
+    def _set_trusted_domains(domains):
+        """
+        Writes the trusted domains to config.php, with occ if the file can
+        not be parsed.
+        """
+        try:
+            config_php.set_trusted_domains(domains)
+            return
+        except config_php.ConfigPhpError as e:
+            logger.warning("Could not parse config.php (%s), using occ for trusted_domains", e)
+        # Delete first, the existing indices might not be in order.
+        Occ.config_system_delete_trusted_domains()
+        for index, domain in enumerate(domains):
+            Occ.config_system_set_trusted_domains(domain, index)
 
     @staticmethod
     def config_system_delete_trusted_domains():
-        cmd = "sudo -u www-data php /var/www/nextcloud/occ \
-                                  config:system:delete trusted_domains"
-        sp.run(cmd.split(), cwd='/var/www/nextcloud')
+        Occ._run(['config:system:delete', 'trusted_domains'])
 
     @staticmethod
     def config_system_get_trusted_domains():
@@ -47,45 +204,34 @@ class Occ:
         Get all current trusted domains in config.php with occ
         return list
         """
-        cmd = "sudo -u www-data php /var/www/nextcloud/occ \
-                           config:system:get trusted_domains"
-        output = sp.run(cmd.split(), cwd='/var/www/nextcloud',
-                        stdout=sp.PIPE, universal_newlines=True)
+        output = Occ._run(['config:system:get', 'trusted_domains'], capture=True)
         domains = output.stdout.split()
         return domains
 
     @staticmethod
     def update_trusted_domains_peer_ips(domains):
-        current_domains = Occ.config_system_get_trusted_domains()
+        """
+        Writes the trusted domains directly to config.php in one atomic
+        write instead of one occ call per index.
+        """
+        current_domains = Occ._get_trusted_domains()
         # Copy 'localhost' and fqdn but replace all peers IP:s
         # with the ones currently available in the relation.
         new_domains = current_domains[0:2] + domains[:]
-        Occ.config_system_delete_trusted_domains()
-        for index, d in enumerate(new_domains):
-            Occ.config_system_set_trusted_domains(d, index)
+        Occ._set_trusted_domains(new_domains)
 
     @staticmethod
     def db_add_missing_indices():
-        cmd = "sudo -u www-data php /var/www/nextcloud/occ db:add-missing-indices"
-        output = sp.run(cmd.split(), cwd='/var/www/nextcloud',
-                        stdout=sp.PIPE, universal_newlines=True)
-        return output
+        return Occ._run(['db:add-missing-indices'], capture=True)
 
     @staticmethod
     def db_convert_filecache_bigint():
-        cmd = "sudo -u www-data php /var/www/nextcloud/occ \
-               db:convert-filecache-bigint --no-interaction"
-        output = sp.run(cmd.split(), cwd='/var/www/nextcloud',
-                        stdout=sp.PIPE, universal_newlines=True)
-        return output
+        return Occ._run(['db:convert-filecache-bigint', '--no-interaction'], capture=True)
 
     @staticmethod
     def maintenance_mode(enable):
         m = "--on" if enable else "--off"
-        cmd = f"sudo -u www-data php /var/www/nextcloud/occ maintenance:mode {m}"
-        output = sp.run(cmd.split(), cwd='/var/www/nextcloud',
-                        stdout=sp.PIPE, universal_newlines=True)
-        return output
+        return Occ._run(['maintenance:mode', m], capture=True)
 
     @staticmethod
     def maintenance_install(ctx):
@@ -93,25 +239,39 @@ class Occ:
         Initializes nextcloud via the nextcloud occ interface.
         :return:
         """
-        cmd = ("sudo -u www-data /usr/bin/php occ maintenance:install "
+        cmd = ("maintenance:install "
                "--database {dbtype} --database-name {dbname} "
                "--database-host {dbhost} --database-pass {dbpass} "
                "--database-user {dbuser} --admin-user {adminusername} "
                "--admin-pass {adminpassword} "
                "--data-dir {datadir} ").format(**ctx)
-        sp.call(cmd.split(), cwd='/var/www/nextcloud')
+        Occ._run(cmd.split())
+
+    @staticmethod
+    def background_jobs_mode(mode):
+        """
+        Sets how background jobs are run: ajax, webcron or cron.
+        """
+        return Occ._run([f"background:{mode}"], capture=True)
+
+    @staticmethod
+    def app_enable(app):
+        """
+        Enables an app, installing it from the app store if needed.
+        """
+        output = Occ._run(['app:enable', app], capture=True)
+        if output.returncode != 0:
+            output = Occ._run(['app:install', app], capture=True)
+        return output
 
     @staticmethod
     def status() -> dict:
         """
         Return dict with nextcloud status.
         """
-        cmd = "sudo -u www-data /usr/bin/php occ status --output=json --no-warnings"
         try:
-            output = sp.run(cmd.split(),
-                            stdout=sp.PIPE,
-                            cwd='/var/www/nextcloud',
-                            universal_newlines=True).stdout
+            output = Occ._run(['status', '--output=json', '--no-warnings'],
+                              capture=True).stdout
             returndict = json.loads(output.split()[-1])
         except sp.CalledProcessError as e:
             print(e)
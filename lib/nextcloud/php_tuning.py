@@ -0,0 +1,209 @@
+"""
+Size PHP OPcache, APCu and realpath cache settings, and the php-fpm
+pool, for the host.
+
+The cache values are derived from the host memory and the number of php
+files in the nextcloud tree, so that the whole code base fits in the
+opcache with room for apps and upgrades. Any value can be overridden from
+config.
+"""
+import os
+import re
+
+# opcache rounds max_accelerated_files up to the next of these primes, and
+# caps it at OPCACHE_MAX_FILES. The prime above that (1048793) is never used.
+OPCACHE_PRIMES = (223, 463, 983, 1979, 3907, 7963, 16229, 32531, 65407,
+                  130987, 262237, 524521)
+OPCACHE_MAX_FILES = 1000000
+
+# Approximate opcache memory used per cached php file (bytes).
+OPCACHE_BYTES_PER_FILE = 16 * 1024
+
+# Files in the php blacklist are never cached. The charm writes config/*.php
+# directly, so they must be read from disk even with validate_timestamps=0.
+OPCACHE_BLACKLIST = ['/var/www/nextcloud/config/*.php']
+
+_OVERRIDE_RE = re.compile(r'^([A-Za-z_][A-Za-z0-9_.]*)\s*=\s*(.*)$')
+
+MB = 1024 * 1024
+
+# Memory kept free for the OS, apache, redis etc. when sizing php-fpm.
+FPM_RESERVED_FRACTION = 0.25
+FPM_MAX_CHILDREN_LIMIT = 512
+FPM_PM_MODES = ('static', 'dynamic', 'ondemand')
+
+
+def host_memory() -> int:
+    """
+    :return: total memory of the host in bytes
+    """
+    with open('/proc/meminfo') as f:
+        for line in f:
+            if line.startswith('MemTotal:'):
+                return int(line.split()[1]) * 1024
+    raise RuntimeError("MemTotal not found in /proc/meminfo")
+
+
+def cpu_count() -> int:
+    return os.cpu_count() or 1
+
+
+def count_php_files(root='/var/www/nextcloud', skip=('data',)) -> int:
+    """
+    Count the .php files below root. Top level entries in skip
+    (the data directory, which may be large shared storage) are not scanned.
+    """
+    count = 0
+    stack = [root]
+    while stack:
+        path = stack.pop()
+        try:
+            entries = list(os.scandir(path))
+        except FileNotFoundError:
+            continue
+        for entry in entries:
+            if path == root and entry.name in skip:
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                stack.append(entry.path)
+            elif entry.name.endswith('.php'):
+                count += 1
+    return count
+
+
+def _clamp(value, low, high):
+    return max(low, min(value, high))
+
+
+def _next_prime(count):
+    for prime in OPCACHE_PRIMES:
+        if prime >= count:
+            return prime
+    return OPCACHE_MAX_FILES
+
+
+def tune(memory, php_files, php_version='7.4', production=False) -> dict:
+    """
+    Compute the php.ini settings for the given host.
+    :param memory: host memory in bytes
+    :param php_files: number of php files in the nextcloud tree
+    :param php_version: X.Y, JIT is only configured for php >= 8.0
+    :param production: cache code without checking timestamps
+    :return: dict of ini setting -> value, in a stable order
+    """
+    memory_mb = memory // MB
+    # Room for twice the current tree: apps, and old and new code during upgrades.
+    files = max(php_files * 2, 10000)
+    opcache_mb = _clamp(files * OPCACHE_BYTES_PER_FILE // MB, 128, max(128, memory_mb // 16))
+    opcache_mb = min(opcache_mb, 1024)
+    settings = {
+        'opcache.enable': 1,
+        'opcache.memory_consumption': opcache_mb,
+        'opcache.interned_strings_buffer': _clamp(opcache_mb // 8, 8, 64),
+        'opcache.max_accelerated_files': _next_prime(files),
+        'opcache.save_comments': 1,
+    }
+    if production:
+        settings['opcache.validate_timestamps'] = 0
+        settings['opcache.revalidate_freq'] = 0
+    else:
+        settings['opcache.validate_timestamps'] = 1
+        settings['opcache.revalidate_freq'] = 1
+    if tuple(int(v) for v in php_version.split('.')[:2]) >= (8, 0):
+        settings['opcache.jit'] = 1255
+        settings['opcache.jit_buffer_size'] = '{}M'.format(_clamp(memory_mb // 256, 32, 256))
+    settings['apc.shm_size'] = '{}M'.format(_clamp(memory_mb // 64, 32, 512))
+    # APCu is the local memcache, occ and cron run nextcloud from the cli.
+    settings['apc.enable_cli'] = 1
+    # Reuse persistent redis connections across requests in a php process.
+    settings['redis.pconnect.pooling_enabled'] = 1
+    # Every php file and the directories above it end up in the realpath cache.
+    settings['realpath_cache_size'] = '{}K'.format(_clamp(php_files // 4, 4096, 65536))
+    settings['realpath_cache_ttl'] = 600 if production else 120
+    return settings
+
+
+def parse_overrides(text) -> dict:
+    """
+    Parse php.ini style overrides, one "key = value" per line.
+    Empty lines and lines starting with ';' or '#' are ignored.
+    """
+    overrides = {}
+    for line in (text or '').splitlines():
+        line = line.strip()
+        if not line or line[0] in ';#':
+            continue
+        m = _OVERRIDE_RE.match(line)
+        if not m:
+            raise ValueError("Invalid php ini override: {!r}".format(line))
+        overrides[m.group(1)] = m.group(2).strip()
+    return overrides
+
+
+def parse_size(value) -> int:
+    """
+    Parse a php.ini size (e.g. '512M', '1G', '-1') into bytes.
+    -1 (no limit) is returned as -1.
+    """
+    value = str(value).strip()
+    m = re.fullmatch(r'(-?\d+)\s*([KkMmGg]?)', value)
+    if not m:
+        raise ValueError("Invalid php size: {!r}".format(value))
+    number = int(m.group(1))
+    if number < 0:
+        return -1
+    return number * {'': 1, 'k': 1024, 'm': MB, 'g': 1024 * MB}[m.group(2).lower()]
+
+
+def _cache_bytes(settings):
+    """
+    Shared memory used by opcache and apcu with the given settings.
+    """
+    total = int(settings.get('opcache.memory_consumption', 128)) * MB
+    total += int(settings.get('opcache.interned_strings_buffer', 8)) * MB
+    total += parse_size(settings.get('apc.shm_size', '32M'))
+    jit = settings.get('opcache.jit_buffer_size')
+    if jit:
+        total += parse_size(jit)
+    return total
+
+
+def fpm_pool(memory, cpus, memory_limit, settings=None, pm='auto', max_requests=500) -> dict:
+    """
+    Size the php-fpm pool so that all children fit in memory.
+    php_memory_limit is the ceiling for a single request; most requests
+    use a fraction of it, so a child is budgeted a quarter of the limit
+    (at least 64M).
+    :param memory: host memory in bytes
+    :param cpus: number of cpus
+    :param memory_limit: php memory_limit, e.g. '1G'
+    :param settings: php settings from tune(), their caches are
+                     subtracted from the memory available to children
+    :param pm: 'static', 'dynamic', 'ondemand' or 'auto'
+    :return: dict of pool setting -> value
+    """
+    if pm not in FPM_PM_MODES + ('auto',):
+        raise ValueError("Invalid php-fpm pm: {!r}".format(pm))
+    limit = parse_size(memory_limit)
+    if limit < 0:
+        limit = 1024 * MB
+    per_child = max(64 * MB, limit // 4)
+    available = memory * (1 - FPM_RESERVED_FRACTION) - _cache_bytes(settings or {})
+    max_children = _clamp(int(available // per_child), 2, FPM_MAX_CHILDREN_LIMIT)
+    if pm == 'auto':
+        # Small hosts only keep workers around while there is traffic.
+        pm = 'ondemand' if memory < 2048 * MB else 'dynamic'
+    pool = {
+        'pm': pm,
+        'pm.max_children': max_children,
+        'pm.max_requests': max_requests,
+    }
+    if pm == 'dynamic':
+        min_spare = min(max_children, max(2, cpus))
+        max_spare = min(max_children, max(min_spare, cpus * 4))
+        pool['pm.start_servers'] = (min_spare + max_spare) // 2
+        pool['pm.min_spare_servers'] = min_spare
+        pool['pm.max_spare_servers'] = max_spare
+    elif pm == 'ondemand':
+        pool['pm.process_idle_timeout'] = '10s'
+    return pool
@@ -0,0 +1,205 @@
+"""
+Timing telemetry for charm hooks, occ commands and subprocesses.
+
+Every record is one JSON line in a size capped log (the previous log is
+kept as LOG_PATH.1), so it survives between hooks and can be summarized
+with stats(). Telemetry never makes a hook fail: errors writing the log
+are ignored.
+"""
+import functools
+import json
+import logging
+import os
+import subprocess
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+LOG_PATH = '/var/log/nextcloud-charm/telemetry.jsonl'
+MAX_LOG_BYTES = 2 * 1024 * 1024
+
+HANDLER = 'handler'
+SUBPROCESS = 'subprocess'
+OCC = 'occ'
+
+
+def record(kind, name, duration, **fields):
+    """
+    Append a record to the telemetry log.
+    :param kind: HANDLER, SUBPROCESS, OCC
+    :param name: what ran, e.g. the handler or command name
+    :param duration: wall time in seconds
+    """
+    entry = {'ts': round(time.time(), 3), 'kind': kind, 'name': name,
+             'duration': round(duration, 6),
+             'hook': os.environ.get('JUJU_HOOK_NAME') or os.environ.get('JUJU_ACTION_NAME')}
+    entry.update(fields)
+    try:
+        os.makedirs(os.path.dirname(LOG_PATH), exist_ok=True)
+        if os.path.exists(LOG_PATH) and os.path.getsize(LOG_PATH) > MAX_LOG_BYTES:
+            os.replace(LOG_PATH, LOG_PATH + '.1')
+        with open(LOG_PATH, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+    except OSError as e:
+        logger.debug("Could not write telemetry: %s", e)
+
+
+@contextmanager
+def timed(kind, name, **fields):
+    """
+    Record the wall time of the block. The yielded dict can be
+    filled with extra fields, e.g. a returncode.
+    """
+    extra = dict(fields)
+    start = time.monotonic()
+    try:
+        yield extra
+    except BaseException as e:
+        extra.setdefault('error', type(e).__name__)
+        raise
+    finally:
+        record(kind, name, time.monotonic() - start, **extra)
+
+
+def _command_name(args):
+    """
+    Short name for a command line: the executable, skipping sudo and its
+    options, plus the first argument (e.g. 'apt install', 'a2enmod rewrite').
+    """
+    if isinstance(args, str):
+        args = args.split()
+    args = [str(a) for a in args]
+    if args and args[0] == 'sudo':
+        args = args[1:]
+        while args and args[0].startswith('-'):
+            # sudo -u www-data
+            args = args[2:] if args[0] in ('-u', '-g') else args[1:]
+    return ' '.join(os.path.basename(a) if i == 0 else a for i, a in enumerate(args[:2]))
+
+
+def _output_size(output):
+    if output is None:
+        return 0
+    return len(output)
+
+
+class _TimedSubprocess:
+    """
+    Drop in for the subprocess module that records the wall time, exit
+    code and output size of run/call/check_call/check_output. Everything
+    else is passed through to subprocess.
+    """
+
+    def __getattr__(self, name):
+        return getattr(subprocess, name)
+
+    @staticmethod
+    def _args(args, kwargs):
+        return args[0] if args else kwargs.get('args')
+
+    def run(self, *args, **kwargs):
+        with timed(SUBPROCESS, _command_name(self._args(args, kwargs))) as extra:
+            result = subprocess.run(*args, **kwargs)
+            extra['returncode'] = result.returncode
+            extra['output_bytes'] = _output_size(result.stdout) + _output_size(result.stderr)
+        return result
+
+    def call(self, *args, **kwargs):
+        with timed(SUBPROCESS, _command_name(self._args(args, kwargs))) as extra:
+            extra['returncode'] = subprocess.call(*args, **kwargs)
+        return extra['returncode']
+
+    def check_call(self, *args, **kwargs):
+        with timed(SUBPROCESS, _command_name(self._args(args, kwargs))) as extra:
+            try:
+                subprocess.check_call(*args, **kwargs)
+            except subprocess.CalledProcessError as e:
+                extra['returncode'] = e.returncode
+                raise
+            extra['returncode'] = 0
+        return 0
+
+    def check_output(self, *args, **kwargs):
+        with timed(SUBPROCESS, _command_name(self._args(args, kwargs))) as extra:
+            try:
+                output = subprocess.check_output(*args, **kwargs)
+            except subprocess.CalledProcessError as e:
+                extra['returncode'] = e.returncode
+                raise
+            extra['returncode'] = 0
+            extra['output_bytes'] = _output_size(output)
+        return output
+
+
+# Use as "from nextcloud.telemetry import sp" in place of "import subprocess as sp".
+sp = _TimedSubprocess()
+
+
+def instrument(cls):
+    """
+    Class decorator recording the wall time of every event handler
+    (methods named _on_*) of a charm or charm Object.
+    """
+    for attr, func in list(vars(cls).items()):
+        if attr.startswith('_on_') and callable(func):
+            setattr(cls, attr, _timed_handler(func, f"{cls.__name__}.{attr}"))
+    return cls
+
+
+def _timed_handler(func, name):
+    @functools.wraps(func)
+    def wrapper(self, event, *args, **kwargs):
+        with timed(HANDLER, name, event=type(event).__name__) as extra:
+            result = func(self, event, *args, **kwargs)
+            if getattr(event, 'deferred', False):
+                extra['deferred'] = True
+        return result
+    return wrapper
+
+
+def read_log(path=None) -> list:
+    """
+    :return: all records of the current and the previous log, oldest first.
+    """
+    path = path or LOG_PATH
+    records = []
+    for p in (path + '.1', path):
+        try:
+            with open(p) as f:
+                for line in f:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        # A line cut short by a full disk or a killed hook.
+                        continue
+        except FileNotFoundError:
+            continue
+    return records
+
+
+def _percentile(values, pct):
+    values = sorted(values)
+    index = max(0, -(-len(values) * pct // 100) - 1)
+    return values[int(index)]
+
+
+def stats(records, kind=None) -> dict:
+    """
+    Summarize records per kind and name.
+    :return: {'kind:name': {'count', 'p50', 'p95', 'max', 'total'}}, in seconds,
+             sorted by total time, largest first.
+    """
+    durations = {}
+    for r in records:
+        if kind and r.get('kind') != kind:
+            continue
+        durations.setdefault(f"{r.get('kind')}:{r.get('name')}", []).append(r.get('duration', 0))
+    summary = {}
+    for key, values in durations.items():
+        summary[key] = {'count': len(values),
+                        'p50': round(_percentile(values, 50), 3),
+                        'p95': round(_percentile(values, 95), 3),
+                        'max': round(max(values), 3),
+                        'total': round(sum(values), 3)}
+    return dict(sorted(summary.items(), key=lambda kv: -kv[1]['total']))
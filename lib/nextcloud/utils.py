@@ -1,5 +1,13 @@
-import subprocess as sp
 import sys
+import os
+import functools
+import glob
+import pwd
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import contextmanager
 
 import lsb_release
 import requests
@@ -8,6 +16,10 @@ from pathlib import Path
 import jinja2
 import io
 
+from nextcloud import php_tuning
+from nextcloud.telemetry import sp
+from nextcloud.cache import ChecksumError, TarballCache
+
 
 def _modify_port(start=None, end=None, protocol='tcp', hook_tool="open-port"):
     assert protocol in {'tcp', 'udp', 'icmp'}
@@ -40,171 +52,807 @@ def close_port(start, end=None, protocol="tcp"):
     _modify_port(start, end, protocol=protocol, hook_tool="close-port")
 
 
-def set_directory_permissions():
-    sp.call("sudo chown -R www-data:www-data /var/www/nextcloud".split(),
-            cwd='/var/www/nextcloud')
+def set_directory_permissions(path='/var/www/nextcloud', owner='www-data', skip=(),
+                              max_depth=None, workers=1):
+    """
+    Give owner ownership of path and everything below it, like chown -R,
+    but only entries with a wrong uid/gid are changed, so an already
+    correct tree costs one stat per entry and no writes.
+    :param skip: directories, relative to path, whose content is not walked
+                 (the directory itself is still fixed), e.g. ['data']
+    :param max_depth: do not walk below this many levels under path
+    :param workers: directories scanned in parallel, useful on network
+                    filesystems where each stat is a round trip
+    :return: number of entries changed
+    """
+    ids = _owner_ids(owner)
+    if ids is None:
+        sp.call(f"sudo chown -R {owner}:{owner} {path}".split(), cwd=path)
+        return None
+    root = os.path.normpath(str(path))
+    skip = {os.path.normpath(os.path.join(root, s)) for s in skip}
+    changed = _chown_entry(root, os.lstat(root), ids)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = {pool.submit(_chown_dir, root, ids): 1} if max_depth != 0 else {}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                depth = pending.pop(future)
+                count, subdirs = future.result()
+                changed += count
+                if max_depth is not None and depth >= max_depth:
+                    continue
+                for subdir in subdirs:
+                    if subdir not in skip:
+                        pending[pool.submit(_chown_dir, subdir, ids)] = depth + 1
+    return changed
+
+
+def _chown_entry(path, st, ids):
+    if (st.st_uid, st.st_gid) == ids:
+        return 0
+    os.lchown(path, *ids)
+    return 1
+
+
+def _chown_dir(path, ids):
+    """
+    Fix ownership of the entries directly in path.
+    :return: (number changed, list of subdirectories)
+    """
+    changed = 0
+    subdirs = []
+    with os.scandir(path) as it:
+        for entry in it:
+            changed += _chown_entry(entry.path, entry.stat(follow_symlinks=False), ids)
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.path)
+    return changed, subdirs
 
 
-def install_dependencies():
+def write_atomic(path, text) -> bool:
     """
-    Installs package dependencies for the supported distros.
+    Replace the content of a file in one step (temp file + rename) so
+    readers never see a partially written file. Keeps owner and mode of an
+    existing file.
+    :return: True if the content changed.
+    """
+    path = Path(path)
+    try:
+        if path.read_text() == text:
+            return False
+        st = path.stat()
+    except FileNotFoundError:
+        st = None
+    fd, tmp = tempfile.mkstemp(dir=str(path.parent), prefix='.' + path.name + '.')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        if st:
+            os.chmod(tmp, st.st_mode & 0o7777)
+            if os.geteuid() == 0:
+                os.chown(tmp, st.st_uid, st.st_gid)
+        else:
+            os.chmod(tmp, 0o644)
+        os.replace(tmp, str(path))
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    return True
+
+
+# Packages that are needed by nextcloud to work with this charm.
+# Inspired by: https://github.com/nextcloud/vm/blob/master/nextcloud_install_production.sh
+PACKAGES = {
+    'bionic': ['apache2',
+               'libapache2-mod-php7.2',
+               'php7.2-gd',
+               'php7.2-json',
+               'php7.2-mysql',
+               'php7.2-pgsql',
+               'php7.2-curl',
+               'php7.2-mbstring',
+               'php7.2-intl',
+               'php-imagick',
+               'php7.2-zip',
+               'php7.2-xml',
+               'php-apcu',
+               'php-redis',
+               'php-smbclient',
+               'postgresql-client'],
+    'focal': ['apache2',
+              'libapache2-mod-php7.4',
+              'php7.4-intl',
+              'php7.4-ldap',
+              'php7.4-imap',
+              'php7.4-gd',
+              'php7.4-pgsql',
+              'php7.4-curl',
+              'php7.4-xml',
+              'php7.4-zip',
+              'php7.4-mbstring',
+              'php7.4-soap',
+              'php7.4-json',
+              'php7.4-gmp',
+              'php7.4-bz2',
+              'php7.4-bcmath',
+              'php-apcu',
+              'php-redis',
+              'php-pear',
+              'postgresql-client'],
+}
+# Needed to serve nextcloud with php-fpm (php-handler=fpm).
+FPM_PACKAGES = {
+    'bionic': ['php7.2-fpm'],
+    'focal': ['php7.4-fpm'],
+}
+# Needed to mount the shared-fs relation.
+NFS_PACKAGES = ['rpcbind', 'nfs-common']
+APT_ARCHIVES = '/var/cache/apt/archives'
+DPKG_STATUS = '/var/lib/dpkg/status'
+
+
+def plan_packages(codename, shared_fs=False, php_fpm=False) -> list:
+    """
+    The full list of packages for a unit, computed up front so they
+    can be installed in a single apt run.
     + focal
     + bionic
-    :return:
+    :param shared_fs: include the packages for the shared-fs relation
+    :param php_fpm: include php-fpm
     """
-    if 'focal' == lsb_release.get_distro_information()['CODENAME']:
-        _install_dependencies_focal()
-    elif 'bionic' == lsb_release.get_distro_information()['CODENAME']:
-        _install_dependencies_bionic()
-    else:
-        raise RuntimeError(f"No valid series found to install package dependencies for")
+    if codename not in PACKAGES:
+        raise RuntimeError(f"No valid series found to install package dependencies for {codename}")
+    packages = list(PACKAGES[codename])
+    if php_fpm:
+        packages.extend(FPM_PACKAGES[codename])
+    if shared_fs:
+        packages.extend(NFS_PACKAGES)
+    return packages
 
 
-def _install_dependencies_bionic():
+def installed_packages(status_path=None) -> set:
     """
-    Install packages that is needed by nextcloud to work with this charm.
-    Inspired by: https://github.com/nextcloud/vm/blob/master/nextcloud_install_production.sh
+    Names of the installed packages, read from the dpkg status file
+    instead of spawning dpkg-query.
     """
+    installed = set()
     try:
-        packages = ['apache2',
-                    'libapache2-mod-php7.2',
-                    'php7.2-gd',
-                    'php7.2-json',
-                    'php7.2-mysql',
-                    'php7.2-pgsql',
-                    'php7.2-curl',
-                    'php7.2-mbstring',
-                    'php7.2-intl',
-                    'php-imagick',
-                    'php7.2-zip',
-                    'php7.2-xml',
-                    'php-apcu',
-                    'php-redis',
-                    'php-smbclient']
-        command = ["sudo", "apt", "install", "-y"]
-        command.extend(packages)
-        sp.run(command, check=True)
-    except sp.CalledProcessError as e:
-        print(e)
-        sys.exit(-1)
+        with open(status_path or DPKG_STATUS) as f:
+            for stanza in f.read().split('\n\n'):
+                fields = dict(line.split(': ', 1) for line in stanza.splitlines()
+                              if ': ' in line and not line.startswith(' '))
+                if fields.get('Status', '').endswith(' installed'):
+                    installed.add(fields.get('Package'))
+    except FileNotFoundError:
+        pass
+    return installed
+
+
+def seed_apt_cache(deb_archive):
+    """
+    Copy the .deb files of a tarball (e.g. a juju resource) into the apt
+    cache, so apt installs them without downloading.
+    """
+    with tarfile.open(deb_archive) as tfile:
+        for member in tfile:
+            name = os.path.basename(member.name)
+            if member.isfile() and name.endswith('.deb'):
+                target = os.path.join(APT_ARCHIVES, name)
+                with tfile.extractfile(member) as src, open(target, 'wb') as dst:
+                    shutil.copyfileobj(src, dst)
 
 
-def _install_dependencies_focal():
+def install_packages(packages, deb_archive=None) -> list:
     """
-    Install packages that is needed by nextcloud to work with this charm.
-    Inspired by: https://github.com/nextcloud/vm/blob/master/nextcloud_install_production.sh
-    :return:
+    Install the packages that are not installed yet, in one apt run.
+    :param deb_archive: optional tarball of .deb files to seed the apt cache with
+    :return: the packages that were installed
     """
+    installed = installed_packages()
+    missing = [p for p in dict.fromkeys(packages) if p not in installed]
+    if not missing:
+        return []
+    if deb_archive:
+        seed_apt_cache(deb_archive)
     try:
-        packages = ['apache2',
-                    'libapache2-mod-php7.4',
-                    'php7.4-fpm',
-                    'php7.4-fpm',
-                    'php7.4-intl',
-                    'php7.4-ldap',
-                    'php7.4-imap',
-                    'php7.4-gd',
-                    'php7.4-pgsql',
-                    'php7.4-curl',
-                    'php7.4-xml',
-                    'php7.4-zip',
-                    'php7.4-mbstring',
-                    'php7.4-soap',
-                    'php7.4-json',
-                    'php7.4-gmp',
-                    'php7.4-bz2',
-                    'php7.4-bcmath',
-                    'php-pear']
         command = ["sudo", "apt", "install", "-y"]
-        command.extend(packages)
+        command.extend(missing)
         sp.run(command, check=True)
     except sp.CalledProcessError as e:
         print(e)
         sys.exit(-1)
+    # php and apache modules may have changed.
+    invalidate_probes()
+    return missing
+
+
+def install_dependencies(shared_fs=False, deb_archive=None, php_fpm=False):
+    """
+    Installs package dependencies for the supported distros.
+    :return:
+    """
+    return install_packages(plan_packages(get_distro_codename(), shared_fs=shared_fs,
+                                          php_fpm=php_fpm),
+                            deb_archive=deb_archive)
+
+
+WWW_DIR = Path('/var/www/')
+NEXTCLOUD_OWNER = 'www-data'
+
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+DOWNLOAD_RETRIES = 5
 
 
-def fetch_and_extract_nextcloud(tarfile_url):
+class ResumableDownload(io.RawIOBase):
+    """
+    Read-only file object over an HTTP download.
+    Data is pulled in DOWNLOAD_CHUNK_SIZE chunks, so memory use is bounded,
+    and a dropped connection is resumed with an HTTP Range request.
+    progress(bytes_read, total_bytes) is called for every chunk,
+    total_bytes is None if the server did not send a Content-Length.
+    """
+
+    def __init__(self, url, progress=None, retries=DOWNLOAD_RETRIES):
+        super().__init__()
+        self.url = url
+        self.progress = progress
+        self.retries = retries
+        self.offset = 0
+        self.total = None
+        self._buffer = b''
+        self._open()
+
+    def _open(self):
+        headers = {'Range': f"bytes={self.offset}-"} if self.offset else {}
+        response = requests.get(self.url, headers=headers, allow_redirects=True,
+                                stream=True, timeout=60)
+        response.raise_for_status()
+        if self.offset and response.status_code != 206:
+            raise IOError(f"{self.url} does not support resuming downloads")
+        if self.total is None and response.headers.get('Content-Length'):
+            self.total = int(response.headers['Content-Length'])
+        self._chunks = response.iter_content(DOWNLOAD_CHUNK_SIZE)
+
+    def _next_chunk(self):
+        while True:
+            try:
+                return next(self._chunks, b'')
+            except (requests.ConnectionError, requests.exceptions.ChunkedEncodingError) as e:
+                if self.retries <= 0:
+                    raise
+                self.retries -= 1
+                print(f"Download interrupted at {self.offset} bytes ({e}), resuming.")
+                self._open()
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if not self._buffer:
+            self._buffer = self._next_chunk()
+            if not self._buffer:
+                return 0
+        n = min(len(b), len(self._buffer))
+        b[:n] = self._buffer[:n]
+        self._buffer = self._buffer[n:]
+        self.offset += n
+        if self.progress:
+            self.progress(self.offset, self.total)
+        return n
+
+
+# Writer threads of extract_nextcloud. More threads were slower than
+# tarfile.extractall in benchmarks/bench_extract.py (0.7x), so one until
+# a benchmark shows a speedup.
+EXTRACT_WORKERS = 1
+
+
+def _download_to_cache(url, cache, sha256=None, progress=None, index_url=None):
+    """
+    Download url into the tarball cache, verifying sha256 if given.
+    The tarball is indexed under index_url (default url).
+    :return: Path to the cached tarball.
+    """
+    with ResumableDownload(url, progress=progress) as stream:
+        with cache.writer(index_url or url, sha256) as f:
+            for chunk in iter(lambda: stream.read(DOWNLOAD_CHUNK_SIZE), b''):
+                f.write(chunk)
+    return cache.lookup(index_url or url, sha256)
+
+
+def fetch_and_extract_nextcloud(tarfile_url, progress=None, sha256=None, cache=None,
+                                mirror_url=None, mirror_sha256=None):
     """
     Fetch and Install nextcloud from internet
-    Sources are about 100M.
+    Sources are about 100M. Without a cache and without a sha256 the
+    archive is streamed straight into the tar reader, it is never held in
+    memory as a whole. With a sha256 it is downloaded to a temporary
+    directory and verified before anything is extracted.
+    With a cache (nextcloud.cache.TarballCache) a cached copy is used if
+    there is one, otherwise the archive is downloaded into the cache,
+    verified and then extracted.
+    :param progress: optional callback(bytes_read, total_bytes)
+    :param sha256: optional expected checksum of the tarball
+    :param mirror_url: optional url tried before tarfile_url, e.g. the
+                       tarball shared by the leader unit
+    :param mirror_sha256: expected checksum of the mirror tarball,
+                          defaults to sha256
     """
     # tarfile_url = 'https://download.nextcloud.com/server/releases/nextcloud-18.0.3.tar.bz2'
     # checksum = '7b67e709006230f90f95727f9fa92e8c73a9e93458b22103293120f9cb50fd72'
     try:
-        response = requests.get(tarfile_url, allow_redirects=True, stream=True)
-        dst = Path('/var/www/')
-        with tarfile.open(fileobj=io.BytesIO(response.content), mode='r:bz2') as tfile:
-            tfile.extractall(path=dst)
-    except sp.CalledProcessError as e:
+        if cache is None and sha256:
+            with tempfile.TemporaryDirectory(prefix='nextcloud-tarball-') as tmpdir:
+                cached = _download_to_cache(tarfile_url, TarballCache(tmpdir), sha256, progress)
+                extract_nextcloud(cached)
+            return
+        if cache is None:
+            with ResumableDownload(tarfile_url, progress=progress) as stream:
+                with tarfile.open(fileobj=stream, mode='r|*',
+                                  bufsize=DOWNLOAD_CHUNK_SIZE) as tfile:
+                    extract_members(tfile, WWW_DIR, owner=NEXTCLOUD_OWNER)
+            return
+        cached = cache.lookup(tarfile_url, sha256)
+        if cached is None and mirror_url:
+            try:
+                cached = _download_to_cache(mirror_url, cache, mirror_sha256 or sha256, progress,
+                                            index_url=tarfile_url)
+            except (requests.RequestException, ChecksumError, IOError) as e:
+                print(f"Fetching from {mirror_url} failed ({e}), using {tarfile_url}")
+        if cached is None:
+            cached = _download_to_cache(tarfile_url, cache, sha256, progress)
+        extract_nextcloud(cached)
+    except (requests.RequestException, tarfile.TarError, ChecksumError, IOError) as e:
         print(e)
         sys.exit(-1)
 
 
-def extract_nextcloud(tarfile_path):
+def extract_nextcloud(tarfile_path, cache=None, dst=None, workers=EXTRACT_WORKERS):
     """
     Install nextcloud from tarfile
+    With a cache, the tarfile is also stored in it so it can be
+    shared with peer units.
+    The archive is decompressed once and the files are written by a pool
+    of worker threads, owned by www-data. bz2, xz, gz and zstd archives
+    are supported, bz2 and zstd use parallel external decompressors
+    (lbzip2/pbzip2, zstd) when installed.
+    :param workers: number of writer threads, at least 1
+    """
+    if cache is not None:
+        cache.add_file(tarfile_path)
+    dst = Path(dst or WWW_DIR)
+    with _open_tarball(tarfile_path) as (fileobj, mode):
+        with tarfile.open(fileobj=fileobj, mode=mode, bufsize=DOWNLOAD_CHUNK_SIZE) as tfile:
+            extract_members(tfile, dst, workers=workers, owner=NEXTCLOUD_OWNER)
+
+
+@contextmanager
+def _open_tarball(tarfile_path):
+    """
+    Open a tarball for streaming, picking the decompressor from the magic
+    bytes rather than the file name (juju resources are always named
+    nextcloud.tar.bz2).
+    :return: (file object, tarfile stream mode)
+    """
+    with open(tarfile_path, 'rb') as f:
+        magic = f.read(6)
+    tool = None
+    if magic.startswith(b'BZh'):
+        tool = shutil.which('lbzip2') or shutil.which('pbzip2')
+    elif magic.startswith(b'\x28\xb5\x2f\xfd'):
+        tool = shutil.which('zstd')
+        if tool is None:
+            # Optional python binding, used when the zstd tool is missing.
+            try:
+                import zstandard
+            except ImportError:
+                raise tarfile.ReadError(f"{tarfile_path} is zstd compressed, "
+                                        "install zstd to extract it")
+            with open(tarfile_path, 'rb') as f:
+                yield zstandard.ZstdDecompressor().stream_reader(f), 'r|'
+            return
+    if tool is None:
+        # Random access mode, much cheaper per member than stream mode.
+        with open(tarfile_path, 'rb') as f:
+            yield f, 'r:*'
+        return
+    proc = sp.Popen([tool, '-dc', str(tarfile_path)], stdout=sp.PIPE)
+    try:
+        yield proc.stdout, 'r|'
+    except BaseException:
+        # Keep the original error, the decompressor fails too once its
+        # output is closed.
+        proc.stdout.close()
+        proc.wait()
+        raise
+    proc.stdout.close()
+    if proc.wait() != 0:
+        raise tarfile.ReadError(f"{tool} failed to decompress {tarfile_path}")
+
+
+def _owner_ids(owner):
+    """
+    Resolve a user name to (uid, gid), None if we can't chown to it.
+    """
+    if owner is None or os.geteuid() != 0:
+        return None
+    try:
+        pw = pwd.getpwnam(owner)
+    except KeyError:
+        return None
+    return pw.pw_uid, pw.pw_gid
+
+
+def _member_path(dst, name):
+    """
+    Path of a tar member below dst, refusing absolute paths and '..'.
     """
-    dst = Path('/var/www/')
-    with tarfile.open(tarfile_path, mode='r:bz2') as tfile:
-        tfile.extractall(path=dst)
+    path = os.path.normpath(os.path.join(dst, name))
+    if path != dst and not path.startswith(dst + os.sep):
+        raise tarfile.ExtractError(f"Refusing to extract {name} outside of {dst}")
+    return path
 
 
-def config_apache2(templates_path, template):
+def _write_member(path, data, member, ids):
+    with open(path, 'wb') as f:
+        f.write(data)
+    os.chmod(path, member.mode & 0o7777)
+    if ids:
+        os.chown(path, *ids)
+    os.utime(path, (member.mtime, member.mtime))
+
+
+def extract_members(tfile, dst, workers=EXTRACT_WORKERS, owner=None):
+    """
+    Extract an (optionally streaming) tarfile.TarFile into dst.
+    Members are read in archive order by this thread. Directories are
+    created here, before any file in them is queued, while file contents
+    are written by a pool of threads. Links are made once all files exist.
+    At most workers * 4 files are held in memory at a time.
+    """
+    dst = os.path.realpath(str(dst))
+    ids = _owner_ids(owner)
+    dirs = []
+    links = []
+    made = set()
+    in_flight = threading.BoundedSemaphore(workers * 4)
+    futures = []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for member in tfile:
+            path = _member_path(dst, member.name)
+            if path == dst:
+                continue
+            parent = os.path.dirname(path)
+            if parent not in made:
+                os.makedirs(parent, exist_ok=True)
+                made.add(parent)
+            if member.isdir():
+                os.makedirs(path, exist_ok=True)
+                made.add(path)
+                dirs.append((path, member))
+            elif member.isfile():
+                data = tfile.extractfile(member).read()
+                in_flight.acquire()
+                future = pool.submit(_write_member, path, data, member, ids)
+                future.add_done_callback(lambda _: in_flight.release())
+                futures.append(future)
+            elif member.issym() or member.islnk():
+                links.append((path, member))
+        for future in futures:
+            future.result()
+    for path, member in links:
+        if os.path.lexists(path):
+            os.unlink(path)
+        if member.issym():
+            os.symlink(member.linkname, path)
+        else:
+            os.link(_member_path(dst, member.linkname), path)
+        if ids:
+            os.lchown(path, *ids)
+    # Deepest first, so a read-only directory does not block its children.
+    for path, member in reversed(dirs):
+        os.chmod(path, member.mode & 0o7777)
+        if ids:
+            os.chown(path, *ids)
+        os.utime(path, (member.mtime, member.mtime))
+
+
+TEMPLATE_CACHE_DIR = '/var/cache/nextcloud-charm/jinja2'
+
+
+@functools.lru_cache(maxsize=None)
+def _jinja_env(templates_path):
+    """
+    One jinja2 Environment per templates directory, with compiled
+    templates kept on disk between hooks.
+    """
+    try:
+        os.makedirs(TEMPLATE_CACHE_DIR, exist_ok=True)
+        bytecode_cache = jinja2.FileSystemBytecodeCache(TEMPLATE_CACHE_DIR)
+    except OSError:
+        bytecode_cache = None
+    env = jinja2.Environment(loader=jinja2.FileSystemLoader(templates_path),
+                             bytecode_cache=bytecode_cache,
+                             trim_blocks=True)
+    env.filters['php_str'] = php_str
+    return env
+
+
+def php_str(value) -> str:
+    """
+    Quote a value as a single quoted php string literal.
+    """
+    return "'" + str(value).replace('\\', '\\\\').replace("'", "\\'") + "'"
+
+
+def render_template(templates_path, template, ctx, target) -> bool:
+    """
+    Render template to target. The file is only (atomically) rewritten
+    when the rendered content differs from what is already there.
+    :return: True if target changed.
+    """
+    text = _jinja_env(str(templates_path)).get_template(template).render(ctx)
+    return write_atomic(target, text)
+
+
+def config_apache2(templates_path, template, ctx=None) -> bool:
     """
     Configures apache2
+    :return: True if the site config or enabled modules/sites changed.
     """
-    template = jinja2.Environment(
-        loader=jinja2.FileSystemLoader(templates_path)
-    ).get_template(template)
     target = Path('/etc/apache2/sites-available/nextcloud.conf')
-    ctx = {}
-    target.write_text(template.render(ctx))
+    changed = render_template(templates_path, template, ctx or {}, target)
     # Enable required modules.
     for module in ['rewrite', 'headers', 'env', 'dir', 'mime']:
-        sp.call(['a2enmod', module])
+        if module not in get_apache_modules():
+            sp.call(['a2enmod', module])
+            invalidate_probes('get_apache_modules')
+            changed = True
     # Disable default site
-    sp.check_call(['a2dissite', '000-default'])
+    if os.path.lexists('/etc/apache2/sites-enabled/000-default.conf'):
+        sp.check_call(['a2dissite', '000-default'])
+        changed = True
     # Enable nextcloud site (wich will be default)
-    sp.check_call(['a2ensite', 'nextcloud'])
+    if not os.path.lexists('/etc/apache2/sites-enabled/nextcloud.conf'):
+        sp.check_call(['a2ensite', 'nextcloud'])
+        changed = True
+    return changed
+
 
+# Apache modules for each php handler (php-handler config), and the
+# ones that have to be disabled for it. {php} is the php version.
+PHP_HANDLER_MODULES = {
+    'mod_php': (['mpm_prefork', 'php{php}'], ['mpm_event', 'proxy_fcgi']),
+    'fpm': (['mpm_event', 'proxy_fcgi', 'setenvif'], ['php{php}', 'mpm_prefork']),
+}
 
-def config_php(phpmod_context, templates_path, template):
+
+def config_php_handler(handler) -> bool:
+    """
+    Switch apache between mod_php with the prefork MPM and php-fpm
+    with the event MPM.
+    :return: True if modules changed. Changing the MPM needs a full
+             apache restart, a graceful reload is not enough.
+    """
+    phpversion = get_phpversion()
+    enable, disable = PHP_HANDLER_MODULES[handler]
+    enabled = get_apache_modules()
+    disable = [m.format(php=phpversion) for m in disable]
+    enable = [m.format(php=phpversion) for m in enable]
+    to_disable = [m for m in disable if m in enabled]
+    to_enable = [m for m in enable if m not in enabled]
+    # Disable first, apache refuses to enable a second MPM.
+    if to_disable:
+        sp.check_call(['a2dismod', '-q'] + to_disable)
+    if to_enable:
+        sp.check_call(['a2enmod', '-q'] + to_enable)
+    if to_disable or to_enable:
+        invalidate_probes('get_apache_modules')
+        return True
+    return False
+
+
+def fpm_pool_path() -> Path:
+    return Path(f"/etc/php/{get_phpversion()}/fpm/pool.d/nextcloud.conf")
+
+
+def fpm_socket() -> str:
+    return f"/run/php/php{get_phpversion()}-fpm-nextcloud.sock"
+
+
+def fpm_service() -> str:
+    return f"php{get_phpversion()}-fpm"
+
+
+def config_php_fpm(pool_ctx, templates_path, template) -> bool:
+    """
+    Renders the php-fpm pool for nextcloud, or removes it when pool_ctx
+    is None.
+    :return: True if the pool config changed.
+    """
+    target = fpm_pool_path()
+    if pool_ctx is None:
+        if target.exists():
+            target.unlink()
+            return True
+        return False
+    pool_ctx = dict(pool_ctx, socket=fpm_socket())
+    return render_template(templates_path, template, pool_ctx, target)
+
+
+def config_php(phpmod_context, templates_path, template) -> bool:
     """
     Renders the phpmodule for nextcloud (nextcloud.ini)
     This is instead of manipulating the system wide php.ini
     which might be overwitten or changed from elsewhere.
+    :return: True if nextcloud.ini changed or was not enabled.
+    """
+    phpversion = get_phpversion()
+    target = Path(f"/etc/php/{phpversion}/mods-available/nextcloud.ini")
+    blacklist = Path(f"/etc/php/{phpversion}/nextcloud-opcache-blacklist.txt")
+    blacklist_changed = write_atomic(blacklist, '\n'.join(php_tuning.OPCACHE_BLACKLIST) + '\n')
+    php_settings = dict(phpmod_context.get('php_settings', {}))
+    php_settings.setdefault('opcache.blacklist_filename', str(blacklist))
+    phpmod_context = dict(phpmod_context, php_settings=php_settings)
+    changed = render_template(templates_path, template, phpmod_context, target)
+    changed = changed or blacklist_changed
+    # Every SAPI (apache2, fpm, cli) has its own conf.d, fpm may be installed later.
+    sapis = glob.glob(f"/etc/php/{phpversion}/*/conf.d")
+    if changed or not sapis or any(not glob.glob(f"{d}/*-nextcloud.ini") for d in sapis):
+        sp.check_call(['phpenmod', 'nextcloud'])
+        changed = True
+    return changed
+
+
+def config_redis(redis_info, templates_path, template) -> bool:
+    """
+    Renders the redis config for nextcloud (redis.config.php), or removes
+    it when redis_info is empty.
     """
-    template = jinja2.Environment(
-        loader=jinja2.FileSystemLoader(templates_path)
-    ).get_template(template)
-    target_72 = Path('/etc/php/7.2/mods-available/nextcloud.ini')
-    target_74 = Path('/etc/php/7.4/mods-available/nextcloud.ini')
-    if get_phpversion() == "7.4":
-        target_74.write_text(template.render(phpmod_context))
-    elif get_phpversion() == "7.2":
-        target_72.write_text(template.render(phpmod_context))
-    sp.check_call(['phpenmod', 'nextcloud'])
-
-
-def config_redis(redis_info, templates_path, template):
-    template = jinja2.Environment(
-        loader=jinja2.FileSystemLoader(templates_path)
-    ).get_template(template)
     target = Path('/var/www/nextcloud/config/redis.config.php')
-    target.write_text(template.render(redis_info))
+    if not redis_info:
+        if target.exists():
+            target.unlink()
+            return True
+        return False
+    return render_template(templates_path, template, redis_info, target)
+
 
-def config_ceph(ceph_info, templates_path, template):
+def config_dbreplica(replicas, templates_path, template) -> bool:
     """
-    Renders the phpmodule for nextcloud (nextcloud.ini)
-    This is instead of manipulating the system wide php.ini
-    which might be overwitten or changed from elsewhere.
+    Renders the database read replicas for nextcloud (dbreplica.config.php),
+    or removes it when there are none.
+    :param replicas: list of dicts with host, dbname, user and password
+    """
+    target = Path('/var/www/nextcloud/config/dbreplica.config.php')
+    if not replicas:
+        if target.exists():
+            target.unlink()
+            return True
+        return False
+    return render_template(templates_path, template, {'replicas': replicas}, target)
+
+
+def config_ceph(ceph_info, templates_path, template) -> bool:
+    """
+    Renders the S3 objectstore config for nextcloud (ceph.config.php)
     """
-    template = jinja2.Environment(
-        loader=jinja2.FileSystemLoader(templates_path)
-    ).get_template(template)
     target = Path('/var/www/nextcloud/config/ceph.config.php')
-    target.write_text(template.render(ceph_info))
+    return render_template(templates_path, template, ceph_info, target)
+
+
+def config_previews(preview_ctx, templates_path, template) -> bool:
+    """
+    Renders the preview config for nextcloud (previews.config.php)
+    """
+    target = Path('/var/www/nextcloud/config/previews.config.php')
+    return render_template(templates_path, template, preview_ctx, target)
+
+
+SYSTEMD_DIR = Path('/etc/systemd/system')
+
 
+def config_timer(name, ctx, templates_path) -> bool:
+    """
+    Renders a systemd service and the timer starting it, from the
+    templates <name>.service.j2 and <name>.timer.j2, and enables the
+    timer. When ctx is None the timer is stopped and both are removed.
+    A run in progress is not interrupted.
+    :return: True if the units changed.
+    """
+    units = [SYSTEMD_DIR / f"{name}.service", SYSTEMD_DIR / f"{name}.timer"]
+    timer = f"{name}.timer"
+    if ctx is None:
+        if not any(unit.exists() for unit in units):
+            return False
+        sp.call(['systemctl', 'disable', '--now', timer])
+        for unit in units:
+            if unit.exists():
+                unit.unlink()
+        sp.check_call(['systemctl', 'daemon-reload'])
+        return True
+    changed = False
+    for unit in units:
+        changed = render_template(templates_path, unit.name + '.j2', ctx, unit) or changed
+    if changed:
+        sp.check_call(['systemctl', 'daemon-reload'])
+        sp.check_call(['systemctl', 'enable', timer])
+        # Restart, a running timer keeps its old schedule.
+        sp.check_call(['systemctl', 'restart', timer])
+    return changed
+
+
+# Host facts (php version, distro, modules) probed at most once per hook.
+# The charm can persist them between hooks with export_probes/load_probes,
+# they are dropped when the installed packages change.
+_probes = {}
+# Probes of state that can change outside the charm, never persisted.
+_hook_only_probes = set()
+
+
+def probe(func=None, persist=True):
+    """
+    Memoize a host probe (a function without arguments) under its name.
+    :param persist: False to keep the fact for the current hook only,
+                    e.g. for state changed by hand between hooks
+    """
+    if func is None:
+        return functools.partial(probe, persist=persist)
+    if not persist:
+        _hook_only_probes.add(func.__name__)
+
+    @functools.wraps(func)
+    def wrapper():
+        if func.__name__ not in _probes:
+            _probes[func.__name__] = func()
+        return _probes[func.__name__]
+    return wrapper
+
+
+def invalidate_probes(*names):
+    """
+    Forget the named probes, or all of them.
+    """
+    if not names:
+        _probes.clear()
+    for name in names:
+        _probes.pop(name, None)
+
+
+def packages_fingerprint() -> str:
+    """
+    Changes whenever dpkg installs or removes packages.
+    """
+    try:
+        return str(os.stat(DPKG_STATUS).st_mtime_ns)
+    except FileNotFoundError:
+        return ''
+
+
+def export_probes() -> dict:
+    """
+    Probed facts, for storing in the charm StoredState.
+    """
+    return {'fingerprint': packages_fingerprint(),
+            'facts': {name: value for name, value in _probes.items()
+                      if name not in _hook_only_probes}}
+
+
+def load_probes(saved):
+    """
+    Reuse facts saved by export_probes in an earlier hook, unless
+    packages have changed since.
+    """
+    if saved and saved.get('fingerprint') == packages_fingerprint():
+        for name, value in saved.get('facts', {}).items():
+            if name not in _hook_only_probes:
+                _probes.setdefault(name, value)
+
+
+@probe
 def get_phpversion():
     """
     Get php version X.Y from the running system.
@@ -221,4 +869,21 @@ def get_phpversion():
     elif "PHP 7.2" in lines[0]:
         return "7.2"
     else:
-        raise RuntimeError(f"No valid PHP version found in check")
+        raise RuntimeError("No valid PHP version found in check")
+
+
+@probe
+def get_distro_codename():
+    """
+    :return: the distro codename, e.g. 'focal'
+    """
+    return lsb_release.get_distro_information()['CODENAME']
+
+
+@probe(persist=False)
+def get_apache_modules():
+    """
+    Not kept between hooks, an a2dismod by hand would go unnoticed.
+    :return: sorted list of the enabled apache modules
+    """
+    return sorted(Path(p).stem for p in glob.glob('/etc/apache2/mods-enabled/*.load'))